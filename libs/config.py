@@ -142,6 +142,10 @@ DefaultOptions = dict(
     # Target attention options
     # Target attention layer id, default is None, means not use target attention.
     trg_attention_layer_id=None,
+
+    # Number of sampled words of the training softmax (besides target words of the batch),
+    # default is 0, means use the full softmax.
+    sampled_softmax=0,
 )
 
 
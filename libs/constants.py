@@ -3,7 +3,8 @@
 
 from __future__ import print_function
 
-profile = False
+# Passed to all compiled functions, None means following `theano.config.profile`
+profile = None
 fX = 'float32'
 
 ImmediateFilename = '{}_imm.iter{}.npz'
@@ -11,6 +12,28 @@ TempImmediateFilename = '{}_imm_tmp.iter{}.npz'
 BestImmediateFilename = '{}_imm.npz'
 BestTempImmediateFilename = '{}_imm_tmp.npz'
 
+# Data iterator state of a checkpoint, formatted with (model filename prefix, iteration, worker id).
+IteratorStateFilename = '{}_iterstate.iter{}.worker{}.pkl'
+# Latest data iterator state (overwritten), formatted with (model filename prefix, worker id).
+LatestIteratorStateFilename = '{}_iterstate.worker{}.pkl'
+
+# Binary pre-indexed corpus, formatted with (text corpus filename, n_words).
+BinaryCorpusFilename = '{}.n{}.ids.npy'
+BinaryOffsetsFilename = '{}.n{}.offsets.npy'
+
+# Length index of a text corpus (token count and byte offset of each line), formatted with the corpus filename.
+LengthIndexFilename = '{}.lengths.npy'
+LineOffsetsFilename = '{}.line_offsets.npy'
+
+# Memory-mapped vocabulary, formatted with the pickled dict filename.
+VocabularyFilename = '{}.vocab'
+
+# JSON-lines training metrics, formatted with (metrics filename prefix, worker id).
+MetricsFilename = '{}.worker{}.jsonl'
+
+# Extension of the unified checkpoint container (replaces ".npz" of the model filename).
+CheckpointExtension = '.ckpt'
+
 # Cycle of shuffle data.
 ShuffleCycle = 7
 
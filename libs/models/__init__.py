@@ -8,15 +8,12 @@ __author__ = 'fyabc'
 
 
 def build_and_init_model(model_name, options=None, build=True, model_type='NMTModel'):
-    import cPickle as pkl
-
     from ..config import DefaultOptions
-    from ..utility.utils import load_params
+    from ..utility.utils import load_params, load_model_options
 
     if options is None:
-        with open('{}.pkl'.format(model_name), 'rb') as f:
-            options = DefaultOptions.copy()
-            options.update(pkl.load(f))
+        options = DefaultOptions.copy()
+        options.update(load_model_options(model_name))
 
     model = eval(model_type)(options)
 
@@ -23,6 +23,7 @@ from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
 from ..constants import fX, profile
 from ..config import DefaultOptions
 from ..utility.utils import *
+from ..utility.checkpoint import load_archive
 from ..layers import *
 
 __author__ = 'fyabc'
@@ -131,7 +132,7 @@ class ParameterInitializer(object):
             if load_embedding:
                 # [NOTE] Important: Load embedding even in random init case
                 print('Loading embedding')
-                old_params = np.load(self.O['preload'])
+                old_params = load_archive(self.O['preload'])
                 np_parameters['Wemb'] = old_params['Wemb']
 
         print_params(np_parameters)
@@ -172,7 +173,7 @@ class ParameterInitializer(object):
             if load_embedding:
                 # [NOTE] Important: Load embedding even in random init case
                 print('Loading embedding')
-                old_params = np.load(self.O['preload'])
+                old_params = load_archive(self.O['preload'])
                 np_parameters['Wemb'] = old_params['Wemb']
                 np_parameters['Wemb_dec'] = old_params['Wemb_dec']
 
@@ -308,6 +309,8 @@ class NMTModel(object):
             self.O['dropout_out'] = 0.5 if 'fix_dp_bug' not in options or not options['fix_dp_bug'] else self.O['use_dropout'] #recover previous dropout_before_softmax
         if 'cost_normalization' not in options:
             self.O['cost_normalization'] = 1
+        if 'sampled_softmax' not in options:
+            self.O['sampled_softmax'] = 0
             
         # Dict of parameters (Theano shared variables)
         self.P = OrderedDict() if given_params is None else given_params
@@ -427,11 +430,20 @@ class NMTModel(object):
             projected_context=pre_projected_context,dropout_params=dropout_params, one_step=False,
         )
 
-        trng, use_noise, probs = self.get_word_probability(hidden_decoder, context_decoder, tgt_embedding,
-                                                           trng=trng, use_noise=use_noise)
+        logit_hidden = self.get_logit_hidden(hidden_decoder, context_decoder, tgt_embedding, trng, use_noise)
+        probs = self.output_probability(logit_hidden)
         test_cost = self.build_cost(y, y_mask, probs)
         cost =  test_cost / self.O['cost_normalization'] #cost used to derive gradient in training
 
+        if self.O['sampled_softmax'] > 0:
+            # Sampled softmax over the candidate words of the batch, see `sample_candidates`.
+            # The inputs are given after [x, x_mask, y, y_mask], the full softmax cost is still returned.
+            y_cand = T.vector('y_cand', dtype='int64')
+            y_cand_idx = T.matrix('y_cand_idx', dtype='int64')
+            sampled_probs = self.output_probability(logit_hidden, candidates=y_cand)
+            opt_ret['sampled_inputs'] = [y_cand, y_cand_idx]
+            opt_ret['sampled_cost'] = self.build_cost(y_cand_idx, y_mask, sampled_probs) / self.O['cost_normalization']
+
         # Plot computation graph
         if self.O['plot_graph'] is not None:
             print('Plotting pre-compile graph...', end='')
@@ -503,10 +515,11 @@ class NMTModel(object):
         :returns f_init, f_next
             f_init: Theano function
                 inputs: x, [if batch mode: x_mask]
-                outputs: init_state, ctx
+                outputs: init_state, [if not resident ctx: ctx]
 
             f_next: Theano function
                 inputs: y, ctx, [if batch mode: x_mask], init_state, [if LSTM unit: init_memory]
+                    [if resident ctx: y, hyp_sentence_indices, init_state, [if LSTM unit: init_memory]]
                 outputs: next_probs, next_sample, hiddens_without_dropout, [if LSTM unit: memory_out],
                     [if get_gates:
                         T.stack(kw_ret['input_gates']),
@@ -516,6 +529,10 @@ class NMTModel(object):
                         kw_ret['forget_gates_att'],
                         kw_ret['output_gates_att'],
                     ]
+
+            If `resident_ctx` is True (batch mode only), f_init stores the context, projected context and x_mask
+            of the batch into shared variables, and f_next takes the sentence index of each hypothesis instead of
+            the repeated context. The second element of the f_next list (f_att_projected) is None in this mode.
         """
 
         batch_mode = kwargs.pop('batch_mode', False)
@@ -525,6 +542,7 @@ class NMTModel(object):
         dropout_rate = kwargs.pop('dropout', False)
         dropout_rate_out = self.O['dropout_out']
         need_srcattn = kwargs.pop('need_srcattn', False)
+        resident_ctx = kwargs.pop('resident_ctx', False) and batch_mode
 
         if dropout_rate is not False:
             dropout_params = [use_noise, trng, dropout_rate]
@@ -557,17 +575,29 @@ class NMTModel(object):
         ctx_mean = self.get_context_mean(ctx, x_mask) if batch_mode else ctx.mean(0)
         init_state = self.feed_forward(ctx_mean, prefix='ff_state', activation=tanh)
 
+        pre_projected_context_ = self.attention_projected_context(ctx, prefix='decoder')
+
         print('Building f_init...', end='')
         inps = [x]
         if batch_mode:
             inps.append(x_mask)
-        outs = [init_state, ctx]
-        f_init = theano.function(inps, outs, name='f_init', profile=profile)
+        if resident_ctx:
+            # Keep the context of the batch on device, f_next gathers it by hypothesis sentence indices
+            ctx_shared = theano.shared(np.zeros((1, 1, 1), dtype=fX), name='ctx_shared')
+            proj_ctx_shared = theano.shared(np.zeros((1, 1, 1), dtype=fX), name='proj_ctx_shared')
+            x_mask_shared = theano.shared(np.zeros((1, 1), dtype=fX), name='x_mask_shared')
+            f_init = theano.function(inps, [init_state], name='f_init', profile=profile, updates=[
+                (ctx_shared, ctx),
+                (proj_ctx_shared, pre_projected_context_),
+                (x_mask_shared, x_mask),
+            ])
+            f_att_projected = None
+        else:
+            outs = [init_state, ctx]
+            f_init = theano.function(inps, outs, name='f_init', profile=profile)
+            f_att_projected = theano.function([ctx], pre_projected_context_, name='f_att_projected', profile=profile)
         print('Done')
 
-        pre_projected_context_ = self.attention_projected_context(ctx, prefix='decoder')
-        f_att_projected = theano.function([ctx], pre_projected_context_, name='f_att_projected', profile=profile)
-
         # x: 1 x 1
         y = T.vector('y_sampler', dtype='int64')
         init_state = T.tensor3('init_state', dtype=fX)
@@ -613,9 +643,19 @@ class NMTModel(object):
         # Compile a function to do the whole thing above, next word probability,
         # sampled word for the next target, next hidden state to be used
         print('Building f_next..', end='')
-        inps = [y, ctx, proj_ctx, init_state]
-        if batch_mode:
-            inps.insert(2, x_mask)
+        givens = None
+        if resident_ctx:
+            hyp_sentences = T.vector('hyp_sentences', dtype='int64')
+            inps = [y, hyp_sentences, init_state]
+            givens = [
+                (ctx, ctx_shared[:, hyp_sentences]),
+                (proj_ctx, proj_ctx_shared[:, hyp_sentences]),
+                (x_mask, x_mask_shared[:, hyp_sentences]),
+            ]
+        else:
+            inps = [y, ctx, proj_ctx, init_state]
+            if batch_mode:
+                inps.insert(2, x_mask)
         outs = [next_probs, next_sample, hiddens_without_dropout]
         if need_srcattn:
             outs.append(alpha_src)
@@ -631,7 +671,7 @@ class NMTModel(object):
                 kw_ret['forget_gates_att'],
                 kw_ret['output_gates_att'],
             ])
-        f_next = theano.function(inps, outs, name='f_next', profile=profile)
+        f_next = theano.function(inps, outs, name='f_next', profile=profile, givens=givens)
         print('Done')
 
         return f_init, [f_next, f_att_projected]
@@ -796,6 +836,10 @@ class NMTModel(object):
         """
         Only used for Batch Beam Search;
         Do not Support Stochastic Sampling
+
+        Hypotheses are kept in a dense (batch, beam) layout: slot jj * k + kk is the kk-th hypothesis of sentence jj.
+        Only live hypotheses are fed into f_next, in slot order.
+        If the sampler is built with `resident_ctx` (f_next[1] is None), only their sentence indices are fed.
         """
 
         kw_ret = {}
@@ -813,29 +857,39 @@ class NMTModel(object):
         sample_score = [[] for _ in xrange(batch_size)]
         sample_attn_src_words = [[] for _ in xrange(batch_size)]
 
-        lives_k = [1] * batch_size
-        deads_k = [0] * batch_size
-
-        batch_hyp_samples = [[[]] for _ in xrange(batch_size)]
-        batch_hyp_scores = [np.zeros(ii, dtype=fX) for ii in lives_k]
+        n_slots = batch_size * k
+        hyp_scores = np.zeros(n_slots, dtype=fX)
+        hyp_words = np.zeros((n_slots, maxlen), dtype='int64')
         if attn_src:
-            batch_hyp_attn_src_words = [[[]] for _ in xrange(batch_size)]
+            hyp_attn_src_words = np.zeros((n_slots, maxlen), dtype='int64')
+        lives = np.zeros(n_slots, dtype=bool)
+        lives[::k] = True
+        deads_k = np.zeros(batch_size, dtype='int64')
+        beam_range = np.arange(k)
+        hyp_len = 0
+
+        resident_ctx = f_next[1] is None
 
         # get initial state of decoder rnn and encoder context
         ret = f_init(x, x_mask)
-        next_state, ctx0 = ret[0], ret[1]
+        next_state = ret[0]
         next_w = np.array([-1] * batch_size, dtype='int64')  # bos indicator
         next_state = np.tile(next_state[None, :, :], (self.O['n_decoder_layers'], 1, 1))
         next_memory = np.zeros((self.O['n_decoder_layers'], next_state.shape[1], next_state.shape[2]), dtype=fX)
-        ctx = np.repeat(ctx0, lives_k, axis=1)
-        projected_context_ = f_next[1](ctx)
+        if not resident_ctx:
+            ctx0 = ret[1]
+            projected_context0 = f_next[1](ctx0)
 
         for ii in xrange(maxlen):
-            ctx = np.repeat(ctx0, lives_k, axis=1)
-            p_context_ = np.repeat(projected_context_, lives_k, axis=1)
-            x_extend_masks = np.repeat(x_mask, lives_k, axis=1)
+            live_slots = np.flatnonzero(lives)
+            live_sents = live_slots // k
+            n_live = len(live_slots)
 
-            inps = [next_w, ctx, x_extend_masks, p_context_, next_state]
+            if resident_ctx:
+                inps = [next_w, live_sents, next_state]
+            else:
+                inps = [next_w, ctx0[:, live_sents], x_mask[:, live_sents], projected_context0[:, live_sents],
+                        next_state]
             if 'lstm' in unit:
                 inps.append(next_memory)
 
@@ -847,117 +901,81 @@ class NMTModel(object):
                 if ret_memory:
                     kw_ret['memory'].append(next_memory)
 
-            next_w_list = []
-            next_state_list = []
-            next_memory_list = []
-
             next_p, next_state = ret[0], ret[2]
             if attn_src:
                 attn = ret[3]
 
-            cursor_start, cursor_end = 0, lives_k[0]
-
-            for jj in xrange(batch_size): #iterate over every instance in the batch
-                if cursor_start == cursor_end:
-                    if jj < batch_size - 1:
-                        cursor_end += lives_k[jj + 1]
-                    continue
-                index_range = range(cursor_start, cursor_end)
-                tmp = next_p[index_range, :]
-                cand_scores = batch_hyp_scores[jj][:, None] - ne.evaluate('log(tmp)')
-                cand_flat = cand_scores.flatten()
-
-                try:
-                    from bottleneck import argpartition as part_sort
-                    ranks_flat = part_sort(cand_flat, kth=k - deads_k[jj] - 1)[:k - deads_k[jj]]
-                except ImportError:
-                    from bottleneck import argpartsort as part_sort
-                    ranks_flat = part_sort(cand_flat, k - deads_k[jj])[:k - deads_k[jj]]
-
-                voc_size = next_p.shape[1]
-                trans_indices = ranks_flat / voc_size
-                word_indices = ranks_flat % voc_size
-                costs = cand_flat[ranks_flat]
-
-                new_hyp_samples = []
-                new_hyp_scores = np.zeros(k - deads_k[jj]).astype('float32')
-                new_hyp_states = []
-                new_hyp_memories = []
-                if attn_src:
-                    new_attn_src_words = []
-
-                for idx, [ti, wi] in enumerate(zip(trans_indices, word_indices)):
-                    new_hyp_samples.append(batch_hyp_samples[jj][ti] + [wi])
-                    new_hyp_scores[idx] = copy.copy(costs[idx])
-                    new_hyp_states.append(copy.copy(next_state[:, cursor_start + ti, :]))
-                    new_hyp_memories.append(copy.copy(next_memory[:, cursor_start + ti, :]))
-                    if attn_src:
-                        new_attn_src_words.append(copy.copy(batch_hyp_attn_src_words[jj][ti] + \
-                                                        [attn[cursor_start + ti].argmax()]))
-                # check the finished samples
-                new_live_k = 0
-                batch_hyp_samples[jj] = []
-                hyp_scores = []
-                hyp_states = []
-                hyp_memories = []
+            # Best k candidates of each live hypothesis, enough to get the best k of each sentence
+            cand_scores = hyp_scores[live_slots][:, None] - ne.evaluate('log(next_p)')
+            row_best = np.argpartition(cand_scores, k - 1, axis=1)[:, :k]
+            beam_scores = np.full((n_slots, k), np.inf, dtype=fX)
+            beam_scores[live_slots] = cand_scores[np.arange(n_live)[:, None], row_best]
+            beam_scores = beam_scores.reshape(batch_size, k * k)
+
+            # Select the best (k - deads) candidates of each sentence, new hypotheses are put in slots in cost order
+            ranks = np.argsort(beam_scores, axis=1, kind='mergesort')[:, :k]
+            sel_sents, sel_beams = np.nonzero(beam_range[None, :] < (k - deads_k)[:, None])
+            ranks = ranks[sel_sents, sel_beams]
+
+            row_of_slot = np.empty(n_slots, dtype='int64')
+            row_of_slot[live_slots] = np.arange(n_live)
+            parent_slots = sel_sents * k + ranks // k
+            parent_rows = row_of_slot[parent_slots]
+            new_words = row_best[parent_rows, ranks % k]
+            new_slots = sel_sents * k + sel_beams
+
+            hyp_scores[new_slots] = beam_scores[sel_sents, ranks]
+            hyp_words[new_slots] = hyp_words[parent_slots]
+            hyp_words[new_slots, ii] = new_words
+            if attn_src:
+                hyp_attn_src_words[new_slots] = hyp_attn_src_words[parent_slots]
+                hyp_attn_src_words[new_slots, ii] = attn[parent_rows].argmax(axis=1)
+            hyp_len = ii + 1
+
+            # check the finished samples
+            finished = new_words == eos_id
+            for jj, slot in zip(sel_sents[finished], new_slots[finished]):
+                sample[jj].append(hyp_words[slot, :hyp_len].tolist())
+                sample_score[jj].append(hyp_scores[slot])
                 if attn_src:
-                    batch_hyp_attn_src_words[jj] = []
-
-                for idx in xrange(len(new_hyp_samples)):
-                    if new_hyp_samples[idx][-1] == eos_id:
-                        sample[jj].append(new_hyp_samples[idx])
-                        sample_score[jj].append(new_hyp_scores[idx])
-                        if attn_src:
-                            sample_attn_src_words[jj].append(new_attn_src_words[idx])
-                        deads_k[jj] += 1
-                    else:
-                        new_live_k += 1
-                        batch_hyp_samples[jj].append(new_hyp_samples[idx])
-                        hyp_scores.append(new_hyp_scores[idx])
-                        hyp_states.append(new_hyp_states[idx])
-                        hyp_memories.append(new_hyp_memories[idx])
-                        if attn_src:
-                            batch_hyp_attn_src_words[jj].append(new_attn_src_words[idx])
+                    sample_attn_src_words[jj].append(hyp_attn_src_words[slot, :hyp_len].tolist())
+            deads_k += np.bincount(sel_sents[finished], minlength=batch_size)
 
-                batch_hyp_scores[jj] = np.array(hyp_scores)
-                lives_k[jj] = new_live_k
+            alive = ~finished
+            lives.fill(False)
+            lives[new_slots[alive]] = True
 
-                if jj < batch_size - 1:
-                    cursor_start = cursor_end
-                    cursor_end += lives_k[jj + 1]
-
-                if hyp_states:
-                    next_w_list += [w[-1] for w in batch_hyp_samples[jj]]
-                    next_state_list += [xx[:, None, :] for xx in hyp_states]
-                    next_memory_list += [xx[:, None, :] for xx in hyp_memories]
-
-            if np.array(lives_k).sum() > 0:
-                next_w = np.array(next_w_list)
-                next_state = np.concatenate(next_state_list[:], axis=1)
-                next_memory = np.concatenate(next_memory_list[:], axis=1)
+            if lives.any():
+                next_w = new_words[alive]
+                next_state = next_state[:, parent_rows[alive], :]
+                next_memory = next_memory[:, parent_rows[alive], :]
             else:
                 break
 
         # dump every remaining one
-        for jj in xrange(batch_size):
-            if lives_k[jj] > 0:
-                for idx in xrange(lives_k[jj]):
-                    sample[jj].append(batch_hyp_samples[jj][idx])
-                    sample_score[jj].append(batch_hyp_scores[jj][idx])
-                    if attn_src:
-                        sample_attn_src_words[jj].append(batch_hyp_attn_src_words[jj][idx])
+        for slot in np.flatnonzero(lives):
+            jj = slot // k
+            sample[jj].append(hyp_words[slot, :hyp_len].tolist())
+            sample_score[jj].append(hyp_scores[slot])
+            if attn_src:
+                sample_attn_src_words[jj].append(hyp_attn_src_words[slot, :hyp_len].tolist())
 
         if have_kw_ret:
             return sample, sample_score, sample_attn_src_words, kw_ret
         return sample, sample_score, sample_attn_src_words
 
-    def save_model(self, saveto, history_errs, uidx = -1):
+    def save_model(self, saveto, history_errs, uidx = -1, writer = None):
+        """Save the model, in background if the `CheckpointWriter` writer is given."""
         saveto_path = '{}.iter{}.npz'.format(
                         os.path.splitext(saveto)[0], uidx) \
             if uidx != -1 else saveto
-        np.savez(saveto_path, history_errs=history_errs,
-                 uidx=uidx, **unzip(self.P))
-        save_options(self.O, uidx, saveto)
+        if writer is not None:
+            writer.save_npz(saveto_path, history_errs=list(history_errs),
+                            uidx=uidx, **self.P)
+        else:
+            np.savez(saveto_path, history_errs=history_errs,
+                     uidx=uidx, **unzip(self.P))
+        save_options(self.O, uidx, saveto, writer=writer)
         return saveto_path
 
     @staticmethod
@@ -1361,11 +1379,8 @@ class NMTModel(object):
 
             return outputs[-1], context_decoder, alpha_decoder, kw_ret
 
-    def get_word_probability(self, hidden_decoder, context_decoder, tgt_embedding, **kwargs):
-        """Compute word probabilities."""
-
-        trng = kwargs.pop('trng', RandomStreams(1234))
-        use_noise = kwargs.pop('use_noise', theano.shared(np.float32(0.)))
+    def get_logit_hidden(self, hidden_decoder, context_decoder, tgt_embedding, trng, use_noise):
+        """Compute the hidden layer before the output layer."""
 
         logit_lstm = self.feed_forward(hidden_decoder, prefix='ff_logit_lstm', activation=linear)
         logit_prev = self.feed_forward(tgt_embedding, prefix='ff_logit_prev', activation=linear)
@@ -1374,19 +1389,58 @@ class NMTModel(object):
         if self.O['dropout_out']:
             logit = self.dropout(logit, use_noise, trng, self.O['dropout_out'])
 
-        # n_timestep * n_sample * n_words
-        logit = self.feed_forward(logit, prefix='ff_logit', activation=linear)
+        return logit
+
+    def output_probability(self, logit_hidden, candidates=None):
+        """Compute the softmax output layer.
+
+        :param candidates: If None, the full softmax over all words, ([Tt] * [BS], n_words).
+            Else the softmax over the candidate words only (int64 vector), ([Tt] * [BS], n_candidates).
+        """
+
+        if candidates is None:
+            # n_timestep * n_sample * n_words
+            logit = self.feed_forward(logit_hidden, prefix='ff_logit', activation=linear)
+        else:
+            # Take rows of W.T, which is faster than taking columns of W
+            W = self.P[_p('ff_logit', 'W')].T[candidates]
+            logit = T.dot(logit_hidden, W.T) + self.P[_p('ff_logit', 'b')][candidates]
         logit_shp = logit.shape
         probs = T.nnet.softmax(logit.reshape([logit_shp[0] * logit_shp[1],
                                               logit_shp[2]]))
 
+        return probs
+
+    def get_word_probability(self, hidden_decoder, context_decoder, tgt_embedding, **kwargs):
+        """Compute word probabilities."""
+
+        trng = kwargs.pop('trng', RandomStreams(1234))
+        use_noise = kwargs.pop('use_noise', theano.shared(np.float32(0.)))
+
+        logit = self.get_logit_hidden(hidden_decoder, context_decoder, tgt_embedding, trng, use_noise)
+        probs = self.output_probability(logit)
+
         return trng, use_noise, probs
 
+    def sample_candidates(self, y, rng=np.random):
+        """Sample the candidate words of the sampled softmax for a training batch.
+
+        The candidates are all target words in the batch and `sampled_softmax` words drawn uniformly
+        from the vocabulary, shared by all positions of the batch (Jean et al., 2015).
+        With the uniform proposal the importance weights of all candidates are equal, so they cancel in the softmax.
+
+        :return: candidates (int64 vector), indices of y in the candidates (same shape as y)
+        """
+
+        negatives = rng.randint(0, self.O['n_words'], size=self.O['sampled_softmax'])
+        candidates, indices = np.unique(np.concatenate([y.ravel(), negatives]), return_inverse=True)
+        return candidates.astype('int64'), indices[:y.size].reshape(y.shape).astype('int64')
+
     def build_cost(self, y, y_mask, probs):
-        """Build the cost from probabilities and target."""
+        """Build the cost from probabilities and target (indices of the columns of probs)."""
 
         y_flat = y.flatten()
-        y_flat_idx = T.arange(y_flat.shape[0]) * self.O['n_words'] + y_flat
+        y_flat_idx = T.arange(y_flat.shape[0]) * probs.shape[1] + y_flat
         cost = -T.log(probs.flatten()[y_flat_idx])
         cost = cost.reshape([y.shape[0], y.shape[1]])
         cost = (cost * y_mask).sum(0)
@@ -8,15 +8,22 @@ import os
 import sys
 import time
 import math
+from collections import OrderedDict
 from pprint import pprint
 
 import numpy as np
 import theano
 import theano.tensor as tensor
 
-from .constants import profile, fX, NaNReloadPrevious
-from .utility.data_iterator import TextIterator
+from .constants import profile, fX, NaNReloadPrevious, MetricsFilename
+from .utility.data_iterator import TextIterator, BinaryTextIterator, BucketIterator, load_parallel_ids
 from .utility.optimizers import Optimizers
+from .utility.prefetch import BatchPrefetcher, prepare_batches
+from .utility.batch_assembler import BatchAssembler, CachedBatches
+from .utility.function_cache import FunctionCache, cached_functions
+from .utility.checkpoint import CheckpointWriter, SnapshotRing
+from .utility.metrics import TrainingMetrics
+from .utility.profiling import ProfileWindow
 from .utility.utils import *
 
 from .utility.translate import translate_dev_get_bleu
@@ -50,44 +57,22 @@ def pred_probs(f_log_probs, prepare_data, options, iterator, verbose=True, norma
     return np.array(probs)
 
 
-def validation(iterator, f_cost, use_noise):
-    if not isinstance(iterator, list):
-        orig_noise = use_noise.get_value()
-        use_noise.set_value(0.)
-    
-        valid_cost = 0.0
-        valid_count = 0
-        for x, y in iterator:
-            x, x_mask, y, y_mask = prepare_data(x, y, maxlen=None)
-    
-            if x is None:
-                continue
-    
+def validation(batches, f_cost, use_noise):
+    """Average cost of the cached batches (see `CachedBatches`) over all references."""
+
+    orig_noise = use_noise.get_value()
+    use_noise.set_value(0.)
+
+    valid_cost = 0.0
+    valid_count = 0
+    for x, x_mask, ys in batches:
+        for y, y_mask in ys:
             valid_cost += f_cost(x, x_mask, y, y_mask) * x_mask.shape[1]
             valid_count += x_mask.shape[1]
-    
-        use_noise.set_value(orig_noise)
-    
-        return valid_cost / valid_count
-    
-    else: # zhen
-        sum_valid_cost = 0.0
-        sum_valid_count = 0
-        for i in range(0, 4):
-            valid_cost = 0.0
-            valid_count = 0
-            for x, y in iterator[i]:
-                x, x_mask, y, y_mask = prepare_data(x, y, maxlen=None)            
-                if x is None:
-                    continue
-        
-                valid_cost += f_cost(x, x_mask, y, y_mask) * x_mask.shape[1]
-                valid_count += x_mask.shape[1]
-        
-            sum_valid_cost += valid_cost
-            sum_valid_count += valid_count
-        
-        return sum_valid_cost / sum_valid_count
+
+    use_noise.set_value(orig_noise)
+
+    return valid_cost / valid_count
 
 def train(dim_word=100,  # word vector dimensionality
           dim=1000,  # the number of LSTM units
@@ -170,6 +155,30 @@ def train(dim_word=100,  # word vector dimensionality
           start_epoch = 0,
           start_from_histo_data = False,
           zhen = False,
+          binary_data = False,
+          prefetch_depth = 0,
+          prefetch_workers = 1,
+          max_tokens = -1,
+          bucket_bounds = None,
+          resident_ctx = False,
+          function_cache = None,
+          warm_cache = False,
+          shard_data = False,
+          sort_valid_batches = True,
+          accum_steps = 1,
+          async_save = False,
+          snapshot_freq = 0,
+          snapshot_size = NaNReloadPrevious,
+          snapshot_fp16 = False,
+          snapshot_max_mb = -1,
+          metrics_file = None,
+          metrics_window = 100,
+          profile_start = 10,
+          profile_steps = 0,
+          profile_memory = False,
+          fused_step = False,
+          fused_silent = False,
+          sampled_softmax = 0,
 
           ):
     model_options = locals().copy()
@@ -192,6 +201,15 @@ def train(dim_word=100,  # word vector dimensionality
         if nccl:
             nccl_comm = init_nccl_env(mpi_communicator)
 
+    # Each worker reads a disjoint shard of the training data
+    n_shards, shard_id = 1, 0
+    if shard_data:
+        if dist_type == 'mv':
+            n_shards = mv.workers_num()
+        elif dist_type == 'mpi_reduce':
+            n_shards = workers_cnt
+        shard_id = worker_id
+
     print 'Use {}, worker id: {}'.format('multiverso' if dist_type == 'mv' else 'mpi' if dist_recover_lr_iter else 'none', worker_id)
     sys.stdout.flush()
 
@@ -221,6 +239,8 @@ Start Time = {}
     ada_alpha = 0.95
     if dist_type == 'mpi_reduce':
         model_options['cost_normalization'] = workers_cnt
+    # Gradients of accum_steps micro-batches are summed into one update
+    model_options['cost_normalization'] *= accum_steps
 
     if worker_id == 0:
         message('Model options:')
@@ -234,37 +254,47 @@ Start Time = {}
 
     dataset_src, dataset_tgt = datasets[0], datasets[1]
 
-    if shuffle_data:
-        text_iterator_list = [None for _ in range(10)]
-        text_iterator = None
-    else:
+    if bucket_bounds:
+        # Bucketing iterator shuffles by itself
         text_iterator_list = None
-        text_iterator = TextIterator(
+        text_iterator = BucketIterator(
             dataset_src, dataset_tgt,
             vocab_filenames[0], vocab_filenames[1],
-            batch_size,n_words_src, n_words,maxlen, k = io_buffer_size,
+            batch_size, n_words_src, n_words, maxlen, buckets=bucket_bounds, max_tokens=max_tokens,
+            n_shards=n_shards, shard_id=shard_id,
         )
+        bucket_bounds = text_iterator.buckets.tolist()
+    elif shuffle_data:
+        text_iterator_list = [None for _ in range(10)]
+        text_iterator = None
+    else:
+        text_iterator_list = None
+        if binary_data:
+            text_iterator = BinaryTextIterator(
+                dataset_src, dataset_tgt,
+                vocab_filenames[0], vocab_filenames[1],
+                batch_size, n_words_src, n_words, maxlen, k=io_buffer_size, max_tokens=max_tokens,
+                n_shards=n_shards, shard_id=shard_id,
+            )
+        else:
+            text_iterator = TextIterator(
+                dataset_src, dataset_tgt,
+                vocab_filenames[0], vocab_filenames[1],
+                batch_size,n_words_src, n_words,maxlen, k = io_buffer_size, max_tokens=max_tokens,
+            )
 
+    # Dev set and small train set are small and fixed, so their batches are prepared once
     if not zhen:
-        valid_iterator.append(TextIterator(
-            valid_datasets[0], valid_datasets[1] if not zhen else valid_datasets[2],
-            vocab_filenames[0], vocab_filenames[1],
-            valid_batch_size, n_words_src, n_words,k = io_buffer_size,
-        ))
+        valid_references = [valid_datasets[1]]
     else:
-        valid_iterator = []
-        for i in range(4, 8): # NIST2005.reference4-7
-            valid_iterator.append(TextIterator(
-                valid_datasets[0], valid_datasets[1] if not zhen else valid_datasets[2]+'{}'.format(i),
-                vocab_filenames[0], vocab_filenames[1],
-                valid_batch_size, n_words_src, n_words,k = io_buffer_size,
-            ))
+        valid_references = [valid_datasets[2] + '{}'.format(i) for i in range(4, 8)] # NIST2005.reference4-7
+    valid_batches = CachedBatches(*load_parallel_ids(
+        valid_datasets[0], valid_references, vocab_filenames[0], vocab_filenames[1], n_words_src, n_words,
+    ), batch_size=valid_batch_size, sort_by_length=sort_valid_batches)
 
-    small_train_iterator = TextIterator(
-        small_train_datasets[0], small_train_datasets[1],
-        vocab_filenames[0], vocab_filenames[1],
-        valid_batch_size, n_words_src, n_words, k = io_buffer_size,
-    )
+    small_train_batches = CachedBatches(*load_parallel_ids(
+        small_train_datasets[0], [small_train_datasets[1]], vocab_filenames[0], vocab_filenames[1], n_words_src, n_words,
+    ), batch_size=valid_batch_size, sort_by_length=sort_valid_batches)
 
     print 'Building model'
     if trg_attention_layer_id is None:
@@ -290,65 +320,112 @@ Start Time = {}
         print_params(params)
     model.init_tparams(params)
 
-    # Build model
-    trng, use_noise, \
-        x, x_mask, y, y_mask, \
-        opt_ret, \
-        cost, test_cost, x_emb = model.build_model()
-    inps = [x, x_mask, y, y_mask]
+    uidx = search_start_uidx(reload_, preload)
+    given_imm_data = get_optimizer_imm_data(optimizer, given_imm, preload, uidx)
 
-    print 'Building sampler'
-    f_init, f_next = model.build_sampler(trng=trng, use_noise=use_noise, batch_mode=True)
+    def build_functions():
+        # Build model
+        trng, use_noise, \
+            x, x_mask, y, y_mask, \
+            opt_ret, \
+            cost, test_cost, x_emb = model.build_model()
+        inps = [x, x_mask, y, y_mask]
 
-    # before any regularizer
-    print 'Building f_log_probs...',
-    f_log_probs = theano.function(inps, cost, profile=profile)
-    print 'Done'
-    sys.stdout.flush()
-    test_cost = test_cost.mean() #FIXME: do not regularize test_cost here
+        print 'Building sampler'
+        f_init, f_next = model.build_sampler(trng=trng, use_noise=use_noise, batch_mode=True, resident_ctx=resident_ctx)
 
-    cost = cost.mean()
+        # before any regularizer
+        print 'Building f_log_probs...',
+        f_log_probs = theano.function(inps, cost, profile=profile)
+        print 'Done'
+        sys.stdout.flush()
+        test_cost = test_cost.mean() #FIXME: do not regularize test_cost here
 
-    cost = l2_regularization(cost, model.P, decay_c)
+        train_inps = inps
+        if sampled_softmax > 0:
+            # train with the sampled softmax, f_log_probs, f_cost and the sampler use the full softmax (and inps)
+            cost = opt_ret['sampled_cost']
+            train_inps = inps + opt_ret['sampled_inputs']
 
-    cost = regularize_alpha_weights(cost, alpha_c, model_options, x_mask, y_mask, opt_ret)
+        cost = cost.mean()
 
-    print 'Building f_cost...',
-    f_cost = theano.function(inps, test_cost, profile=profile)
-    print 'Done'
+        cost = l2_regularization(cost, model.P, decay_c)
 
-    if plot_graph is not None:
-        print 'Plotting post-compile graph...',
-        theano.printing.pydotprint(
-            f_cost,
-            outfile='pictures/post_compile_{}'.format(plot_graph),
-            var_with_name_simple=True,
-        )
+        cost = regularize_alpha_weights(cost, alpha_c, model_options, x_mask, y_mask, opt_ret)
+
+        print 'Building f_cost...',
+        f_cost = theano.function(inps, test_cost, profile=profile)
         print 'Done'
 
-    print 'Computing gradient...',
-    grads = tensor.grad(cost, wrt=itemlist(model.P))
+        print 'Computing gradient...',
+        grads = tensor.grad(cost, wrt=itemlist(model.P))
 
-    clip_shared = theano.shared(np.array(clip_c, dtype=fX), name='clip_shared')
+        clip_shared = theano.shared(np.array(clip_c, dtype=fX), name='clip_shared')
 
-    if dist_type != 'mpi_reduce': #build grads clip into computational graph
-        grads, g2 = clip_grad_remove_nan(grads, clip_shared, model.P)
-    else: #do the grads clip after gradients aggregation
-        g2 = None
+        if dist_type != 'mpi_reduce' and accum_steps == 1: #build grads clip into computational graph
+            grads, g2 = clip_grad_remove_nan(grads, clip_shared, model.P)
+        else: #do the grads clip after gradients aggregation (or accumulation)
+            g2 = None
 
-    # compile the optimizer, the actual computational graph is compiled here
-    lr = tensor.scalar(name='lr')
-    print 'Building optimizers...',
+        # compile the optimizer, the actual computational graph is compiled here
+        lr = tensor.scalar(name='lr')
+        print 'Building optimizers...',
 
-    uidx = search_start_uidx(reload_, preload)
-    given_imm_data = get_optimizer_imm_data(optimizer, given_imm, preload, uidx)
+        f_grad_shared = f_update = f_train = f_train_silent = None
+        if fused_step:
+            # gradients, clip and update in one function, no gradient buffers
+            f_train, f_train_silent, grads_shared, imm_shared = Optimizers[optimizer](
+                lr, model.P, grads, train_inps, cost, g2=g2, given_imm_data=given_imm_data, alpha = ada_alpha,
+                fused=True, fused_silent=fused_silent)
+        else:
+            f_grad_shared, f_update, grads_shared, imm_shared = Optimizers[optimizer](
+                lr, model.P, grads, train_inps, cost, g2=g2, given_imm_data=given_imm_data, alpha = ada_alpha,
+                accumulate=accum_steps > 1)
+        print 'Done'
 
-    f_grad_shared, f_update, grads_shared, imm_shared = Optimizers[optimizer](
-        lr, model.P, grads, inps, cost, g2=g2, given_imm_data=given_imm_data, alpha = ada_alpha)
-    print 'Done'
+        f_grads_clip = None
+        if g2 is None:
+            f_grads_clip = make_grads_clip_func(grads_shared = grads_shared, mt_tparams= model.P, clip_c_shared = clip_shared)
+
+        return {
+            'functions': OrderedDict([
+                ('f_init', f_init), ('f_next', f_next[0]), ('f_att_projected', f_next[1]),
+                ('f_log_probs', f_log_probs), ('f_cost', f_cost),
+                ('f_grad_shared', f_grad_shared), ('f_update', f_update), ('f_grads_clip', f_grads_clip),
+                ('f_train', f_train), ('f_train_silent', f_train_silent),
+            ]),
+            'trng': trng, 'use_noise': use_noise, 'clip_shared': clip_shared,
+            'grads_shared': grads_shared, 'imm_shared': imm_shared,
+        }
+
+    function_cache_ = FunctionCache(function_cache, model_options) if function_cache else None
+    cache_hit = function_cache_ is not None and not warm_cache and function_cache_.exists('train')
+    functions = cached_functions(function_cache_, 'train', model.P, build_functions, warm=warm_cache)
+    if warm_cache:
+        message('Function cache warmed')
+        return 0.
+
+    trng, use_noise, clip_shared = functions['trng'], functions['use_noise'], functions['clip_shared']
+    grads_shared, imm_shared = functions['grads_shared'], functions['imm_shared']
+    functions = functions['functions']
+    f_init, f_next = functions['f_init'], [functions['f_next'], functions.get('f_att_projected')]
+    f_log_probs, f_cost = functions['f_log_probs'], functions['f_cost']
+    f_grad_shared, f_update = functions.get('f_grad_shared'), functions.get('f_update')
+    f_grads_clip = functions.get('f_grads_clip')
+    f_train, f_train_silent = functions.get('f_train'), functions.get('f_train_silent')
+
+    # Optimizer states of cached functions are re-allocated as zeros
+    if cache_hit and given_imm_data is not None:
+        set_optimizer_imm_data(optimizer, given_imm_data, imm_shared)
 
-    if dist_type == 'mpi_reduce':
-        f_grads_clip = make_grads_clip_func(grads_shared = grads_shared, mt_tparams= model.P, clip_c_shared = clip_shared)
+    if plot_graph is not None:
+        print 'Plotting post-compile graph...',
+        theano.printing.pydotprint(
+            f_cost,
+            outfile='pictures/post_compile_{}'.format(plot_graph),
+            var_with_name_simple=True,
+        )
+        print 'Done'
 
     print 'Optimization'
     log('Preparation Done\n@Current Time = {}'.format(time.time()))
@@ -387,8 +464,8 @@ Start Time = {}
         for t_value in itemlist(model.P):
             t_value.set_value(t_value.get_value() / workers_cnt)
 
-    best_valid_cost = validation(valid_iterator, f_cost, use_noise)
-    small_train_cost = validation(small_train_iterator, f_cost, use_noise)
+    best_valid_cost = validation(valid_batches, f_cost, use_noise)
+    small_train_cost = validation(small_train_batches, f_cost, use_noise)
     best_bleu = translate_dev_get_bleu(model, f_init, f_next, trng, use_noise, zhen = zhen) if reload_ else 0
     message('Worker id {}, Initial Valid cost {:.5f} Small train cost {:.5f} Valid BLEU {:.2f}'.format(worker_id, best_valid_cost, small_train_cost, best_bleu))
 
@@ -403,62 +480,187 @@ Start Time = {}
     finetune_cnt = 0
     last_saveto_paths = []
 
-    if start_from_histo_data:
-        if uidx != 0:
-            epoch_n_batches = get_epoch_batch_cnt(dataset_src, dataset_tgt, vocab_filenames, batch_size, maxlen, n_words_src, n_words) \
+    # Write checkpoints in background, training is only blocked by the parameter snapshot
+    checkpoint_writer = CheckpointWriter() if async_save else None
+
+    # Recent parameter and optimizer snapshots in host memory, restored directly when NaN detected
+    snapshot_ring = None
+    if snapshot_freq > 0:
+        snapshot_ring = SnapshotRing(itemlist(model.P), flatten_optimizer_imm_shared(imm_shared),
+                                     size=snapshot_size, float16=snapshot_fp16, max_bytes=snapshot_max_mb * 1048576)
+        snapshot_ring.take(uidx)
+
+    # Op-level profile of updates [profile_start, profile_start + profile_steps), aggregated by model component
+    profile_window = None
+    if profile_steps > 0:
+        profile_window = ProfileWindow(OrderedDict([
+            ('f_grad_shared', (f_grad_shared, None)),
+            ('f_grads_clip', (f_grads_clip, 'optimizer')),
+            ('f_update', (f_update, 'optimizer')),
+            ('f_train', (f_train, None)),
+            ('f_train_silent', (f_train_silent, None)),
+        ]), start=profile_start, n_steps=profile_steps, name='Worker {} profile'.format(worker_id),
+            memory=profile_memory)
+        f_grad_shared, f_grads_clip, f_update, f_train, f_train_silent = [profile_window.function(k) for k in (
+            'f_grad_shared', 'f_grads_clip', 'f_update', 'f_train', 'f_train_silent')]
+
+    # Per-phase timing and throughput, emitted as JSON lines every dispFreq updates
+    metrics = TrainingMetrics(MetricsFilename.format(metrics_file, worker_id) if metrics_file else None,
+                              worker_id=worker_id, window=metrics_window, emit_freq=dispFreq)
+
+    # Exact data iterator state saved with the checkpoint, all workers must have it
+    iterator_state = load_iterator_state(preload, uidx, worker_id) if start_from_histo_data and uidx != 0 else None
+    if dist_type == 'mpi_reduce' and not all(mpi_communicator.allgather(iterator_state is not None)):
+        iterator_state = None
+
+    if iterator_state is not None:
+        start_epoch = iterator_state['epoch']
+    elif start_from_histo_data:
+        if bucket_bounds:
+            epoch_n_batches = text_iterator.n_epoch_batches
+        elif uidx != 0:
+            epoch_n_batches = get_epoch_batch_cnt(dataset_src, dataset_tgt, vocab_filenames, batch_size, maxlen, n_words_src, n_words,
+                                                  binary=binary_data, k=io_buffer_size, max_tokens=max_tokens) \
                 if worker_id == 0 else None
         else:
             epoch_n_batches = 1 #avoid heavy data IO
 
         if dist_type == 'mpi_reduce':
             epoch_n_batches = mpi_communicator.bcast(epoch_n_batches, root = 0)
+        if not bucket_bounds and n_shards > 1:
+            # Approximate, the exact position is restored from the saved iterator state
+            epoch_n_batches = max(1, epoch_n_batches // n_shards)
 
-        start_epoch = start_epoch + uidx / epoch_n_batches
-        pass_batches = uidx % epoch_n_batches
+        # Each update consumes accum_steps batches
+        start_epoch = start_epoch + uidx * accum_steps / epoch_n_batches
+        pass_batches = uidx * accum_steps % epoch_n_batches
 
     print 'worker', worker_id, 'uidx', uidx, 'l_rate', lrate, 'ada_alpha', ada_alpha, 'n_batches', epoch_n_batches, \
         'start_epoch', start_epoch, 'pass_batches', pass_batches
 
     print 'Allocating GPU memory in advance for batch data...',
-    x, x_mask, y, y_mask = get_batch_place_holder(batch_size, maxlen)
-    if dist_type != 'mpi_reduce':
-        cost, g2_value = f_grad_shared(x, x_mask, y, y_mask)
+    x, x_mask, y, y_mask = get_batch_place_holder(batch_size, maxlen, max_tokens)
+
+    # Candidate words of the sampled softmax are drawn for each batch
+    candidate_rng = np.random.RandomState(1234 + worker_id)
+    train_inputs = (x, x_mask, y, y_mask)
+    if sampled_softmax > 0:
+        train_inputs += model.sample_candidates(y, candidate_rng)
+
+    if fused_step:
+        cost, g2_value = f_train(*(train_inputs + (np.float32(.0),)))
+    else:
+        if f_grads_clip is None:
+            cost, g2_value = f_grad_shared(*train_inputs)
+        else:
+            cost = f_grad_shared(*train_inputs)
+        f_update(np.float32(.0))
+    if sampled_softmax > 0:
+        # validation functions take the batch only, check them before training
+        f_cost(x, x_mask, y, y_mask)
+        f_log_probs(x, x_mask, y, y_mask)
+
+    # Assemble train batches into reused buffers (the buffer ring is only safe with a single preparing thread)
+    if prefetch_depth <= 0:
+        n_batch_buffers = 2
+    elif prefetch_workers <= 1:
+        n_batch_buffers = prefetch_depth + 3
     else:
-        cost = f_grad_shared(x, x_mask, y, y_mask)
-    f_update(np.float32(.0))
+        n_batch_buffers = 0
+    batch_assembler = BatchAssembler(batch_size, maxlen, n_batch_buffers, bucket_bounds=bucket_bounds)
+
+    def prepare_train_batch(x, y):
+        return batch_assembler(x, y)
+
+    def prepare_train_indices(indices):
+        # Assemble from the binary corpus directly, without converting sentences to lists
+        return batch_assembler.assemble_indices(
+            text_iterator.source_ids, text_iterator.source_offsets,
+            text_iterator.target_ids, text_iterator.target_offsets, indices)
+
+    def with_iterator_state(raw_batches):
+        # Attach the iterator state after each raw batch (prefetching reads ahead of training),
+        # so the state saved with a checkpoint continues from the next batch to be trained
+        for batch in raw_batches:
+            yield batch + (text_iterator.state_dict(),)
+
+    def prepare_with_state(prepare_fn):
+        return lambda *args: prepare_fn(*args[:-1]) + (args[-1],)
+
+    # Number of batches accumulated into the current update (kept across epochs)
+    n_accum_batches = 0
 
     for eidx in xrange(start_epoch, max_epochs):
-        if shuffle_data:
+        if bucket_bounds:
+            text_iterator.reset(eidx if n_shards > 1 else eidx + worker_id)
+        elif shuffle_data:
             text_iterator = load_shuffle_text_iterator(
                 eidx, worker_id, text_iterator_list,
-                datasets, vocab_filenames, batch_size, maxlen, n_words_src, n_words, buffer_size=io_buffer_size
+                datasets, vocab_filenames, batch_size, maxlen, n_words_src, n_words, buffer_size=io_buffer_size,
+                binary=binary_data, max_tokens=max_tokens, n_shards=n_shards,
             )
         n_samples = 0
         if dist_type == 'mpi_reduce':
             mpi_communicator.Barrier()
 
-        for i, (x, y) in enumerate(text_iterator):
-            if eidx == start_epoch and i < pass_batches: #ignore the first several batches when reload
-                continue
-            n_samples += len(x)
-            uidx += 1
-            use_noise.set_value(1.)
+        if iterator_state is not None and eidx == start_epoch:
+            message('Restore data iterator state of epoch {} at iteration {}'.format(eidx, uidx))
+            text_iterator.load_state_dict(iterator_state['iterator'])
+
+        #ignore the first several batches when reload
+        skip_batches = pass_batches if eidx == start_epoch else 0
+        if skip_batches > 0:
+            # Seek to the resume batch directly, instead of reading and dropping the passed batches
+            message('Skip {} batches of epoch {}'.format(skip_batches, eidx))
+            text_iterator.skip_batches(skip_batches)
+            skip_batches = 0
+        if isinstance(text_iterator, (BinaryTextIterator, BucketIterator)):
+            raw_batches, prepare_fn = text_iterator.iter_indices(), prepare_train_indices
+        else:
+            raw_batches, prepare_fn = text_iterator, prepare_train_batch
+        raw_batches = with_iterator_state(raw_batches)
+        prepare_fn = metrics.timed('batch_prep', prepare_with_state(prepare_fn))
+        if prefetch_depth > 0:
+            batch_iterator = BatchPrefetcher(raw_batches, prepare_fn, prefetch_depth, prefetch_workers,
+                                             skip=skip_batches)
+        else:
+            batch_iterator = prepare_batches(raw_batches, prepare_fn, skip=skip_batches)
 
-            x, x_mask, y, y_mask = prepare_data(x, y, maxlen=maxlen)
+        for x, x_mask, y, y_mask, batch_iterator_state in batch_iterator:
+            metrics.batch_ready()
+            use_noise.set_value(1.)
 
             if x is None:
                 print 'Minibatch with zero sample under length ', maxlen
-                uidx -= 1
+                metrics.batch_done()
+                continue
+            n_samples += x_mask.shape[1]
+            metrics.add_batch(x_mask, y_mask)
+
+            train_inputs = (x, x_mask, y, y_mask)
+            if sampled_softmax > 0:
+                train_inputs += model.sample_candidates(y, candidate_rng)
+
+            if n_accum_batches == 0:
+                ud_start = time.time()
+                cost = 0.
+
+            # compute cost, grads (accumulated into grads_shared if accum_steps > 1)
+            if not fused_step:
+                with metrics.timing('forward_backward'):
+                    if f_grads_clip is None:
+                        cost, g2_value = f_grad_shared(*train_inputs)
+                    else:
+                        cost += f_grad_shared(*train_inputs)
+
+            n_accum_batches += 1
+            if n_accum_batches < accum_steps:
+                metrics.batch_done()
                 continue
+            n_accum_batches = 0
 
+            uidx += 1
             effective_uidx = uidx - start_uidx
-            ud_start = time.time()
-
-            # compute cost, grads
-            if dist_type != 'mpi_reduce':
-                cost, g2_value = f_grad_shared(x, x_mask, y, y_mask)
-            else:
-                cost = f_grad_shared(x, x_mask, y, y_mask)
 
             if dist_type == 'mpi_reduce':
                 reduce_start = time.time()
@@ -469,32 +671,56 @@ Start Time = {}
                 else:
                     commu_time, gpucpu_cp_time = all_reduce_params_nccl(nccl_comm, grads_shared)
                 reduce_time = time.time() - reduce_start
+                metrics.add('allreduce', reduce_time)
                 commu_time_sum += commu_time
                 reduce_time_sum += reduce_time
                 cp_time_sum += gpucpu_cp_time
 
-                g2_value = f_grads_clip()
+            if f_grads_clip is not None:
+                # clip on the norm of the aggregated (and accumulated) gradients
+                with metrics.timing('clip'):
+                    g2_value = f_grads_clip()
 
             curr_lr = lrate if not dist_type or dist_recover_lr_iter < effective_uidx \
                 else lrate * 0.05 + effective_uidx * lrate / dist_recover_lr_iter * 0.95
             if curr_lr < lrate:
                 print 'Curr lr {:.3f}'.format(curr_lr)
 
+            if fused_step:
+                # compute cost, grads and do the update in one call, the update is already applied when NaN detected.
+                # The silent step does not fetch cost and g2, so NaN is only detected at display steps.
+                with metrics.timing('forward_backward'):
+                    if f_train_silent is not None and np.mod(uidx, dispFreq) != 0:
+                        f_train_silent(*(train_inputs + (curr_lr,)))
+                    else:
+                        cost, g2_value = f_train(*(train_inputs + (curr_lr,)))
+
             if np.isnan(cost) or np.isinf(cost):
                 message('NaN detected')
                 sys.stdout.flush()
+                if checkpoint_writer is not None:
+                    checkpoint_writer.wait()
                 clip_shared.set_value(np.float32(clip_shared.get_value() * 0.8))
                 message('Discount clip value to {} at iteration {}'.format(clip_shared.get_value(), uidx))
 
-                # reload the N-th previous saved model.
+                # restore the N-th previous in-memory snapshot if exists (an older one if NaN again after restored)
+                can_reload = False
+                if snapshot_ring is not None:
+                    snapshot_uidx = snapshot_ring.restore(NaNReloadPrevious)
+                    if snapshot_uidx is not None:
+                        message('Restore in-memory snapshot of iteration {}'.format(snapshot_uidx))
+                        can_reload = True
+                    else:
+                        message('In-memory snapshots exhausted')
+
+                # else reload the N-th previous saved model.
                 reload_iter = (uidx // saveFreq - NaNReloadPrevious + 1) * saveFreq
 
                 if reload_iter < saveFreq:
                     # if not exist, reload the first saved model.
                     reload_iter = saveFreq
 
-                can_reload = False
-                while reload_iter < uidx:
+                while not can_reload and reload_iter < uidx:
                     model_save_path = '{}.iter{}.npz'.format(os.path.splitext(saveto)[0], reload_iter)
                     imm_save_path = '{}_imm.iter{}.npz'.format(os.path.splitext(saveto)[0], reload_iter)
 
@@ -514,20 +740,28 @@ Start Time = {}
                         zipp(prev_params, model.P)
                         prev_imm_data = get_optimizer_imm_data(optimizer, True, saveto, reload_iter)
                         set_optimizer_imm_data(optimizer, prev_imm_data, imm_shared)
-
-                        #begin scale the model parameters
-                        for (p, grad) in zip(itemlist(model.P), grads_shared):
-                            grad.set_value(p.get_value() * np.float32(.1))
                         break
 
                     reload_iter += saveFreq
 
-                if not can_reload:
+                if can_reload and not fused_step:
+                    #begin scale the model parameters
+                    for (p, grad) in zip(itemlist(model.P), grads_shared):
+                        grad.set_value(p.get_value() * np.float32(.1))
+                elif not can_reload:
                     message('Cannot reload any saved model. Task exited')
+                    if checkpoint_writer is not None:
+                        checkpoint_writer.close()
                     return 1., 1., 1.
 
             # do the update on parameters
-            f_update(curr_lr)
+            if not fused_step:
+                with metrics.timing('update'):
+                    f_update(curr_lr)
+
+            if snapshot_ring is not None and np.mod(uidx, snapshot_freq) == 0:
+                with metrics.timing('checkpoint'):
+                    snapshot_ring.take(uidx)
 
             ud = time.time() - ud_start
 
@@ -551,20 +785,36 @@ Start Time = {}
                 sys.stdout.flush()
 
             if np.mod(uidx, saveFreq) == 0 and worker_id == 0:
+                metrics_start = time.time()
                 # save with uidx
                 if not overwrite:
                     print 'Saving the model at iteration {}...'.format(uidx),
-                    model.save_model(saveto, history_errs, uidx)
+                    model.save_model(saveto, history_errs, uidx, writer=checkpoint_writer)
                     print 'Done'
                     sys.stdout.flush()
 
                 # save immediate data in adadelta
-                dump_optimizer_imm_data(optimizer, imm_shared, dump_imm, saveto, uidx)
+                dump_optimizer_imm_data(optimizer, imm_shared, dump_imm, saveto, uidx, writer=checkpoint_writer)
+                metrics.add('checkpoint', time.time() - metrics_start)
+
+            if np.mod(uidx, saveFreq) == 0:
+                # each worker saves its own data iterator state, along with the iteration checkpoint
+                # (only the latest state is kept if overwrite, no iteration checkpoint to resume from)
+                with metrics.timing('checkpoint'):
+                    save_iterator_state(saveto, None if overwrite else uidx, worker_id, {
+                        'epoch': eidx,
+                        'uidx': uidx,
+                        'iterator': batch_iterator_state,
+                    }, writer=checkpoint_writer)
+                if checkpoint_writer is not None:
+                    message('Worker {} {}'.format(worker_id, checkpoint_writer.stats_str()))
 
             if np.mod(uidx, validFreq) == 0:
-                valid_cost = validation(valid_iterator, f_cost, use_noise)
-                small_train_cost = validation(small_train_iterator, f_cost, use_noise)
-                valid_bleu = translate_dev_get_bleu(model, f_init, f_next, trng, use_noise)
+                with metrics.timing('validation'):
+                    valid_cost = validation(valid_batches, f_cost, use_noise)
+                    small_train_cost = validation(small_train_batches, f_cost, use_noise)
+                with metrics.timing('bleu'):
+                    valid_bleu = translate_dev_get_bleu(model, f_init, f_next, trng, use_noise)
                 message('Worker {} Valid cost {:.5f} Small train cost {:.5f} Valid BLEU {:.2f} Bad count {}'.format(worker_id, valid_cost, small_train_cost, valid_bleu, bad_counter))
                 sys.stdout.flush()
 
@@ -591,8 +841,8 @@ Start Time = {}
                         #dump the best model so far, including the immediate file
                         if worker_id == 0:
                             message('Dump the the best model so far at uidx {}'.format(uidx))
-                            model.save_model(saveto, history_errs)
-                            dump_optimizer_imm_data(optimizer, imm_shared, dump_imm, saveto)
+                            model.save_model(saveto, history_errs, writer=checkpoint_writer)
+                            dump_optimizer_imm_data(optimizer, imm_shared, dump_imm, saveto, writer=checkpoint_writer)
                     else:
                         bad_counter += 1
                         if bad_counter >= fine_tune_patience:
@@ -606,9 +856,15 @@ Start Time = {}
                             finetune_cnt += 1
                             if finetune_cnt == 3:
                                 message('Learning rate decayed to {:.5f}, clip decayed to {:.5f}, task completed'.format(lrate, clip_shared.get_value()))
+                                if checkpoint_writer is not None:
+                                    checkpoint_writer.close()
                                 return 1., 1., 1.
                             bad_counter = 0
 
+            metrics.end_update(uidx, eidx)
+            if profile_window is not None:
+                profile_window.step()
+
             # finish after this many updates
             if uidx >= finish_after:
                 print 'Finishing after {} iterations!'.format(uidx)
@@ -616,10 +872,21 @@ Start Time = {}
                 break
 
         print 'Seen {} samples in worker {}'.format(n_samples, worker_id)
+        if prefetch_depth > 0:
+            message('Worker {} Epoch {} {}'.format(worker_id, eidx, batch_iterator.stats_str()))
+        if bucket_bounds:
+            message('Worker {} Epoch {} {}'.format(worker_id, eidx, text_iterator.stats_str()))
 
         if estop:
             break
 
+    if checkpoint_writer is not None:
+        checkpoint_writer.close()
+        message('Worker {} {}'.format(worker_id, checkpoint_writer.stats_str()))
+    metrics.close()
+    if profile_window is not None:
+        profile_window.report()
+
     if best_p is not None:
         zipp(best_p, model.P)
 
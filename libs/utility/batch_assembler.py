@@ -0,0 +1,194 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Vectorized batch assembly.
+
+Fill padded (time, batch) id and mask arrays from a flat token array and offsets with numpy operations
+(no per-sentence Python loop), optionally into preallocated buffers that are reused across batches.
+"""
+
+from __future__ import print_function
+
+import bisect
+from itertools import chain
+
+import numpy as np
+
+__author__ = 'fyabc'
+
+
+def round_to_bucket(length, bucket_bounds):
+    """Round the length up to the nearest bucket bound (keep it if larger than all bounds)."""
+    if not bucket_bounds:
+        return length
+    i = bisect.bisect_left(bucket_bounds, length)
+    return bucket_bounds[i] if i < len(bucket_bounds) else length
+
+
+def flatten_seqs(seqs):
+    """Convert a list of sentences into (flat ids, starts, lengths)."""
+    lengths = np.fromiter((len(s) for s in seqs), dtype='int64', count=len(seqs))
+    flat = np.fromiter(chain.from_iterable(seqs), dtype='int64', count=int(lengths.sum()))
+    starts = np.zeros_like(lengths)
+    np.cumsum(lengths[:-1], out=starts[1:])
+    return flat, starts, lengths
+
+
+def fill_padded(flat, starts, lengths, padded_len, x=None, x_mask=None, mask_len_offset=1):
+    """Fill the padded arrays of a batch.
+
+    :param flat: flat token array (may be a memory-mapped corpus).
+    :param starts: start offsets of sentences in `flat`.
+    :param lengths: lengths of sentences.
+    :param padded_len: length of the time axis.
+    :param x: int64 output array of shape (padded_len, n_samples), allocated if None.
+    :param x_mask: float32 output array of the same shape, allocated if None.
+    :param mask_len_offset: mask covers `length + mask_len_offset` steps (1 for the eos).
+    :return: x, x_mask
+    """
+
+    n_samples = len(lengths)
+    if x is None:
+        x = np.empty((padded_len, n_samples), dtype='int64')
+    if x_mask is None:
+        x_mask = np.empty((padded_len, n_samples), dtype='float32')
+
+    steps = np.arange(padded_len)[:, None]
+    token_mask = steps < lengths[None, :]
+
+    x.fill(0)
+    # Column j of x gets flat[starts[j]:starts[j] + lengths[j]]
+    x[token_mask] = flat[(steps + starts[None, :])[token_mask]]
+    np.less(steps, lengths[None, :] + mask_len_offset, out=x_mask, casting='unsafe')
+
+    return x, x_mask
+
+
+class BatchAssembler(object):
+    """Assemble padded train batches into preallocated, reused buffers.
+
+    Buffers are used in a ring of `n_buffers`, a returned batch is valid until `n_buffers` more batches
+    are assembled, so `n_buffers` must not be less than the number of batches alive at the same time
+    (e.g. the prefetch queue depth + 2 with one prefetch worker). The ring is not thread-safe,
+    set `n_buffers` to 0 to allocate new arrays for each batch (e.g. with several prefetch workers).
+
+    Returned arrays are C-contiguous views of the buffers, and are same as the output of `prepare_data`.
+    """
+
+    def __init__(self, batch_size, maxlen, n_buffers=2, bucket_bounds=None):
+        self.batch_size = batch_size
+        self.maxlen = maxlen
+        self.n_buffers = max(0, n_buffers)
+        self.bucket_bounds = bucket_bounds
+
+        size = (maxlen + 1) * batch_size
+        self._x = [np.zeros(size, dtype='int64') for _ in xrange(self.n_buffers)]
+        self._x_mask = [np.zeros(size, dtype='float32') for _ in xrange(self.n_buffers)]
+        self._y = [np.zeros(size, dtype='int64') for _ in xrange(self.n_buffers)]
+        self._y_mask = [np.zeros(size, dtype='float32') for _ in xrange(self.n_buffers)]
+        self._next = 0
+
+    def _views(self, len_x, len_y, n_samples):
+        if self.n_buffers == 0:
+            return (np.empty((len_x, n_samples), dtype='int64'), np.empty((len_x, n_samples), dtype='float32'),
+                    np.empty((len_y, n_samples), dtype='int64'), np.empty((len_y, n_samples), dtype='float32'))
+
+        i = self._next
+        self._next = (self._next + 1) % self.n_buffers
+
+        size_x, size_y = len_x * n_samples, len_y * n_samples
+        return (self._x[i][:size_x].reshape(len_x, n_samples), self._x_mask[i][:size_x].reshape(len_x, n_samples),
+                self._y[i][:size_y].reshape(len_y, n_samples), self._y_mask[i][:size_y].reshape(len_y, n_samples))
+
+    def assemble(self, flat_x, starts_x, lengths_x, flat_y, starts_y, lengths_y):
+        """Assemble a batch from flat token arrays, sentences with length >= maxlen are removed.
+
+        :return: x, x_mask, y, y_mask (all None if the batch is empty after filtering)
+        """
+
+        keep = (lengths_x < self.maxlen) & (lengths_y < self.maxlen)
+        if not keep.all():
+            starts_x, lengths_x = starts_x[keep], lengths_x[keep]
+            starts_y, lengths_y = starts_y[keep], lengths_y[keep]
+
+        n_samples = len(lengths_x)
+        if n_samples < 1:
+            return None, None, None, None
+        if n_samples > self.batch_size:
+            raise ValueError('Batch of {} sentences is larger than the buffer size {}'.format(
+                n_samples, self.batch_size))
+
+        len_x = round_to_bucket(int(lengths_x.max()), self.bucket_bounds) + 1
+        len_y = round_to_bucket(int(lengths_y.max()), self.bucket_bounds) + 1
+        x, x_mask, y, y_mask = self._views(len_x, len_y, n_samples)
+
+        fill_padded(flat_x, starts_x, lengths_x, len_x, x, x_mask)
+        fill_padded(flat_y, starts_y, lengths_y, len_y, y, y_mask)
+
+        return x, x_mask, y, y_mask
+
+    def assemble_indices(self, source_ids, source_offsets, target_ids, target_offsets, indices):
+        """Assemble a batch of line indices of a binary corpus (see `libs.utility.corpus`)."""
+
+        indices = np.asarray(indices, dtype='int64')
+        starts_x = source_offsets[indices]
+        starts_y = target_offsets[indices]
+        return self.assemble(
+            source_ids, starts_x, source_offsets[indices + 1] - starts_x,
+            target_ids, starts_y, target_offsets[indices + 1] - starts_y,
+        )
+
+    def __call__(self, seqs_x, seqs_y):
+        """Assemble a batch of sentence lists, same interface as `prepare_data(seqs_x, seqs_y, maxlen)`."""
+
+        return self.assemble(*(flatten_seqs(seqs_x) + flatten_seqs(seqs_y)))
+
+
+class CachedBatches(object):
+    """Padded batches of a small fixed bitext (e.g. dev set or small train set), prepared once and reused.
+
+    A source can have several target references (multi-reference dev sets), the source batches are shared by them.
+    Iterating yields (x, x_mask, [(y, y_mask) of each reference]), arrays are same as `prepare_data(..., maxlen=None)`.
+    """
+
+    def __init__(self, seqs_x, seqs_y_list, batch_size, sort_by_length=True):
+        """
+        :param seqs_x: list of source sentences (word id lists).
+        :param seqs_y_list: list of target sentence lists, one for each reference.
+        :param batch_size: number of sentences in a batch.
+        :param sort_by_length: sort sentences by length before batching, for minimal padding.
+        """
+
+        n_samples = min([len(seqs_x)] + [len(seqs_y) for seqs_y in seqs_y_list])
+        flat_x, starts_x, lengths_x = flatten_seqs(seqs_x[:n_samples])
+        targets = [flatten_seqs(seqs_y[:n_samples]) for seqs_y in seqs_y_list]
+
+        if sort_by_length and targets:
+            # Sort by source length (shared by all references), then by the longest target
+            order = np.lexsort((np.max([lengths_y for _, _, lengths_y in targets], axis=0), lengths_x))
+        else:
+            order = np.arange(n_samples)
+
+        self.n_samples = n_samples
+        self.batches = []
+        for start in xrange(0, n_samples, batch_size):
+            indices = order[start:start + batch_size]
+            x, x_mask = fill_padded(flat_x, starts_x[indices], lengths_x[indices], int(lengths_x[indices].max()) + 1)
+            ys = [fill_padded(flat_y, starts_y[indices], lengths_y[indices], int(lengths_y[indices].max()) + 1)
+                  for flat_y, starts_y, lengths_y in targets]
+            self.batches.append((x, x_mask, ys))
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        return iter(self.batches)
+
+
+__all__ = [
+    'round_to_bucket',
+    'flatten_seqs',
+    'fill_padded',
+    'BatchAssembler',
+    'CachedBatches',
+]
@@ -0,0 +1,458 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Checkpoint files.
+
+Background checkpoint writing:
+    The training loop only snapshots the values to save into host arrays (`get_value` copies),
+    serializing, compressing and fsync-ing the files is done in a background thread.
+    Each file is written into a temp file and atomically renamed, so a checkpoint file is either complete or missing.
+
+Unified checkpoint container (*.ckpt), model parameters, options, optimizer and data iterator states in one file:
+    magic:          8 bytes
+    manifest_size:  uint64
+    manifest:       JSON, {"version", "meta", "entries": [{"name", "kind", "offset", "nbytes", ["dtype", "shape"]}]}
+    blobs:          raw bytes of each entry, each starts at an aligned offset (relative to the end of the manifest)
+
+    Entry names: "params/<name>", "optimizer/<index>" (the flat list of optimizer states, same order as
+    the immediate file), "options", "iterator/worker<id>".
+    Arrays are uncompressed, they are memory-mapped and only read when used (e.g. inference never reads
+    the optimizer states). Other entries are pickled objects.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import glob
+import time
+import struct
+import threading
+import cPickle as pkl
+from collections import OrderedDict, deque
+from Queue import Queue
+
+import numpy as np
+
+from ..constants import CheckpointExtension, ImmediateFilename, IteratorStateFilename
+
+__author__ = 'fyabc'
+
+# Marker to stop the writer thread.
+_End = object()
+
+_Magic = 'NMTCKPT\0'
+_Version = 1
+_Alignment = 64
+
+
+def _snapshot(value):
+    """Copy a value to save into host memory: shared variables are copied, callables are called."""
+    if hasattr(value, 'get_value'):
+        return value.get_value()
+    if callable(value):
+        return value()
+    return value
+
+
+def write_file_atomic(filename, write_fn, fsync=True):
+    """Write a file by `write_fn(f)` into a temp file, then rename it to `filename`.
+
+    :return: size of the written file in bytes.
+    """
+
+    tmp_filename = '{}.tmp{}'.format(filename, os.getpid())
+    with open(tmp_filename, 'wb') as f:
+        write_fn(f)
+        f.flush()
+        if fsync:
+            os.fsync(f.fileno())
+        size = f.tell()
+    os.rename(tmp_filename, filename)
+
+    if fsync:
+        # Make the rename durable
+        try:
+            dir_fd = os.open(os.path.dirname(os.path.abspath(filename)), os.O_RDONLY)
+        except OSError:
+            return size
+        try:
+            os.fsync(dir_fd)
+        except OSError:
+            pass
+        finally:
+            os.close(dir_fd)
+
+    return size
+
+
+class CheckpointWriter(object):
+    """Write checkpoint files in a background thread, at most `max_pending` files wait in the queue.
+
+    Timing counters:
+        blocked_time: total seconds the training loop was blocked (snapshot + waiting for a free queue slot)
+        write_time: total seconds spent writing files in the background
+    """
+
+    def __init__(self, max_pending=2, fsync=True):
+        self.fsync = fsync
+
+        self.n_files = 0
+        self.n_bytes = 0
+        self.blocked_time = 0.0
+        self.write_time = 0.0
+
+        self._queue = Queue(maxsize=max(1, max_pending))
+        self._error = None
+        self._thread = threading.Thread(target=self._worker, name='CheckpointWriter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is _End:
+                    return
+                filename, write_fn = job
+                start_time = time.time()
+                self.n_bytes += write_file_atomic(filename, write_fn, self.fsync)
+                self.write_time += time.time() - start_time
+                self.n_files += 1
+            except Exception:
+                if self._error is None:
+                    self._error = sys.exc_info()
+            finally:
+                self._queue.task_done()
+
+    def _check_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error[0], error[1], error[2]
+
+    def _submit(self, filename, write_fn, start_time):
+        self._check_error()
+        self._queue.put((filename, write_fn))
+        self.blocked_time += time.time() - start_time
+
+    def save_npz(self, filename, *args, **kwds):
+        """Same as `np.savez(filename, *args, **kwds)`, values may be shared variables or callables (snapshot now).
+
+        :param compress: keyword only, use `np.savez_compressed`, default is False.
+        """
+
+        start_time = time.time()
+        compress = kwds.pop('compress', False)
+        args = [_snapshot(v) for v in args]
+        kwds = {k: _snapshot(v) for k, v in kwds.iteritems()}
+        save_fn = np.savez_compressed if compress else np.savez
+        self._submit(filename, lambda f: save_fn(f, *args, **kwds), start_time)
+
+    def save_pickle(self, filename, obj):
+        """Pickle an object, the object is pickled in the background (it must not be modified after)."""
+        self._submit(filename, lambda f: pkl.dump(obj, f, protocol=pkl.HIGHEST_PROTOCOL), time.time())
+
+    def wait(self):
+        """Wait until all submitted files are written."""
+        start_time = time.time()
+        self._queue.join()
+        self.blocked_time += time.time() - start_time
+        self._check_error()
+
+    def close(self):
+        """Write all submitted files and stop the writer thread."""
+        if self._thread.is_alive():
+            self._queue.put(_End)
+            self._thread.join()
+        self._check_error()
+
+    def stats_str(self):
+        return 'Checkpoint: {} files, {:.1f} MB, blocked {:.3f} s, written in background {:.3f} s'.format(
+            self.n_files, self.n_bytes / 1048576.0, self.blocked_time, self.write_time)
+
+
+class SnapshotRing(object):
+    """Ring of the last `size` snapshots of shared variables (parameters and optimizer states) in host memory.
+
+    Float parameters can be stored as float16 to halve the memory (restored in their own dtype), optimizer states
+    are always kept in their own dtype (e.g. second moments are often below the float16 range).
+    Oldest snapshots are dropped when the total size exceeds `max_bytes` (if > 0), at least one is kept.
+    """
+
+    def __init__(self, params, states=(), size=3, float16=False, max_bytes=-1):
+        self.params = list(params)
+        self.states = list(states)
+        self.size = max(1, size)
+        self.float16 = float16
+        self.max_bytes = max_bytes
+
+        self.n_bytes = 0
+        self._snapshots = deque()
+        self._restored = False
+
+    def __len__(self):
+        return len(self._snapshots)
+
+    def _compress(self, value):
+        if self.float16 and value.dtype.kind == 'f' and value.ndim >= 1:
+            return value.astype('float16')
+        return value
+
+    def _drop(self, newest=False):
+        _, dropped = self._snapshots.pop() if newest else self._snapshots.popleft()
+        self.n_bytes -= sum(v.nbytes for v in dropped)
+
+    def take(self, uidx):
+        """Take a snapshot of the current values at update `uidx`."""
+        values = [self._compress(var.get_value()) for var in self.params] + \
+                 [var.get_value() for var in self.states]
+        self._snapshots.append((uidx, values))
+        self.n_bytes += sum(v.nbytes for v in values)
+        self._restored = False
+
+        while len(self._snapshots) > self.size or \
+                (self.max_bytes > 0 and self.n_bytes > self.max_bytes and len(self._snapshots) > 1):
+            self._drop()
+
+    def restore(self, n_back=1):
+        """Restore the `n_back`-th latest snapshot (the oldest one if there are fewer), newer snapshots are dropped.
+
+        If no snapshot is taken since the last restore (it failed again), the restored snapshot is dropped
+        and the previous one is restored instead, so repeated failures exhaust the ring.
+
+        :return: uidx of the restored snapshot, None if the ring is empty.
+        """
+
+        if self._restored:
+            self._drop(newest=True)
+            n_back = 1
+        if not self._snapshots:
+            return None
+
+        n_keep = max(1, len(self._snapshots) - n_back + 1)
+        while len(self._snapshots) > n_keep:
+            self._drop(newest=True)
+
+        uidx, values = self._snapshots[-1]
+        for var, value in zip(self.params + self.states, values):
+            var.set_value(value.astype(var.dtype))
+        self._restored = True
+        return uidx
+
+
+def _align(n, alignment=_Alignment):
+    return (n + alignment - 1) // alignment * alignment
+
+
+def is_checkpoint_file(filename):
+    return filename.endswith(CheckpointExtension)
+
+
+def save_checkpoint(filename, params, options=None, optimizer_data=None, iterator_states=None, meta=None,
+                    fsync=True):
+    """Save a unified checkpoint container (written into a temp file and atomically renamed).
+
+    :param params: OrderedDict of parameter name -> numpy array.
+    :param options: model options dict, or None.
+    :param optimizer_data: flat list of optimizer state arrays (see `dump_optimizer_imm_data`), or None.
+    :param iterator_states: dict of worker id -> data iterator state, or None.
+    :param meta: JSON-serializable dict (e.g. uidx, history_errs, optimizer).
+    """
+
+    entries, blobs = [], []
+    offset = 0
+
+    def add(name, kind, data, **info):
+        nbytes = len(data) if kind == 'pickle' else data.nbytes
+        entry = OrderedDict([('name', name), ('kind', kind), ('offset', offset), ('nbytes', nbytes)])
+        entry.update(info)
+        entries.append(entry)
+        blobs.append(data)
+        return _align(offset + nbytes)
+
+    for name, value in params.iteritems():
+        # np.ascontiguousarray would turn 0-d arrays (e.g. adam t_prev) into shape (1,)
+        value = np.require(value, requirements='C')
+        offset = add('params/{}'.format(name), 'array', value, dtype=value.dtype.str, shape=list(value.shape))
+    for i, value in enumerate(optimizer_data or []):
+        value = np.require(value, requirements='C')
+        offset = add('optimizer/{}'.format(i), 'array', value, dtype=value.dtype.str, shape=list(value.shape))
+    if options is not None:
+        offset = add('options', 'pickle', pkl.dumps(dict(options), pkl.HIGHEST_PROTOCOL))
+    for worker_id, state in sorted((iterator_states or {}).iteritems()):
+        offset = add('iterator/worker{}'.format(worker_id), 'pickle', pkl.dumps(state, pkl.HIGHEST_PROTOCOL))
+
+    manifest = json.dumps(OrderedDict([('version', _Version), ('meta', meta or {}), ('entries', entries)]))
+
+    def write_fn(f):
+        f.write(_Magic)
+        f.write(struct.pack('<Q', len(manifest)))
+        f.write(manifest)
+        data_start = _align(f.tell())
+        for entry, data in zip(entries, blobs):
+            f.write('\0' * (data_start + entry['offset'] - f.tell()))
+            if entry['kind'] == 'pickle':
+                f.write(data)
+            else:
+                data.tofile(f)
+
+    return write_file_atomic(filename, write_fn, fsync)
+
+
+class Checkpoint(object):
+    """Lazy reader of a checkpoint container, only the manifest is read when opened.
+
+    Can be used as the parameter archive (same as `np.load` of the *.npz model file):
+    `name in checkpoint`, `checkpoint[name]`, `keys()` and `iteritems()` access the model parameters.
+    """
+
+    def __init__(self, filename, mmap=True):
+        self.filename = filename
+
+        with open(filename, 'rb') as f:
+            if f.read(len(_Magic)) != _Magic:
+                raise ValueError('{} is not a checkpoint file'.format(filename))
+            manifest_size, = struct.unpack('<Q', f.read(8))
+            manifest = json.loads(f.read(manifest_size))
+            self._data_start = _align(f.tell())
+
+        if manifest['version'] != _Version:
+            raise ValueError('Unsupported checkpoint version {} of {}'.format(manifest['version'], filename))
+        self.meta = manifest['meta']
+        self.entries = OrderedDict((str(e['name']), e) for e in manifest['entries'])
+
+        self._data = np.memmap(filename, dtype='uint8', mode='r') if mmap else None
+
+    def _read(self, name):
+        entry = self.entries[name]
+        start = self._data_start + entry['offset']
+
+        if self._data is not None:
+            data = self._data[start:start + entry['nbytes']]
+        else:
+            with open(self.filename, 'rb') as f:
+                f.seek(start)
+                data = np.fromfile(f, dtype='uint8', count=entry['nbytes'])
+
+        if entry['kind'] == 'pickle':
+            return pkl.loads(data.tostring())
+        return data.view(np.dtype(str(entry['dtype']))).reshape(entry['shape'])
+
+    def _names(self, prefix):
+        return [name[len(prefix):] for name in self.entries if name.startswith(prefix)]
+
+    # Parameter archive interface
+
+    def keys(self):
+        return self._names('params/')
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __contains__(self, name):
+        return 'params/{}'.format(name) in self.entries
+
+    def __getitem__(self, name):
+        try:
+            return self._read('params/{}'.format(name))
+        except KeyError:
+            raise KeyError('{} is not a parameter of {}'.format(name, self.filename))
+
+    def iteritems(self):
+        for name in self.keys():
+            yield name, self[name]
+
+    def params(self, names=None):
+        """Get an OrderedDict of parameters (all if names is None), arrays are memory-mapped if possible."""
+        return OrderedDict((name, self[name]) for name in (self.keys() if names is None else names))
+
+    def options(self):
+        return self._read('options') if 'options' in self.entries else None
+
+    def optimizer_data(self):
+        """Get the flat list of optimizer states, None if not saved."""
+        n = len(self._names('optimizer/'))
+        return [self._read('optimizer/{}'.format(i)) for i in xrange(n)] if n > 0 else None
+
+    def iterator_state(self, worker_id):
+        name = 'iterator/worker{}'.format(worker_id)
+        return self._read(name) if name in self.entries else None
+
+    def close(self):
+        self._data = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def load_archive(filename, mmap=True):
+    """Load the parameter archive of a model file (*.npz or checkpoint container)."""
+    if is_checkpoint_file(filename):
+        return Checkpoint(filename, mmap=mmap)
+    return np.load(filename)
+
+
+def convert_to_checkpoint(model_filename, output=None, optimizer=True, iterator=True):
+    """Convert a checkpoint of separated files (model, options, immediate and iterator state files)
+    into a checkpoint container.
+
+    :param model_filename: the model file, e.g. "model.iter10000.npz".
+    :param output: output filename, default is the model filename with the checkpoint extension.
+    :param optimizer: include the optimizer states (immediate file), if exists.
+    :param iterator: include the data iterator states of all workers, if exist.
+    :return: output filename.
+    """
+
+    prefix = os.path.splitext(model_filename)[0]
+    if output is None:
+        output = prefix + CheckpointExtension
+
+    with np.load(model_filename) as data:
+        params = OrderedDict((k, data[k]) for k in data.files if k not in ('history_errs', 'uidx'))
+        uidx = int(data['uidx']) if 'uidx' in data.files else -1
+        history_errs = data['history_errs'].tolist() if 'history_errs' in data.files else []
+
+    options = None
+    if os.path.exists('{}.pkl'.format(model_filename)):
+        with open('{}.pkl'.format(model_filename), 'rb') as f:
+            options = pkl.load(f)
+
+    meta = OrderedDict([('uidx', uidx), ('history_errs', history_errs)])
+    if options is not None and 'optimizer' in options:
+        meta['optimizer'] = options['optimizer']
+
+    # [NOTE] model filename format: filename.iter10000.npz
+    real_prefix = os.path.splitext(prefix)[0]
+
+    optimizer_data = None
+    imm_filename = ImmediateFilename.format(real_prefix, uidx)
+    if optimizer and uidx >= 0 and os.path.exists(imm_filename):
+        with np.load(imm_filename, allow_pickle=True) as data:
+            optimizer_data = [np.asarray(value) for value in data['arr_0']]
+
+    iterator_states = None
+    if iterator and uidx >= 0:
+        iterator_states = {}
+        for filename in glob.glob(IteratorStateFilename.format(real_prefix, uidx, '*')):
+            worker_id = int(filename[filename.rindex('.worker') + len('.worker'):].split('.')[0])
+            with open(filename, 'rb') as f:
+                iterator_states[worker_id] = pkl.load(f)
+
+    save_checkpoint(output, params, options, optimizer_data, iterator_states, meta)
+    return output
+
+
+__all__ = [
+    'write_file_atomic',
+    'CheckpointWriter',
+    'SnapshotRing',
+    'is_checkpoint_file',
+    'save_checkpoint',
+    'Checkpoint',
+    'load_archive',
+    'convert_to_checkpoint',
+]
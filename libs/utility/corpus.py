@@ -0,0 +1,205 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Binary pre-indexed corpus.
+
+A text corpus is compiled once into two numpy files:
+    ids:        flat token id array of the whole corpus (UNK-clipped by `n_words`)
+    offsets:    int64 array of length n_lines + 1, line i is ids[offsets[i]:offsets[i + 1]]
+
+So the training iterators can serve batches without any tokenization or dict lookup.
+
+A text corpus can also have a length index (token count and byte offset of each line), so the batches of an epoch
+can be counted and located without reading the corpus.
+"""
+
+from __future__ import print_function
+
+import os
+import shutil
+import gzip
+
+import numpy as np
+
+from ..constants import BinaryCorpusFilename, BinaryOffsetsFilename, LengthIndexFilename, LineOffsetsFilename
+from .vocabulary import load_dictionary
+
+__author__ = 'fyabc'
+
+# Number of tokens written to disk at once when compiling.
+_WriteChunkSize = 1 << 20
+
+
+def fopen(filename, mode='r'):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode)
+    return open(filename, mode)
+
+
+def ids_dtype(n_words):
+    """The smallest dtype that can hold all (clipped) word ids."""
+    if 0 < n_words <= np.iinfo(np.uint16).max + 1:
+        return np.uint16
+    return np.int32
+
+
+def binary_corpus_filenames(filename, n_words):
+    return BinaryCorpusFilename.format(filename, n_words), BinaryOffsetsFilename.format(filename, n_words)
+
+
+def binary_corpus_exists(filename, n_words):
+    return all(os.path.exists(f) for f in binary_corpus_filenames(filename, n_words))
+
+
+def _raw_to_npy(raw_filename, npy_filename, dtype, size):
+    """Prepend a .npy header to a raw binary file (so it can be memory-mapped by `np.load`)."""
+    with open(npy_filename, 'wb') as f_out:
+        np.lib.format.write_array_header_1_0(f_out, {
+            'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+            'fortran_order': False,
+            'shape': (size,),
+        })
+        with open(raw_filename, 'rb') as f_in:
+            shutil.copyfileobj(f_in, f_out)
+
+
+def compile_corpus(filename, dictionary, n_words=-1, unk_id=1):
+    """Compile a text corpus into the binary format.
+
+    :param filename: text corpus, one sentence per line.
+    :param dictionary: word dict (or the path of the pickled word dict or vocabulary file).
+    :param n_words: vocabulary size, words with id >= n_words are mapped to UNK. -1 means not clip.
+    :return: filenames of ids and offsets.
+    """
+
+    ids_filename, offsets_filename = binary_corpus_filenames(filename, n_words)
+
+    if isinstance(dictionary, basestring):
+        dictionary = load_dictionary(dictionary)
+
+    dtype = ids_dtype(n_words)
+    # Write to temp files first, then rename them, so a crashed compile never leaves a broken corpus.
+    tmp_suffix = '.tmp{}'.format(os.getpid())
+    raw_filename = ids_filename + tmp_suffix + '.raw'
+
+    length_chunks = []
+    lengths = []
+    buf = []
+    with fopen(filename, 'r') as f_in, open(raw_filename, 'wb') as f_raw:
+        for line in f_in:
+            ss = [dictionary.get(w, unk_id) for w in line.strip().split()]
+            if n_words > 0:
+                ss = [w if w < n_words else unk_id for w in ss]
+            buf.extend(ss)
+            lengths.append(len(ss))
+
+            if len(buf) >= _WriteChunkSize:
+                np.asarray(buf, dtype=dtype).tofile(f_raw)
+                length_chunks.append(np.asarray(lengths, dtype=np.int64))
+                buf = []
+                lengths = []
+        np.asarray(buf, dtype=dtype).tofile(f_raw)
+        length_chunks.append(np.asarray(lengths, dtype=np.int64))
+
+    offsets = np.zeros(sum(len(c) for c in length_chunks) + 1, dtype=np.int64)
+    np.cumsum(np.concatenate(length_chunks), out=offsets[1:])
+
+    try:
+        _raw_to_npy(raw_filename, ids_filename + tmp_suffix, dtype, int(offsets[-1]))
+        with open(offsets_filename + tmp_suffix, 'wb') as f:
+            np.save(f, offsets)
+        os.rename(ids_filename + tmp_suffix, ids_filename)
+        os.rename(offsets_filename + tmp_suffix, offsets_filename)
+    finally:
+        os.remove(raw_filename)
+
+    return ids_filename, offsets_filename
+
+
+def load_binary_corpus(filename, n_words, dictionary=None, mmap_mode=None):
+    """Load a compiled corpus, compile it first if not exists and `dictionary` is given.
+
+    :return: ids, offsets
+    """
+
+    if not binary_corpus_exists(filename, n_words):
+        if dictionary is None:
+            raise IOError('Binary corpus of {} (n_words={}) not found'.format(filename, n_words))
+        compile_corpus(filename, dictionary, n_words)
+
+    ids_filename, offsets_filename = binary_corpus_filenames(filename, n_words)
+    return np.load(ids_filename, mmap_mode=mmap_mode), np.load(offsets_filename, mmap_mode=mmap_mode)
+
+
+def length_index_filenames(filename):
+    return LengthIndexFilename.format(filename), LineOffsetsFilename.format(filename)
+
+
+def length_index_exists(filename):
+    """Check if the length index exists and is not older than the corpus."""
+    mtime = os.path.getmtime(filename)
+    return all(os.path.exists(f) and os.path.getmtime(f) >= mtime for f in length_index_filenames(filename))
+
+
+def build_length_index(filename):
+    """Build the length index of a text corpus.
+
+    :return: filenames of lengths (int32, number of tokens of each line)
+        and line offsets (int64, n_lines + 1, byte offset of each line in the uncompressed text).
+    """
+
+    lengths_filename, line_offsets_filename = length_index_filenames(filename)
+
+    length_chunks, lengths = [], []
+    size_chunks, sizes = [], []
+    with fopen(filename, 'rb') as f_in:
+        for line in f_in:
+            lengths.append(len(line.split()))
+            sizes.append(len(line))
+
+            if len(lengths) >= _WriteChunkSize:
+                length_chunks.append(np.asarray(lengths, dtype=np.int32))
+                size_chunks.append(np.asarray(sizes, dtype=np.int64))
+                lengths, sizes = [], []
+        length_chunks.append(np.asarray(lengths, dtype=np.int32))
+        size_chunks.append(np.asarray(sizes, dtype=np.int64))
+
+    lengths = np.concatenate(length_chunks)
+    line_offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(np.concatenate(size_chunks), out=line_offsets[1:])
+
+    tmp_suffix = '.tmp{}'.format(os.getpid())
+    with open(lengths_filename + tmp_suffix, 'wb') as f:
+        np.save(f, lengths)
+    with open(line_offsets_filename + tmp_suffix, 'wb') as f:
+        np.save(f, line_offsets)
+    os.rename(lengths_filename + tmp_suffix, lengths_filename)
+    os.rename(line_offsets_filename + tmp_suffix, line_offsets_filename)
+
+    return lengths_filename, line_offsets_filename
+
+
+def load_length_index(filename, mmap_mode='r'):
+    """Load the length index of a text corpus, build it first if not exists or outdated.
+
+    :return: lengths, line_offsets
+    """
+
+    if not length_index_exists(filename):
+        build_length_index(filename)
+
+    lengths_filename, line_offsets_filename = length_index_filenames(filename)
+    return np.load(lengths_filename, mmap_mode=mmap_mode), np.load(line_offsets_filename, mmap_mode=mmap_mode)
+
+
+__all__ = [
+    'ids_dtype',
+    'binary_corpus_filenames',
+    'binary_corpus_exists',
+    'compile_corpus',
+    'load_binary_corpus',
+    'length_index_filenames',
+    'length_index_exists',
+    'build_length_index',
+    'load_length_index',
+]
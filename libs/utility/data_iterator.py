@@ -3,6 +3,9 @@ import numpy
 import cPickle as pkl
 import gzip
 
+from .corpus import load_binary_corpus, load_length_index
+from .vocabulary import load_dictionary
+
 
 def fopen(filename, mode='r'):
     if filename.endswith('.gz'):
@@ -10,6 +13,107 @@ def fopen(filename, mode='r'):
     return open(filename, mode)
 
 
+def load_parallel_ids(source, targets, source_dict, target_dict, n_words_source=-1, n_words_target=-1):
+    """Read a small parallel corpus into word id lists (same ids as `TextIterator`, without length filter).
+
+    :param targets: list of target filenames (references of the same source).
+    :return: source sentences, list of target sentences of each reference
+    """
+
+    def read(filename, dictionary, n_words):
+        with fopen(filename, 'r') as f:
+            seqs = [[dictionary.get(w, 1) for w in line.strip().split()] for line in f]
+        if n_words > 0:
+            seqs = [[w if w < n_words else 1 for w in ss] for ss in seqs]
+        return seqs
+
+    source_dict = load_dictionary(source_dict)
+    target_dict = load_dictionary(target_dict)
+    return (read(source, source_dict, n_words_source),
+            [read(target, target_dict, n_words_target) for target in targets])
+
+
+def batch_tokens(n_samples, max_len_x, max_len_y):
+    """Number of source + target tokens (including padding and eos) of a batch after `prepare_data`."""
+    return n_samples * (max_len_x + max_len_y + 2)
+
+
+def epoch_batch_plan(source_lengths, target_lengths, batch_size, maxlen, k, max_tokens=-1, order=None):
+    """Plan the batches of an epoch of `TextIterator` or `BinaryTextIterator` from sentence lengths only.
+
+    The iterators fill a buffer with the next `k` pairs not longer than `maxlen`, sort it by target length,
+    and split it into batches (a batch never spans two buffers), so the batches can be counted per buffer.
+
+    :param k: buffer size in sentences (the `k` attribute of the iterators).
+    :param order: line indices in read order, None means the file order.
+    :return: (starts, n_batches): read position of the first pair of each buffer, and number of batches of each buffer.
+    """
+
+    source_lengths = numpy.asarray(source_lengths, dtype='int64')
+    target_lengths = numpy.asarray(target_lengths, dtype='int64')
+    if order is not None:
+        source_lengths, target_lengths = source_lengths[order], target_lengths[order]
+
+    valid = numpy.flatnonzero((source_lengths <= maxlen) & (target_lengths <= maxlen))
+    starts = valid[::k]
+
+    if max_tokens <= 0:
+        sizes = numpy.full(len(starts), k, dtype='int64')
+        if len(starts) > 0:
+            sizes[-1] = len(valid) - k * (len(starts) - 1)
+        return starts, (sizes + batch_size - 1) // batch_size
+
+    n_batches = numpy.zeros(len(starts), dtype='int64')
+    sizes = numpy.arange(1, batch_size + 1, dtype='int64')
+    for i in xrange(len(starts)):
+        buffer_ = valid[i * k:(i + 1) * k]
+        len_s, len_t = source_lengths[buffer_], target_lengths[buffer_]
+        # Same sort as the iterators, batches are popped from the end of the sorted buffer
+        tidx = len_t.argsort()[::-1]
+        len_s, len_t = len_s[tidx], len_t[tidx]
+
+        # Target lengths are descending, so the max target length of a batch is the one of its first pair,
+        # and the tokens grow with the batch size: count the sizes under the budget (at least 1)
+        start = 0
+        while start < len(len_s):
+            max_len_s = numpy.maximum.accumulate(len_s[start:start + batch_size])
+            n = len(max_len_s)
+            fits = batch_tokens(sizes[:n], max_len_s, len_t[start]) <= max_tokens
+            start += max(1, int(fits.sum()))
+            n_batches[i] += 1
+
+    return starts, n_batches
+
+
+def locate_batch(starts, n_batches, batch_index):
+    """Locate a batch in the plan of `epoch_batch_plan`.
+
+    :return: (read position of its buffer, index of the batch in its buffer), (None, 0) if out of the epoch.
+    """
+
+    cum_batches = numpy.cumsum(n_batches)
+    i = int(numpy.searchsorted(cum_batches, batch_index, side='right'))
+    if i >= len(starts):
+        return None, 0
+    return int(starts[i]), batch_index - (int(cum_batches[i - 1]) if i > 0 else 0)
+
+
+def snake_shards(costs, n_shards):
+    """Deal items into `n_shards` shards of the same size with balanced costs.
+
+    Consecutive groups of `n_shards` items are sorted by cost and dealt in snake order (reversed in odd groups),
+    the last incomplete group is dropped.
+
+    :return: int64 array of shape (n_groups, n_shards), column s is the item indices of shard s in order.
+    """
+
+    n_groups = len(costs) // n_shards
+    costs = numpy.asarray(costs)[:n_groups * n_shards].reshape(n_groups, n_shards)
+    ranks = costs.argsort(axis=1, kind='mergesort')
+    ranks[1::2] = ranks[1::2, ::-1]
+    return ranks + (numpy.arange(n_groups, dtype='int64') * n_shards)[:, None]
+
+
 class TextIterator:
     """Simple Bitext iterator."""
 
@@ -19,13 +123,14 @@ class TextIterator:
                  n_words_source=-1,
                  n_words_target=-1,
                  maxlen=1000000,
-                 k = 40):
+                 k = 40,
+                 max_tokens=-1):
+        self.source_filename = source
+        self.target_filename = target
         self.source = fopen(source, 'r')
         self.target = fopen(target, 'r')
-        with open(source_dict, 'rb') as f:
-            self.source_dict = pkl.load(f)
-        with open(target_dict, 'rb') as f:
-            self.target_dict = pkl.load(f)
+        self.source_dict = load_dictionary(source_dict)
+        self.target_dict = load_dictionary(target_dict)
 
         self.batch_size = batch_size
         self.maxlen = maxlen
@@ -33,6 +138,10 @@ class TextIterator:
         self.n_words_source = n_words_source
         self.n_words_target = n_words_target
 
+        # Token budget of a batch (see `batch_tokens`), -1 means fixed `batch_size` sentences per batch.
+        # When set, `batch_size` is still the upper bound of sentences.
+        self.max_tokens = max_tokens
+
         self.source_buffer = []
         self.target_buffer = []
         self.k = batch_size * k
@@ -46,6 +155,56 @@ class TextIterator:
         self.source.seek(0)
         self.target.seek(0)
 
+    def skip_batches(self, n_batches):
+        """Skip the first `n_batches` batches of the epoch (the iterator must be at the start of the epoch).
+
+        The buffer of the resume batch is located by the length index (see `corpus.load_length_index`),
+        so only that buffer is read.
+        """
+
+        if n_batches <= 0:
+            return
+
+        source_lengths, source_line_offsets = load_length_index(self.source_filename)
+        target_lengths, target_line_offsets = load_length_index(self.target_filename)
+        n_lines = min(len(source_lengths), len(target_lengths))
+
+        pos, n_rest = locate_batch(*epoch_batch_plan(
+            source_lengths[:n_lines], target_lengths[:n_lines],
+            self.batch_size, self.maxlen, self.k, self.max_tokens), batch_index=n_batches)
+        if pos is None:
+            pos = n_lines
+
+        self.source.seek(source_line_offsets[pos])
+        self.target.seek(target_line_offsets[pos])
+        self.source_buffer = []
+        self.target_buffer = []
+        for _ in xrange(n_rest):
+            self.next()
+
+    def state_dict(self):
+        """Position in the current epoch (file offsets and buffer contents), restored by `load_state_dict`."""
+        return {
+            'source': self.source_filename,
+            'target': self.target_filename,
+            'source_offset': self.source.tell(),
+            'target_offset': self.target.tell(),
+            'source_buffer': list(self.source_buffer),
+            'target_buffer': list(self.target_buffer),
+            'end_of_data': self.end_of_data,
+        }
+
+    def load_state_dict(self, state):
+        if (state['source'], state['target']) != (self.source_filename, self.target_filename):
+            raise ValueError('Iterator state of ({}, {}) cannot be loaded into iterator of ({}, {})'.format(
+                state['source'], state['target'], self.source_filename, self.target_filename))
+
+        self.source.seek(state['source_offset'])
+        self.target.seek(state['target_offset'])
+        self.source_buffer = list(state['source_buffer'])
+        self.target_buffer = list(state['target_buffer'])
+        self.end_of_data = state['end_of_data']
+
     def _fill_buffer(self):
         """fill buffer, if it's empty"""
 
@@ -92,6 +251,7 @@ class TextIterator:
 
         source = []
         target = []
+        max_len_s, max_len_t = 0, 0
 
         self._fill_buffer()
 
@@ -107,6 +267,14 @@ class TextIterator:
                         ss = self.source_buffer.pop()
                     else:
                         break
+
+                if self.max_tokens > 0 and source:
+                    max_len_s, max_len_t = max(max_len_s, len(ss)), max(max_len_t, len(self.target_buffer[-1]))
+                    if batch_tokens(len(source) + 1, max_len_s, max_len_t) > self.max_tokens:
+                        # put it back for next batch
+                        self.source_buffer.append(ss)
+                        break
+
                 ss = [self.source_dict.get(w, 1)
                       for w in ss]
                 if self.n_words_source > 0:
@@ -124,6 +292,7 @@ class TextIterator:
 
                 source.append(ss)
                 target.append(tt)
+                max_len_s, max_len_t = max(max_len_s, len(ss)), max(max_len_t, len(tt))
 
                 if len(source) >= self.batch_size or \
                         len(target) >= self.batch_size:
@@ -137,3 +306,431 @@ class TextIterator:
             raise StopIteration
 
         return source, target
+
+
+class BinaryTextIterator:
+    """Bitext iterator over binary pre-indexed corpus (see `corpus.py`).
+
+    Serves the same batches as `TextIterator`, but without any tokenization.
+    The binary corpus will be compiled at the first time if not exists.
+
+    The corpus is memory-mapped and read in place, so the memory usage does not grow with the corpus size.
+    If `shuffle` is True, each epoch reads the sentence pairs in a random permutation (seeded by `seed` and epoch)
+    instead of the file order, so no shuffled copies of the corpus are needed.
+
+    If `n_shards` > 1 (distributed training), the read order (shared by all workers with the same seed and epoch)
+    is split into disjoint shards of the same size and balanced token counts (see `snake_shards`),
+    and this iterator only reads shard `shard_id`. With `max_tokens`, each shard stops at the smallest batch count
+    of all shards, so all workers run the same number of steps.
+    """
+
+    def __init__(self, source, target,
+                 source_dict, target_dict,
+                 batch_size=128,
+                 n_words_source=-1,
+                 n_words_target=-1,
+                 maxlen=1000000,
+                 k=40,
+                 shuffle=False,
+                 seed=1234,
+                 max_tokens=-1,
+                 n_shards=1,
+                 shard_id=0):
+        self.source_ids, self.source_offsets = load_binary_corpus(source, n_words_source, source_dict, mmap_mode='r')
+        self.target_ids, self.target_offsets = load_binary_corpus(target, n_words_target, target_dict, mmap_mode='r')
+
+        self.n_lines = min(len(self.source_offsets), len(self.target_offsets)) - 1
+
+        self.batch_size = batch_size
+        self.maxlen = maxlen
+
+        # Token budget of a batch, same as `TextIterator`
+        self.max_tokens = max_tokens
+
+        # Buffer of line indices, sorted by target length
+        self.buffer = []
+        self.k = batch_size * k
+
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        # Line indices in read order of current epoch, None means the file order
+        self.order = None
+
+        self.n_shards = n_shards
+        self.shard_id = shard_id
+        # Max number of batches of current epoch, -1 means not limited
+        self.max_batches = -1
+        self.n_read_batches = 0
+
+        # Position of next line to be read in current epoch
+        self.pos = 0
+
+        self.reset()
+
+    def __iter__(self):
+        return self
+
+    def reset(self, epoch=None):
+        """Rewind to the start of the epoch.
+
+        :param epoch: if given, switch to this epoch (and draw its permutation when shuffling).
+        """
+
+        self.pos = 0
+        self.n_read_batches = 0
+
+        if epoch is not None and epoch != self.epoch:
+            self.epoch = epoch
+            self.order = None
+        if self.order is None and (self.shuffle or self.n_shards > 1):
+            if self.shuffle:
+                self.order = numpy.random.RandomState([self.seed, self.epoch]).permutation(self.n_lines).astype('int64')
+            else:
+                self.order = numpy.arange(self.n_lines, dtype='int64')
+            if self.n_shards > 1:
+                self._shard()
+
+    def _shard(self):
+        source_lengths = self._lengths(self.source_offsets, self.order)
+        target_lengths = self._lengths(self.target_offsets, self.order)
+        valid = (source_lengths <= self.maxlen) & (target_lengths <= self.maxlen)
+
+        shards = self.order[valid][snake_shards(source_lengths[valid] + target_lengths[valid], self.n_shards)]
+        self.order = shards[:, self.shard_id].copy()
+
+        self.max_batches = -1
+        if self.max_tokens > 0:
+            lengths = (numpy.diff(self.source_offsets[:self.n_lines + 1]),
+                       numpy.diff(self.target_offsets[:self.n_lines + 1]))
+            self.max_batches = min(int(epoch_batch_plan(
+                lengths[0], lengths[1], self.batch_size, self.maxlen, self.k, self.max_tokens, order=shards[:, i])[1].sum())
+                for i in xrange(self.n_shards))
+
+    @property
+    def n_read_lines(self):
+        """Number of lines to read in an epoch (including lines longer than maxlen)."""
+        return self.n_lines if self.order is None else len(self.order)
+
+    @staticmethod
+    def _lengths(offsets, indices):
+        return offsets[indices + 1] - offsets[indices]
+
+    def skip_batches(self, n_batches):
+        """Skip the first `n_batches` batches of the epoch (the iterator must be at the start of the epoch).
+
+        Only the buffer of the resume batch is read, other positions are computed from the corpus offsets.
+        """
+
+        if n_batches <= 0:
+            return
+
+        pos, n_rest = locate_batch(*epoch_batch_plan(
+            numpy.diff(self.source_offsets[:self.n_lines + 1]), numpy.diff(self.target_offsets[:self.n_lines + 1]),
+            self.batch_size, self.maxlen, self.k, self.max_tokens, order=self.order), batch_index=n_batches)
+
+        self.pos = self.n_read_lines if pos is None else pos
+        self.buffer = []
+        self.n_read_batches = n_batches - n_rest
+        for _ in xrange(n_rest):
+            self.next_indices()
+
+    def state_dict(self):
+        """Position in the current epoch (the permutation is redrawn from seed and epoch), see `load_state_dict`."""
+        return {
+            'n_lines': self.n_lines,
+            'shuffle': self.shuffle,
+            'shard': (self.n_shards, self.shard_id),
+            'seed': self.seed,
+            'epoch': self.epoch,
+            'pos': self.pos,
+            'buffer': list(self.buffer),
+            'n_read_batches': self.n_read_batches,
+        }
+
+    def load_state_dict(self, state):
+        if (state['n_lines'], state['shuffle'], state['shard']) != \
+                (self.n_lines, self.shuffle, (self.n_shards, self.shard_id)):
+            raise ValueError('Iterator state of {} lines (shuffle={}, shard={}) cannot be loaded into iterator of '
+                             '{} lines (shuffle={}, shard={})'.format(
+                                 state['n_lines'], state['shuffle'], state['shard'],
+                                 self.n_lines, self.shuffle, (self.n_shards, self.shard_id)))
+
+        if state['seed'] != self.seed:
+            self.seed = state['seed']
+            self.order = None
+        self.reset(state['epoch'])
+        self.pos = state['pos']
+        self.buffer = list(state['buffer'])
+        self.n_read_batches = state['n_read_batches']
+
+    def _fill_buffer(self):
+        """fill buffer, if it's empty"""
+
+        if len(self.buffer) == 0:
+            indices = []
+            n_indices = 0
+            n_read_lines = self.n_read_lines
+            while n_indices < self.k and self.pos < n_read_lines:
+                end = min(n_read_lines, self.pos + self.k - n_indices)
+                if self.order is None:
+                    window = numpy.arange(self.pos, end)
+                else:
+                    window = self.order[self.pos:end]
+                self.pos = end
+
+                window = window[(self._lengths(self.source_offsets, window) <= self.maxlen) &
+                                (self._lengths(self.target_offsets, window) <= self.maxlen)]
+                indices.append(window)
+                n_indices += len(window)
+
+            if n_indices > 0:
+                indices = numpy.concatenate(indices)
+
+                # sort by target buffer
+                tidx = self._lengths(self.target_offsets, indices).argsort()
+                self.buffer = indices[tidx].tolist()
+
+        if len(self.buffer) == 0:
+            self.reset()
+            raise StopIteration
+
+    def get_pair(self, index):
+        return (self.source_ids[self.source_offsets[index]:self.source_offsets[index + 1]].tolist(),
+                self.target_ids[self.target_offsets[index]:self.target_offsets[index + 1]].tolist())
+
+    def next_indices(self):
+        """Get the line indices of next batch."""
+
+        indices = []
+
+        if 0 <= self.max_batches <= self.n_read_batches:
+            self.buffer = []
+            self.reset()
+            raise StopIteration
+        self._fill_buffer()
+        self.n_read_batches += 1
+
+        max_len_s, max_len_t = 0, 0
+        while len(indices) < self.batch_size and self.buffer:
+            index = self.buffer[-1]
+            len_s = self.source_offsets[index + 1] - self.source_offsets[index]
+            len_t = self.target_offsets[index + 1] - self.target_offsets[index]
+            if self.max_tokens > 0 and indices and \
+                    batch_tokens(len(indices) + 1, max(max_len_s, len_s), max(max_len_t, len_t)) > self.max_tokens:
+                break
+
+            indices.append(self.buffer.pop())
+            max_len_s, max_len_t = max(max_len_s, len_s), max(max_len_t, len_t)
+
+        return numpy.array(indices, dtype='int64')
+
+    def iter_indices(self):
+        """Iterate over the epoch, yield 1-tuples of batch line indices (for `BatchAssembler.assemble_indices`)."""
+        while True:
+            yield (self.next_indices(),)
+
+    def next(self):
+        source = []
+        target = []
+        for index in self.next_indices():
+            ss, tt = self.get_pair(index)
+            source.append(ss)
+            target.append(tt)
+
+        return source, target
+
+
+class BucketIterator:
+    """Length-bucketed bitext iterator over binary pre-indexed corpus.
+
+    Sentence pairs of the whole corpus are grouped into (source length, target length) buckets by `buckets`
+    bounds, each batch is taken from a single bucket and is padded to the bucket bounds
+    (by `prepare_data(..., bucket_bounds=buckets)`), so there are only a few fixed batch shapes.
+    Pairs are shuffled inside buckets and batches are shuffled across buckets in each epoch.
+    If `n_shards` > 1, the shuffled batches (same in all workers) are dealt into shards with the same number
+    of batches and balanced padded tokens, this iterator only serves shard `shard_id`.
+
+    Padding efficiency (real tokens / padded tokens) of the current epoch is counted in `n_real_tokens`
+    and `n_padded_tokens`.
+    """
+
+    def __init__(self, source, target,
+                 source_dict, target_dict,
+                 batch_size=128,
+                 n_words_source=-1,
+                 n_words_target=-1,
+                 maxlen=1000000,
+                 buckets=(10, 20, 30, 40, 50, 60, 80),
+                 seed=1234,
+                 max_tokens=-1,
+                 n_shards=1,
+                 shard_id=0):
+        self.source_ids, self.source_offsets = load_binary_corpus(source, n_words_source, source_dict, mmap_mode='r')
+        self.target_ids, self.target_offsets = load_binary_corpus(target, n_words_target, target_dict, mmap_mode='r')
+
+        n_lines = min(len(self.source_offsets), len(self.target_offsets)) - 1
+        source_lengths = numpy.diff(self.source_offsets[:n_lines + 1])
+        target_lengths = numpy.diff(self.target_offsets[:n_lines + 1])
+
+        self.batch_size = batch_size
+        self.maxlen = maxlen
+        self.max_tokens = max_tokens
+
+        # The last bound must cover maxlen
+        self.buckets = numpy.array(sorted(set(b for b in buckets if b < maxlen) | {maxlen}), dtype='int64')
+        n_buckets = len(self.buckets)
+
+        valid = (source_lengths <= maxlen) & (target_lengths <= maxlen)
+        self.indices = numpy.flatnonzero(valid)
+        self.bucket_keys = numpy.searchsorted(self.buckets, source_lengths[self.indices]) * n_buckets + \
+            numpy.searchsorted(self.buckets, target_lengths[self.indices])
+
+        self.seed = seed
+        self.n_shards = n_shards
+        self.shard_id = shard_id
+        self.epoch = None
+        self.batches = []
+        self.n_real_tokens = 0
+        self.n_padded_tokens = 0
+
+        self.reset(0)
+
+    def __iter__(self):
+        return self
+
+    def _bucket_batch_size(self, key):
+        if self.max_tokens <= 0:
+            return self.batch_size
+        n_buckets = len(self.buckets)
+        return max(1, min(self.batch_size, self.max_tokens // (
+            self.buckets[key // n_buckets] + self.buckets[key % n_buckets] + 2)))
+
+    def reset(self, epoch=None):
+        """Build the shuffled batches of the epoch.
+
+        :param epoch: if given, switch to this epoch, else rebuild batches of current epoch.
+        """
+
+        if epoch is not None:
+            self.epoch = epoch
+        rng = numpy.random.RandomState([self.seed, self.epoch])
+        n_buckets = len(self.buckets)
+
+        perm = rng.permutation(len(self.indices))
+        keys = self.bucket_keys[perm]
+        order = keys.argsort(kind='mergesort')
+        perm, keys = perm[order], keys[order]
+
+        starts = numpy.concatenate([[0], numpy.flatnonzero(numpy.diff(keys)) + 1])
+        ends = numpy.concatenate([starts[1:], [len(keys)]])
+
+        self.batches = []
+        costs = []
+        for start, end in zip(starts, ends):
+            bucket_batch_size = self._bucket_batch_size(keys[start])
+            len_s, len_t = self.buckets[keys[start] // n_buckets], self.buckets[keys[start] % n_buckets]
+            for batch_start in xrange(start, end, bucket_batch_size):
+                self.batches.append(self.indices[perm[batch_start:min(end, batch_start + bucket_batch_size)]])
+                costs.append(batch_tokens(len(self.batches[-1]), len_s, len_t))
+
+        # Shuffle at bucket granularity
+        batch_order = rng.permutation(len(self.batches))
+        if self.n_shards > 1:
+            # Deal the shuffled batches (same in all workers) into shards of balanced padded tokens
+            batch_order = batch_order[snake_shards(numpy.array(costs)[batch_order], self.n_shards)[
+                :, self.shard_id]]
+        self.batches = [self.batches[i] for i in batch_order]
+        self.batches.reverse()
+
+        self.n_real_tokens = 0
+        self.n_padded_tokens = 0
+
+    @property
+    def n_epoch_batches(self):
+        return len(self.batches)
+
+    def skip_batches(self, n_batches):
+        """Skip the first `n_batches` batches of the epoch (the iterator must be at the start of the epoch)."""
+        if self.batches is None:
+            self.reset()
+        if n_batches > 0:
+            del self.batches[max(0, len(self.batches) - n_batches):]
+
+    def state_dict(self):
+        """Position in the current epoch (batches are rebuilt from seed and epoch), see `load_state_dict`."""
+        return {
+            'n_pairs': len(self.indices),
+            'shard': (self.n_shards, self.shard_id),
+            'seed': self.seed,
+            'epoch': self.epoch,
+            'n_rest_batches': None if self.batches is None else len(self.batches),
+            'n_real_tokens': self.n_real_tokens,
+            'n_padded_tokens': self.n_padded_tokens,
+        }
+
+    def load_state_dict(self, state):
+        if (state['n_pairs'], state['shard']) != (len(self.indices), (self.n_shards, self.shard_id)):
+            raise ValueError('Iterator state of {} pairs (shard={}) cannot be loaded into iterator of {} pairs '
+                             '(shard={})'.format(state['n_pairs'], state['shard'],
+                                                 len(self.indices), (self.n_shards, self.shard_id)))
+
+        self.seed = state['seed']
+        self.reset(state['epoch'])
+        if state['n_rest_batches'] is None:
+            self.batches = None
+        else:
+            # Batches are popped from the end
+            del self.batches[state['n_rest_batches']:]
+        self.n_real_tokens = state['n_real_tokens']
+        self.n_padded_tokens = state['n_padded_tokens']
+
+    def padding_efficiency(self):
+        if self.n_padded_tokens == 0:
+            return 1.0
+        return float(self.n_real_tokens) / self.n_padded_tokens
+
+    def stats_str(self):
+        return 'Bucket padding efficiency: {:.4f} ({} real tokens / {} padded tokens)'.format(
+            self.padding_efficiency(), self.n_real_tokens, self.n_padded_tokens)
+
+    def get_pair(self, index):
+        return (self.source_ids[self.source_offsets[index]:self.source_offsets[index + 1]].tolist(),
+                self.target_ids[self.target_offsets[index]:self.target_offsets[index + 1]].tolist())
+
+    def next_indices(self):
+        """Get the line indices of next batch."""
+
+        # Batches are rebuilt lazily, so the padding stats of the finished epoch are kept until the next pass.
+        if self.batches is None:
+            self.reset()
+        if not self.batches:
+            self.batches = None
+            raise StopIteration
+
+        indices = self.batches.pop()
+
+        lengths_s = self.source_offsets[indices + 1] - self.source_offsets[indices]
+        lengths_t = self.target_offsets[indices + 1] - self.target_offsets[indices]
+        self.n_real_tokens += int(lengths_s.sum() + lengths_t.sum()) + 2 * len(indices)
+        self.n_padded_tokens += batch_tokens(
+            len(indices),
+            self.buckets[numpy.searchsorted(self.buckets, lengths_s.max())],
+            self.buckets[numpy.searchsorted(self.buckets, lengths_t.max())])
+
+        return indices
+
+    def iter_indices(self):
+        """Iterate over the epoch, yield 1-tuples of batch line indices (for `BatchAssembler.assemble_indices`)."""
+        while True:
+            yield (self.next_indices(),)
+
+    def next(self):
+        source = []
+        target = []
+        for index in self.next_indices():
+            ss, tt = self.get_pair(index)
+            source.append(ss)
+            target.append(tt)
+
+        return source, target
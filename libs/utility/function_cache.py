@@ -0,0 +1,187 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Persistent cache of compiled Theano functions.
+
+Compiled functions are pickled together (so they still share their shared variables after loading),
+keyed by a hash of the model options that affect the graphs, Theano version and device.
+
+Values of float shared variables (parameters, gradient buffers, optimizer states) are not stored:
+    model parameters are swapped into the loaded functions by `Function.copy(swap=...)`,
+    other shared variables are re-allocated as zeros with the same shapes.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import hashlib
+import cPickle as pkl
+from collections import OrderedDict
+
+import numpy as np
+import theano
+
+from .utils import message
+
+__author__ = 'fyabc'
+
+# Options that never affect the compiled graphs, they are excluded from the cache key.
+NonGraphOptions = {
+    'saveto', 'datasets', 'valid_datasets', 'small_train_datasets', 'picked_train_idxes_file', 'vocab_filenames',
+    'map_filename', 'src_vocab_map_file', 'tgt_vocab_map_file', 'given_embedding',
+    'patience', 'max_epochs', 'finish_after', 'dispFreq', 'saveFreq', 'validFreq', 'sampleFreq', 'dev_bleu_freq',
+    'lrate', 'lr_discount_freq', 'dist_recover_lr', 'dist_recover_lr_iter', 'fine_tune_patience', 'fine_tune_type',
+    'reload_', 'overwrite', 'preload', 'given_imm', 'dump_imm', 'dump_before_train', 'plot_graph', 'sort_by_len',
+    'shuffle_data', 'io_buffer_size', 'start_epoch', 'start_from_histo_data', 'binary_data', 'prefetch_depth',
+    'prefetch_workers', 'max_tokens', 'bucket_bounds', 'batch_size', 'valid_batch_size', 'maxlen',
+    'function_cache', 'warm_cache', 'shard_data', 'sort_valid_batches', 'async_save', 'sync_batch', 'sync_models',
+    'nccl', 'snapshot_freq', 'snapshot_size', 'snapshot_fp16', 'snapshot_max_mb', 'metrics_file', 'metrics_window',
+    'profile_start', 'profile_steps', 'profile_memory',
+}
+
+# Pickling compiled graphs needs deep recursion.
+_RecursionLimit = 50000
+
+
+def _is_stripped(value):
+    return np.asarray(value).dtype.kind == 'f' and np.ndim(value) >= 1
+
+
+class FunctionCache(object):
+    """Cache of compiled functions in `cache_dir`, keyed by the options and `extra` key items."""
+
+    def __init__(self, cache_dir, options, extra=None):
+        self.cache_dir = cache_dir
+
+        key_items = sorted((k, repr(v)) for k, v in options.iteritems() if k not in NonGraphOptions)
+        key_items.append(('extra', repr(extra)))
+        key_items.append(('theano', theano.__version__))
+        key_items.append(('floatX', theano.config.floatX))
+        key_items.append(('device', theano.config.device))
+        key_items.append(('profile', theano.config.profile))
+        self.key = hashlib.md5(repr(key_items)).hexdigest()
+
+    def filename(self, name):
+        return os.path.join(self.cache_dir, '{}.{}.pkl'.format(name, self.key))
+
+    def exists(self, name):
+        return os.path.exists(self.filename(name))
+
+    def save(self, name, bundle, params):
+        """Save a bundle of compiled functions.
+
+        :param bundle: dict, bundle['functions'] is a dict of compiled functions (None values are ignored),
+            other items are saved with them (e.g. shared variables used by the functions).
+        :param params: OrderedDict of model parameters (shared variables) used by the functions.
+        """
+
+        functions = OrderedDict((k, f) for k, f in bundle['functions'].iteritems() if f is not None)
+        shared_vars = set()
+        for f in functions.itervalues():
+            shared_vars.update(f.get_shared())
+
+        # Strip large values, restore them after pickling
+        stripped = []
+        for var in shared_vars:
+            value = var.get_value(borrow=True)
+            if _is_stripped(value):
+                stripped.append((var, value))
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        tmp_filename = '{}.tmp{}'.format(self.filename(name), os.getpid())
+
+        recursion_limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(recursion_limit, _RecursionLimit))
+        try:
+            for var, value in stripped:
+                var.set_value(np.zeros((0,) * value.ndim, dtype=value.dtype), borrow=True)
+
+            data = dict(bundle)
+            data['functions'] = functions
+            data['_params'] = params
+            data['_stripped'] = [(var, value.shape) for var, value in stripped]
+            with open(tmp_filename, 'wb') as f:
+                pkl.dump(data, f, protocol=pkl.HIGHEST_PROTOCOL)
+        finally:
+            for var, value in stripped:
+                var.set_value(value, borrow=True)
+            sys.setrecursionlimit(recursion_limit)
+
+        os.rename(tmp_filename, self.filename(name))
+
+    def load(self, name, params):
+        """Load a bundle of compiled functions, the functions use `params` instead of the saved parameters.
+
+        :return: the bundle (same as the saved one), or None if not cached.
+        """
+
+        if not self.exists(name):
+            return None
+
+        reoptimize = theano.config.reoptimize_unpickled_function
+        theano.config.reoptimize_unpickled_function = False
+        recursion_limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(recursion_limit, _RecursionLimit))
+        try:
+            with open(self.filename(name), 'rb') as f:
+                data = pkl.load(f)
+        finally:
+            theano.config.reoptimize_unpickled_function = reoptimize
+            sys.setrecursionlimit(recursion_limit)
+
+        saved_params = data.pop('_params')
+        if list(saved_params.iterkeys()) != list(params.iterkeys()):
+            message('Parameters of cached functions {} mismatch, ignore the cache'.format(name))
+            return None
+        swap = {saved_params[k]: params[k] for k in params}
+
+        for var, shape in data.pop('_stripped'):
+            if var not in swap:
+                var.set_value(np.zeros(shape, dtype=var.dtype))
+
+        functions = OrderedDict()
+        for k, f in data['functions'].iteritems():
+            used = set(f.get_shared())
+            functions[k] = f.copy(swap={old: new for old, new in swap.iteritems() if old in used})
+        data['functions'] = functions
+
+        return data
+
+
+def cached_functions(cache, name, params, build_fn, warm=False):
+    """Load a bundle of compiled functions from the cache, or build it (and save into the cache).
+
+    :param cache: `FunctionCache` or None (always build).
+    :param build_fn: function without arguments, return the bundle (see `FunctionCache.save`).
+    :param warm: always build and save, overwrite the cached one.
+    :return: the bundle.
+    """
+
+    start_time = time.time()
+    if cache is not None and not warm:
+        bundle = cache.load(name, params)
+        if bundle is not None:
+            message('Loaded cached functions {} from {} in {:.3f} s'.format(
+                name, cache.filename(name), time.time() - start_time))
+            return bundle
+
+    bundle = build_fn()
+    message('Compiled functions {} in {:.3f} s'.format(name, time.time() - start_time))
+
+    if cache is not None:
+        save_start_time = time.time()
+        cache.save(name, bundle, params)
+        message('Saved functions {} into {} in {:.3f} s'.format(
+            name, cache.filename(name), time.time() - save_start_time))
+
+    return bundle
+
+
+__all__ = [
+    'NonGraphOptions',
+    'FunctionCache',
+    'cached_functions',
+]
@@ -0,0 +1,162 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Per-phase training throughput metrics.
+
+The wall time of each update is split into phases (data wait, forward/backward, allreduce, ...),
+every `emit_freq` updates one JSON line is appended to the metrics file:
+    {"uidx", "epoch", "worker", "time",
+     "phases": {phase: {"mean", "p50", "p90", "p99", "max"}},    # seconds per update, over the rolling window
+     "update_time": {...},                                       # total seconds per update, same statistics
+     "src_tokens_per_sec", "tgt_tokens_per_sec", "samples_per_sec", "padding_ratio"}   # over the rolling window
+Phases which run in other threads (e.g. batch preparation of the prefetcher) are added to the current update,
+they overlap with other phases. If the filename is None, metrics are collected but not emitted.
+"""
+
+from __future__ import print_function
+
+import os
+import json
+import time
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+import numpy as np
+
+__author__ = 'fyabc'
+
+# Phases in output order, other phases are appended in the order they are first seen.
+Phases = ['data_wait', 'batch_prep', 'forward_backward', 'allreduce', 'clip', 'update',
+          'validation', 'bleu', 'checkpoint']
+
+_Percentiles = (50, 90, 99)
+
+
+class TrainingMetrics(object):
+    """Collect per-update phase times and token counts, emit JSON lines with rolling statistics."""
+
+    def __init__(self, filename, worker_id=0, window=100, emit_freq=100):
+        self.filename = filename
+        self.worker_id = worker_id
+        self.window = max(1, window)
+        self.emit_freq = max(1, emit_freq)
+
+        self.phases = list(Phases)
+        self._records = deque(maxlen=self.window)
+        self._lock = threading.Lock()
+        self._new_record()
+        self._last_time = self._update_start = time.time()
+
+        self._file = None
+        if filename is not None:
+            dirname = os.path.dirname(filename)
+            if dirname and not os.path.exists(dirname):
+                os.makedirs(dirname)
+            self._file = open(filename, 'a')
+
+    def _new_record(self):
+        self._current = {'phases': {}, 'src_tokens': 0, 'tgt_tokens': 0, 'padded_tokens': 0, 'n_samples': 0}
+
+    def add(self, phase, seconds):
+        """Add time of a phase to the current update (thread-safe)."""
+        with self._lock:
+            phases = self._current['phases']
+            phases[phase] = phases.get(phase, 0.0) + seconds
+            if phase not in self.phases:
+                self.phases.append(phase)
+
+    @contextmanager
+    def timing(self, phase):
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.add(phase, time.time() - start_time)
+
+    def timed(self, phase, fn):
+        """Wrap a function, its running time is added to the phase."""
+        def wrapped(*args, **kwargs):
+            with self.timing(phase):
+                return fn(*args, **kwargs)
+        return wrapped
+
+    def add_batch(self, x_mask, y_mask):
+        """Count tokens of a batch (several batches may be counted in one update)."""
+        with self._lock:
+            self._current['src_tokens'] += int(x_mask.sum())
+            self._current['tgt_tokens'] += int(y_mask.sum())
+            self._current['padded_tokens'] += x_mask.size + y_mask.size
+            self._current['n_samples'] += x_mask.shape[1]
+
+    def batch_ready(self):
+        """A batch is taken from the batch iterator, time since the previous batch is processed is `data_wait`."""
+        now = time.time()
+        self.add('data_wait', now - self._last_time)
+        self._last_time = now
+
+    def batch_done(self):
+        """The batch is processed (e.g. a skipped or accumulated batch), start waiting for the next batch."""
+        self._last_time = time.time()
+
+    def end_update(self, uidx, epoch):
+        """Finish the current update, emit a JSON line every `emit_freq` updates.
+
+        The update time is the wall time since the end of the previous update, including all phases.
+        """
+        now = time.time()
+        with self._lock:
+            record = self._current
+            self._new_record()
+        record['update_time'] = now - self._update_start
+        self._records.append(record)
+        self._last_time = self._update_start = now
+
+        if self._file is not None and uidx % self.emit_freq == 0:
+            self.emit(uidx, epoch)
+
+    @staticmethod
+    def _stats(values):
+        values = np.asarray(values)
+        stats = OrderedDict([('mean', float(values.mean()))])
+        for p, value in zip(_Percentiles, np.percentile(values, _Percentiles)):
+            stats['p{}'.format(p)] = float(value)
+        stats['max'] = float(values.max())
+        return stats
+
+    def summary(self, uidx, epoch):
+        records = list(self._records)
+        result = OrderedDict([('uidx', uidx), ('epoch', epoch), ('worker', self.worker_id), ('time', time.time())])
+        if not records:
+            return result
+
+        result['phases'] = OrderedDict(
+            (phase, self._stats([r['phases'].get(phase, 0.0) for r in records]))
+            for phase in self.phases if any(phase in r['phases'] for r in records))
+        result['update_time'] = self._stats([r['update_time'] for r in records])
+
+        total_time = sum(r['update_time'] for r in records) or 1e-12
+        src_tokens = sum(r['src_tokens'] for r in records)
+        tgt_tokens = sum(r['tgt_tokens'] for r in records)
+        padded_tokens = sum(r['padded_tokens'] for r in records)
+        result['src_tokens_per_sec'] = src_tokens / total_time
+        result['tgt_tokens_per_sec'] = tgt_tokens / total_time
+        result['samples_per_sec'] = sum(r['n_samples'] for r in records) / total_time
+        result['padding_ratio'] = 1.0 - float(src_tokens + tgt_tokens) / padded_tokens if padded_tokens else 0.0
+        return result
+
+    def emit(self, uidx, epoch):
+        self._file.write(json.dumps(self.summary(uidx, epoch)))
+        self._file.write('\n')
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+__all__ = [
+    'Phases',
+    'TrainingMetrics',
+]
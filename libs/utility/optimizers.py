@@ -2,10 +2,9 @@ import theano
 import theano.tensor as tensor
 import numpy
 
+from ..constants import profile
 from .utils import itemlist
 
-profile = False
-
 
 # todo: change optimizer function to optimizer class, move save/load immediate data here.
 
@@ -60,23 +59,69 @@ class AdamOptimizer(Optimizer):
         # todo
 
 
+def _grad_updates(grad_shared, grads, accumulate=False):
+    """Updates of f_grad_shared: store gradients into the shared buffers, or add them if accumulating."""
+    if accumulate:
+        return [(gs, gs + g) for gs, g in zip(grad_shared, grads)]
+    return [(gs, g) for gs, g in zip(grad_shared, grads)]
+
+
+def _reset_updates(grad_shared, accumulate=False):
+    """Updates of f_update: zero the accumulated gradients after applying them."""
+    if accumulate:
+        return [(gs, tensor.zeros_like(gs)) for gs in grad_shared]
+    return []
+
+
+def _fused_train(inp, lr, outputs, updates, silent=False):
+    """Compile the fused train step, which computes gradients and applies the updates in one call.
+
+    :return: f_train(*inp, lr) -> outputs, f_train_silent(*inp, lr) without outputs (None if not silent)
+    """
+    f_train = theano.function(inp + [lr], outputs, updates=updates,
+                              on_unused_input='ignore', profile=profile)
+    f_train_silent = None
+    if silent:
+        # No outputs to copy back, the call does not wait for the device
+        f_train_silent = theano.function(inp + [lr], [], updates=updates,
+                                         on_unused_input='ignore', profile=profile)
+    return f_train, f_train_silent
+
+
+def _pop_fused(kwargs, accumulate=False):
+    fused = kwargs.pop('fused', False)
+    silent = kwargs.pop('fused_silent', False)
+    if fused and accumulate:
+        raise ValueError('Fused train step does not support gradient accumulation')
+    return fused, silent
+
+
 # optimizers
 # name(hyperp, tparams, grads, inputs (list), cost) = f_grad_shared, f_update
+# If accumulate is True, f_grad_shared adds gradients into the shared buffers (so several micro-batches can be
+# accumulated before one f_update), and f_update zeros them.
+# If fused is True, the updates use the symbolic gradients directly (no gradient buffers), return
+# f_train, f_train_silent, None, imm_shared (see `_fused_train`).
 def adam(lr, tparams, grads, inp, cost, beta1=0.9, beta2=0.999, e=1e-8, **kwargs):
     g2 = kwargs.pop('g2', None)
     given_imm_data = kwargs.pop('given_imm_data', None)
     dump_imm = kwargs.pop('dump_imm', False)
+    accumulate = kwargs.pop('accumulate', False)
+    fused, silent = _pop_fused(kwargs, accumulate)
 
     if g2 is None:
         outputs = cost
     else:
         outputs = [cost, g2]
 
-    gshared = [theano.shared(p.get_value() * 0., name='%s_grad' % k)
-               for k, p in tparams.iteritems()]
-    gsup = [(gs, g) for gs, g in zip(gshared, grads)]
+    if fused:
+        gshared = grads
+    else:
+        gshared = [theano.shared(p.get_value() * 0., name='%s_grad' % k)
+                   for k, p in tparams.iteritems()]
+        gsup = _grad_updates(gshared, grads, accumulate)
 
-    f_grad_shared = theano.function(inp, outputs, updates=gsup, profile=profile)
+        f_grad_shared = theano.function(inp, outputs, updates=gsup, profile=profile)
 
     updates = []
 
@@ -110,6 +155,12 @@ def adam(lr, tparams, grads, inp, cost, beta1=0.9, beta2=0.999, e=1e-8, **kwargs
         updates.append((p, p_t))
     updates.append((t_prev, t))
 
+    if fused:
+        f_train, f_train_silent = _fused_train(inp, lr, outputs, updates, silent)
+        return f_train, f_train_silent, None, [t_prev, ms, vs]
+
+    updates.extend(_reset_updates(gshared, accumulate))
+
     f_update = theano.function([lr], [], updates=updates,
                                on_unused_input='ignore', profile=profile)
 
@@ -120,15 +171,20 @@ def adadelta(lr, tparams, grads, inp, cost, **kwargs):
     g2 = kwargs.pop('g2', None)
     given_imm_data = kwargs.pop('given_imm_data', None)
     alpha = kwargs.pop('alpha', 0.95)
+    accumulate = kwargs.pop('accumulate', False)
+    fused, silent = _pop_fused(kwargs, accumulate)
 
     if g2 is None:
         outputs = cost
     else:
         outputs =[cost, g2]
 
-    zipped_grads = [theano.shared(p.get_value() * numpy.float32(0.),
-                                  name='%s_grad' % k)
-                    for k, p in tparams.iteritems()]
+    if fused:
+        zipped_grads = grads
+    else:
+        zipped_grads = [theano.shared(p.get_value() * numpy.float32(0.),
+                                      name='%s_grad' % k)
+                        for k, p in tparams.iteritems()]
 
     if given_imm_data is not None:
         running_up2 = [theano.shared(value, name='%s_rup2' % k)
@@ -141,11 +197,6 @@ def adadelta(lr, tparams, grads, inp, cost, **kwargs):
         running_grads2 = [theano.shared(p.get_value() * numpy.float32(0.), name='%s_rgrad2' % k)
                           for k, p in tparams.iteritems()]
 
-    zgup = [(zg, g) for zg, g in zip(zipped_grads, grads)]
-
-    f_grad_shared = theano.function(inp, outputs, updates=zgup ,
-                                    profile=profile)
-
     rg2up = [(rg2, alpha * rg2 + (1 - alpha) * (g ** 2))
              for rg2, g in zip(running_grads2, zipped_grads)]
 
@@ -156,13 +207,28 @@ def adadelta(lr, tparams, grads, inp, cost, **kwargs):
              for ru2, ud in zip(running_up2, updir)]
     param_up = [(p, p + lr * ud) for p, ud in zip(itemlist(tparams), updir)]
 
-    f_update = theano.function([lr], [], updates=rg2up + ru2up + param_up,
+    if fused:
+        f_train, f_train_silent = _fused_train(inp, lr, outputs, rg2up + ru2up + param_up, silent)
+        return f_train, f_train_silent, None, [running_up2, running_grads2]
+
+    zgup = _grad_updates(zipped_grads, grads, accumulate)
+
+    f_grad_shared = theano.function(inp, outputs, updates=zgup ,
+                                    profile=profile)
+
+    f_update = theano.function([lr], [], updates=rg2up + ru2up + param_up + _reset_updates(zipped_grads, accumulate),
                                on_unused_input='ignore', profile=profile)
 
     return f_grad_shared, f_update, zipped_grads, [running_up2, running_grads2]
 
 def rmsprop(lr, tparams, grads, inp, cost, **kwargs):
     g2 = kwargs.pop('g2', None)
+    if kwargs.pop('accumulate', False):
+        # Running averages are updated with the gradients of each batch in f_grad_shared
+        raise ValueError('rmsprop does not support gradient accumulation')
+    if kwargs.pop('fused', False):
+        # The update direction uses the running averages updated in f_grad_shared
+        raise ValueError('rmsprop does not support the fused train step')
     if g2 is None:
         outputs = cost
     else:
@@ -202,21 +268,28 @@ def rmsprop(lr, tparams, grads, inp, cost, **kwargs):
 
 def sgd(lr, tparams, grads, inp, cost, **kwargs):
     g2 = kwargs.pop('g2', None)
+    accumulate = kwargs.pop('accumulate', False)
+    fused, silent = _pop_fused(kwargs, accumulate)
     if g2 is None:
         outputs = cost
     else:
         outputs = [cost, g2]
 
+    if fused:
+        pup = [(p, p - lr * g) for p, g in zip(itemlist(tparams), grads)]
+        f_train, f_train_silent = _fused_train(inp, lr, outputs, pup, silent)
+        return f_train, f_train_silent, None, None
+
     gshared = [theano.shared(p.get_value() * 0.,
                              name='%s_grad' % k)
                for k, p in tparams.iteritems()]
-    gsup = [(gs, g) for gs, g in zip(gshared, grads)]
+    gsup = _grad_updates(gshared, grads, accumulate)
 
     f_grad_shared = theano.function(inp, outputs, updates=gsup,
                                     profile=profile)
 
     pup = [(p, p - lr * g) for p, g in zip(itemlist(tparams), gshared)]
-    f_update = theano.function([lr], [], updates=pup, profile=profile)
+    f_update = theano.function([lr], [], updates=pup + _reset_updates(gshared, accumulate), profile=profile)
 
     return f_grad_shared, f_update, gshared, None
 
@@ -0,0 +1,163 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Background batch preparation.
+
+Read, tokenize and pad batches in worker threads while the GPU is computing,
+so the training loop only takes ready-to-feed numpy arrays from a bounded queue.
+"""
+
+from __future__ import print_function
+
+import sys
+import time
+import threading
+from Queue import Queue, Empty, Full
+
+__author__ = 'fyabc'
+
+# Markers put into the queue by the workers.
+_End = object()
+_Error = object()
+
+# Seconds to wait in a blocked queue operation before checking the stop flag.
+_PollInterval = 0.1
+
+
+def prepare_batches(iterator, prepare_fn, skip=0):
+    """Prepare batches synchronously (no prefetch), same interface as `BatchPrefetcher`."""
+    for i, batch in enumerate(iterator):
+        if i < skip:
+            continue
+        yield prepare_fn(*batch)
+
+
+class BatchPrefetcher(object):
+    """Prepare batches of an iterator in background threads, for one pass of the iterator.
+
+    Batches are yielded in the same order as the iterator, at most `depth` batches ahead.
+
+    Starvation counters (the training loop had to wait for input):
+        n_starved: number of batches that were not ready when requested
+        wait_time: total seconds spent waiting for them
+    """
+
+    def __init__(self, iterator, prepare_fn, depth=4, n_workers=1, skip=0):
+        """
+        :param iterator: the raw batch iterator (e.g. `TextIterator`), yields tuples of arguments of `prepare_fn`.
+        :param prepare_fn: function to convert a raw batch into the batch to feed.
+        :param depth: max number of prepared batches waiting in the queue.
+        :param n_workers: number of worker threads.
+        :param skip: number of raw batches to skip at the start, they are not prepared.
+        """
+
+        self.iterator = iterator
+        self.prepare_fn = prepare_fn
+        self.depth = max(1, depth)
+        self.n_workers = max(1, n_workers)
+        self.skip = skip
+
+        self.n_batches = 0
+        self.n_starved = 0
+        self.wait_time = 0.0
+
+        self._queue = Queue(maxsize=self.depth)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._exhausted = False
+        self._seq = 0
+
+    def _next_raw(self):
+        with self._lock:
+            while not self._exhausted:
+                try:
+                    batch = self.iterator.next()
+                except StopIteration:
+                    self._exhausted = True
+                    break
+
+                seq = self._seq
+                self._seq += 1
+                if seq < self.skip:
+                    continue
+                return seq, batch
+            return None
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=_PollInterval)
+                return
+            except Full:
+                pass
+
+    def _worker(self):
+        try:
+            while not self._stop.is_set():
+                item = self._next_raw()
+                if item is None:
+                    break
+                seq, batch = item
+                self._put((seq, self.prepare_fn(*batch)))
+        except Exception:
+            self._put((_Error, sys.exc_info()))
+        self._put((_End, None))
+
+    def __iter__(self):
+        threads = [threading.Thread(target=self._worker, name='BatchPrefetcher-{}'.format(i))
+                   for i in xrange(self.n_workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        pending = {}
+        next_seq = self.skip
+        starved_seq = None
+        n_ended = 0
+
+        try:
+            while True:
+                if next_seq in pending:
+                    self.n_batches += 1
+                    yield pending.pop(next_seq)
+                    next_seq += 1
+                    continue
+
+                if n_ended == self.n_workers:
+                    break
+
+                # Starved: the next batch exists but is not ready yet
+                if self._queue.empty() and not (self._exhausted and next_seq >= self._seq):
+                    if starved_seq != next_seq:
+                        self.n_starved += 1
+                        starved_seq = next_seq
+                    wait_start = time.time()
+                    seq, value = self._queue.get()
+                    self.wait_time += time.time() - wait_start
+                else:
+                    seq, value = self._queue.get()
+
+                if seq is _End:
+                    n_ended += 1
+                elif seq is _Error:
+                    raise value[0], value[1], value[2]
+                else:
+                    pending[seq] = value
+        finally:
+            # Stop the workers (also when the consumer breaks early)
+            self._stop.set()
+            while any(thread.is_alive() for thread in threads):
+                try:
+                    self._queue.get(timeout=_PollInterval)
+                except Empty:
+                    pass
+
+    def stats_str(self):
+        return 'Prefetch: {} batches, starved {} times, waited {:.3f} s'.format(
+            self.n_batches, self.n_starved, self.wait_time)
+
+
+__all__ = [
+    'prepare_batches',
+    'BatchPrefetcher',
+]
@@ -0,0 +1,234 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Op-level profiling aggregated by model component.
+
+`ProfileWindow` makes profiled copies of the compiled functions (`profiled_copy`) and calls them instead of
+the original ones only in a bounded window of steps (updates or decode steps), so other steps pay no profiling
+overhead. It takes the Theano profile counters of the window and aggregates the time and output memory
+(with `memory=True`) of each op by the model component it belongs to.
+
+Components are found from the parameter names (`_p(prefix, name, layer_id)`):
+    encoder_<i>, decoder_<i>, attention, decoder_init, logit_softmax, embedding_src, embedding_tgt, optimizer.
+Ops without parameter inputs belong to the component of their first input, scan ops with parameters of
+several components are reported as "<component1>+<component2>".
+"""
+
+from __future__ import print_function
+
+import re
+from collections import OrderedDict
+
+import numpy as np
+import theano
+
+from .utils import message
+
+__author__ = 'fyabc'
+
+_LayerParamPattern = re.compile(r'(encoder|decoder)(?:_r)?_(.+?)(?:_(\d+))?$')
+
+
+def profiled_copy(f, name, memory=False):
+    """Copy a compiled function with op-level profiling, the copy shares the shared variables (and updates) of f.
+
+    :param memory: Also record the output shapes of ops (slower, runs on the Python VM).
+    """
+
+    flags = theano.config.profile, theano.config.profile_memory
+    # The linker of the copy chooses the VM by these flags
+    theano.config.profile, theano.config.profile_memory = True, memory
+    try:
+        return f.copy(profile=name)
+    finally:
+        theano.config.profile, theano.config.profile_memory = flags
+
+
+def param_component(name):
+    """Get the model component of a parameter (or optimizer shared variable) name, None if unknown."""
+    if not name:
+        return None
+    if name.endswith('_grad'):
+        return 'optimizer'
+    if name == 'Wemb':
+        return 'embedding_src'
+    if name == 'Wemb_dec':
+        return 'embedding_tgt'
+    if name.startswith('ff_logit'):
+        return 'logit_softmax'
+    if name.startswith('ff_state'):
+        return 'decoder_init'
+
+    m = _LayerParamPattern.match(name)
+    if m is None:
+        return None
+    prefix, param_name, layer_id = m.groups()
+    if prefix == 'decoder' and ('att' in param_name or param_name == 'c_tt'):
+        return 'attention'
+    return '{}_{}'.format(prefix, layer_id or 0)
+
+
+def node_components(fgraph, default=None):
+    """Map each apply node of the function graph to its component."""
+
+    var_components = {}
+    for var in fgraph.inputs:
+        component = param_component(var.name)
+        if component is not None:
+            var_components[var] = component
+
+    components = {}
+    for node in fgraph.toposort():
+        if default is not None:
+            component = default
+        else:
+            own = sorted(set(var_components[v] for v in node.inputs if v.owner is None and v in var_components))
+            if own:
+                component = '+'.join(own)
+            else:
+                component = next((var_components[v] for v in node.inputs if v in var_components), 'other')
+        components[node] = component
+        for var in node.outputs:
+            var_components[var] = component
+
+    return components
+
+
+def _node_of(key):
+    # Theano >= 1.0 keys the profile counters by (fgraph, node)
+    return key[1] if isinstance(key, tuple) else key
+
+
+def _output_bytes(profile, node):
+    # Output shapes of the last call, only recorded with `theano.config.profile_memory`
+    total = 0
+    for var in node.outputs:
+        shape = profile.variable_shape.get(var)
+        if shape is not None and hasattr(var.type, 'dtype'):
+            total += int(np.prod(shape)) * np.dtype(var.type.dtype).itemsize
+    return total
+
+
+class ProfileWindow(object):
+    """Profile steps [start, start + n_steps) of the given functions, report time and memory by component.
+
+    Call the functions returned by `function(name)`, they call the profiled copies within the window.
+    Call `step()` once per step (e.g. after each update), or wrap the function called once per step by `wrap`.
+    """
+
+    def __init__(self, functions, start=10, n_steps=100, name='Profile', memory=False):
+        """
+        :param functions: OrderedDict of name -> (compiled function, default component or None).
+            If the default component is given, all ops of the function belong to it (e.g. "optimizer").
+        :param memory: Record output memory of ops (see `profiled_copy`).
+        """
+
+        self.originals = OrderedDict()
+        self.functions = OrderedDict()
+        for k, (f, default) in functions.iteritems():
+            if f is None:
+                continue
+            self.originals[k] = f
+            self.functions[k] = (profiled_copy(f, '{} {}'.format(name, k), memory), default)
+        self.start = start
+        self.n_steps = n_steps
+        self.name = name
+
+        self.n_done = 0
+        self.finished = False
+        self._begin = None
+
+        self._components = {k: node_components(f.maker.fgraph, default)
+                            for k, (f, default) in self.functions.iteritems()}
+        if self.start <= 0:
+            self._begin = self._counters()
+
+    def _counters(self):
+        counters = {}
+        for k, (f, _) in self.functions.iteritems():
+            profile = f.profile
+            counters[k] = (
+                {_node_of(key): value for key, value in profile.apply_time.iteritems()},
+                {_node_of(key): value for key, value in profile.apply_callcount.iteritems()},
+                profile.fct_call_time, profile.fct_callcount,
+            )
+        return counters
+
+    @property
+    def active(self):
+        """The current step is in the window."""
+        return not self.finished and self.start <= self.n_done < self.start + self.n_steps
+
+    def function(self, k):
+        """Get the function `k`, which calls the profiled copy in the window (None if `k` is not given)."""
+        if k not in self.functions:
+            return None
+        f, profiled = self.originals[k], self.functions[k][0]
+
+        def dispatched(*args, **kwargs):
+            return (profiled if self.active else f)(*args, **kwargs)
+        return dispatched
+
+    def step(self):
+        """Mark the end of a step."""
+        if self.finished:
+            return
+        self.n_done += 1
+        if self.n_done == self.start:
+            self._begin = self._counters()
+        elif self.n_done == self.start + self.n_steps:
+            self.report()
+
+    def wrap(self, f):
+        """Wrap a function called once per step."""
+        def wrapped(*args, **kwargs):
+            ret = f(*args, **kwargs)
+            self.step()
+            return ret
+        return wrapped
+
+    def summary(self):
+        """Get an OrderedDict of component -> {time, calls, output_bytes}, sorted by time."""
+        end = self._counters()
+        result = {}
+        for k, (f, _) in self.functions.iteritems():
+            begin_time, begin_calls, _, _ = self._begin[k]
+            end_time, end_calls, _, _ = end[k]
+            components = self._components[k]
+            for node, t in end_time.iteritems():
+                component = components.get(node, 'other')
+                stats = result.setdefault(component, {'time': 0.0, 'calls': 0, 'output_bytes': 0})
+                stats['time'] += t - begin_time.get(node, 0.0)
+                stats['calls'] += end_calls.get(node, 0) - begin_calls.get(node, 0)
+                stats['output_bytes'] += _output_bytes(f.profile, node)
+
+        return OrderedDict(sorted(result.iteritems(), key=lambda item: -item[1]['time']))
+
+    def report(self):
+        """Print the summary of the window (can be called before the window is finished)."""
+        if self.finished or self._begin is None:
+            return
+        self.finished = True
+
+        summary = self.summary()
+        n_steps = self.n_done - max(0, self.start)
+        total_time = sum(stats['time'] for stats in summary.itervalues()) or 1e-12
+        function_times = ', '.join('{} {:.3f} s'.format(k, end[2] - self._begin[k][2])
+                                   for k, end in self._counters().iteritems())
+
+        message('{}: {} steps from step {}, op time {:.3f} s ({})'.format(
+            self.name, n_steps, self.start, total_time, function_times))
+        message('{:<28}{:>12}{:>9}{:>14}{:>12}{:>14}'.format(
+            'Component', 'Time (s)', '%', 'Time/step (ms)', 'Op calls', 'Output (MB)'))
+        for component, stats in summary.iteritems():
+            message('{:<28}{:>12.3f}{:>9.2f}{:>14.3f}{:>12}{:>14.2f}'.format(
+                component, stats['time'], 100.0 * stats['time'] / total_time,
+                1000.0 * stats['time'] / max(1, n_steps), stats['calls'], stats['output_bytes'] / 1048576.0))
+
+
+__all__ = [
+    'profiled_copy',
+    'param_component',
+    'node_components',
+    'ProfileWindow',
+]
@@ -0,0 +1,195 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Dynamic request batching for online translation.
+
+Requests are queued and grouped into batches: a batch is sent to the translate function when it is full,
+or when its oldest request has waited for `max_latency` seconds.
+"""
+
+from __future__ import print_function
+
+import sys
+import time
+import threading
+from collections import deque
+from Queue import Queue, Empty
+
+import numpy as np
+
+__author__ = 'fyabc'
+
+
+class Request(object):
+    """A pending translation request, `wait()` blocks until it is translated."""
+
+    def __init__(self, source):
+        self.source = source
+        self.result = None
+        self.error = None
+        self.start_time = time.time()
+        self.end_time = None
+        self._done = threading.Event()
+
+    @property
+    def latency(self):
+        return None if self.end_time is None else self.end_time - self.start_time
+
+    def finish(self, result=None, error=None):
+        self.result, self.error = result, error
+        self.end_time = time.time()
+        self._done.set()
+
+    def wait(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise RuntimeError('Request not finished in {} s'.format(timeout))
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class ServingStats(object):
+    """Latency percentiles (over the last `window` requests) and throughput since start."""
+
+    def __init__(self, window=10000):
+        self.latencies = deque(maxlen=window)
+        self.start_time = time.time()
+        self.n_requests = 0
+        self.n_batches = 0
+        self.n_errors = 0
+        self._lock = threading.Lock()
+
+    def add_batch(self, requests):
+        with self._lock:
+            self.n_batches += 1
+            for request in requests:
+                self.n_requests += 1
+                if request.error is not None:
+                    self.n_errors += 1
+                if request.latency is not None:
+                    self.latencies.append(request.latency)
+
+    def summary(self):
+        with self._lock:
+            elapsed = time.time() - self.start_time
+            latencies = np.array(self.latencies) if self.latencies else np.zeros(1)
+            return {
+                'requests': self.n_requests,
+                'batches': self.n_batches,
+                'errors': self.n_errors,
+                'avg_batch_size': float(self.n_requests) / max(1, self.n_batches),
+                'p50_latency': float(np.percentile(latencies, 50)),
+                'p99_latency': float(np.percentile(latencies, 99)),
+                'throughput': self.n_requests / elapsed if elapsed > 0 else 0.0,
+            }
+
+    def summary_str(self):
+        return 'Requests {requests}, batches {batches} (avg size {avg_batch_size:.2f}), errors {errors}, ' \
+               'latency p50 {p50_latency:.3f} s p99 {p99_latency:.3f} s, throughput {throughput:.2f} sent/s' \
+            .format(**self.summary())
+
+
+class DynamicBatcher(object):
+    """Group queued requests into batches in a background thread.
+
+    `translate_fn` takes a list of sources and returns a list of results, it is only called in the batching
+    thread (so Theano functions are never called concurrently).
+    """
+
+    def __init__(self, translate_fn, max_batch_size=32, max_latency=0.05, stats=None):
+        """
+        :param translate_fn: function to translate a batch of sources.
+        :param max_batch_size: max number of requests in a batch.
+        :param max_latency: max seconds the oldest request of a batch waits for more requests.
+        :param stats: `ServingStats` to record into, create a new one if None.
+        """
+
+        self.translate_fn = translate_fn
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_latency = max_latency
+        self.stats = ServingStats() if stats is None else stats
+
+        self._queue = Queue()
+        self._stop = threading.Event()
+        # Guards queueing against closing, so no request is queued after the queue is drained
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='DynamicBatcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, source):
+        """Queue a source, return the `Request`."""
+        request = Request(source)
+        with self._lock:
+            if self._stop.is_set():
+                raise RuntimeError('DynamicBatcher is closed')
+            self._queue.put(request)
+        return request
+
+    def translate(self, source, timeout=None):
+        """Translate a source synchronously."""
+        return self.submit(source).wait(timeout)
+
+    def close(self):
+        """Stop the batching thread, requests not translated yet fail."""
+        with self._lock:
+            self._stop.set()
+        self._thread.join()
+
+        pending = []
+        while True:
+            try:
+                pending.append(self._queue.get_nowait())
+            except Empty:
+                break
+        for request in pending:
+            request.finish(error=RuntimeError('DynamicBatcher is closed'))
+
+    def _translate(self, sources):
+        results = self.translate_fn(sources)
+        if len(results) != len(sources):
+            raise ValueError('Got {} results of {} sources'.format(len(results), len(sources)))
+        return results
+
+    def _next_batch(self):
+        try:
+            batch = [self._queue.get(timeout=0.1)]
+        except Empty:
+            return []
+
+        deadline = batch[0].start_time + self.max_latency
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.time()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not self._stop.is_set():
+            batch = self._next_batch()
+            if not batch:
+                continue
+
+            try:
+                results = self._translate([request.source for request in batch])
+                for request, result in zip(batch, results):
+                    request.finish(result)
+            except Exception as e:
+                print('Error when translating a batch: {}'.format(e), file=sys.stderr)
+                # Translate one by one, so only the bad requests fail
+                for request in batch:
+                    try:
+                        request.finish(self._translate([request.source])[0])
+                    except Exception as e:
+                        request.finish(error=e)
+
+            self.stats.add_batch(batch)
+
+
+__all__ = [
+    'Request',
+    'ServingStats',
+    'DynamicBatcher',
+]
@@ -11,6 +11,7 @@ import subprocess
 from collections import defaultdict
 
 from .utils import prepare_data_x
+from .vocabulary import load_dictionary, invert_dictionary
 
 __author__ = 'fyabc'
 
@@ -97,9 +98,8 @@ def load_translate_data(dictionary, dictionary_target, source_file, batch_mode=F
     # load source dictionary and invert
     if echo:
         print('Load and invert source dictionary...', end='')
-    with open(dictionary, 'rb') as f:
-        word_dict = pkl.load(f)
-    word_idict = {v: k for k, v in word_dict.iteritems()}
+    word_dict = load_dictionary(dictionary)
+    word_idict = invert_dictionary(word_dict)
     word_idict[0] = '<eos>'
     word_idict[unk_id] = 'UNK'
     if echo:
@@ -108,9 +108,8 @@ def load_translate_data(dictionary, dictionary_target, source_file, batch_mode=F
     # load target dictionary and invert
     if echo:
         print('Load and invert target dictionary...', end='')
-    with open(dictionary_target, 'rb') as f:
-        word_dict_trg = pkl.load(f)
-    word_idict_trg = {v: k for k, v in word_dict_trg.iteritems()}
+    word_dict_trg = load_dictionary(dictionary_target)
+    word_idict_trg = invert_dictionary(word_dict_trg)
     word_idict_trg[0] = '<eos>'
     word_idict_trg[unk_id] = 'UNK'
     if echo:
@@ -20,7 +20,10 @@ import theano.tensor as tensor
 import numpy as np
 
 from ..constants import *
-from .data_iterator import TextIterator
+from .data_iterator import TextIterator, BinaryTextIterator, epoch_batch_plan
+from .corpus import load_binary_corpus, load_length_index
+from .batch_assembler import round_to_bucket, flatten_seqs, fill_padded
+from .checkpoint import is_checkpoint_file, Checkpoint, load_archive
 from libs.config import DefaultOptions
 
 _fp_log = None
@@ -98,15 +101,23 @@ def _p(*args, **kwargs):
 
     return '_'.join(str(arg) for arg in args)
 
+def load_model_options(model_name):
+    """Load the saved options of a model file (from "<model_name>.pkl", or the checkpoint container)."""
+    if is_checkpoint_file(model_name):
+        return Checkpoint(model_name).options()
+
+    with open('%s.pkl' % model_name, 'rb') as f:
+        return pkl.load(f)
+
+
 def load_options_test(model_name):
     # load model model_options
-    with open('%s.pkl' % model_name, 'rb') as f:
-        options = DefaultOptions.copy()
-        options.update(pkl.load(f))
-        if 'fix_dp_bug' not in options:
-            options['fix_dp_bug'] = False
-        print('Options:')
-        pprint(options)
+    options = DefaultOptions.copy()
+    options.update(load_model_options(model_name))
+    if 'fix_dp_bug' not in options:
+        options['fix_dp_bug'] = False
+    print('Options:')
+    pprint(options)
 
     return options
 
@@ -219,7 +230,7 @@ def load_params(path, params, src_map_file = None, tgt_map_file = None):
     :param params: New parameters to be updated.
     """
 
-    old_params = np.load(path)
+    old_params = load_archive(path)
     for key, value in params.iteritems():
         if key not in old_params:
             warnings.warn('{} is not in the archive'.format(key))
@@ -441,93 +452,62 @@ def regularize_alpha_weights(cost, alpha_c, model_options, x_mask, y_mask, opt_r
 
 
 # batch preparation
-def prepare_data(seqs_x, seqs_y, maxlen=None):
+def prepare_data(seqs_x, seqs_y, maxlen=None, bucket_bounds=None):
     # x: a list of sentences
-    lengths_x = [len(s) for s in seqs_x]
-    lengths_y = [len(s) for s in seqs_y]
+    # bucket_bounds: sorted bucket bounds, pad to the bucket bound instead of the max length of the batch
+    flat_x, starts_x, lengths_x = flatten_seqs(seqs_x)
+    flat_y, starts_y, lengths_y = flatten_seqs(seqs_y)
 
     if maxlen is not None:
-        new_seqs_x = []
-        new_seqs_y = []
-        new_lengths_x = []
-        new_lengths_y = []
-        for l_x, s_x, l_y, s_y in zip(lengths_x, seqs_x, lengths_y, seqs_y):
-            if l_x < maxlen and l_y < maxlen:
-                new_seqs_x.append(s_x)
-                new_lengths_x.append(l_x)
-                new_seqs_y.append(s_y)
-                new_lengths_y.append(l_y)
-        lengths_x = new_lengths_x
-        seqs_x = new_seqs_x
-        lengths_y = new_lengths_y
-        seqs_y = new_seqs_y
+        keep = (lengths_x < maxlen) & (lengths_y < maxlen)
+        starts_x, lengths_x = starts_x[keep], lengths_x[keep]
+        starts_y, lengths_y = starts_y[keep], lengths_y[keep]
 
         if len(lengths_x) < 1 or len(lengths_y) < 1:
             return None, None, None, None
 
-    n_samples = len(seqs_x)
-    maxlen_x = np.max(lengths_x) + 1
-    maxlen_y = np.max(lengths_y) + 1
+    maxlen_x = round_to_bucket(int(np.max(lengths_x)), bucket_bounds) + 1
+    maxlen_y = round_to_bucket(int(np.max(lengths_y)), bucket_bounds) + 1
 
-    x = np.zeros((maxlen_x, n_samples)).astype('int64')
-    y = np.zeros((maxlen_y, n_samples)).astype('int64')
-    x_mask = np.zeros((maxlen_x, n_samples)).astype('float32')
-    y_mask = np.zeros((maxlen_y, n_samples)).astype('float32')
-    for idx, [s_x, s_y] in enumerate(zip(seqs_x, seqs_y)):
-        x[:lengths_x[idx], idx] = s_x
-        x_mask[:lengths_x[idx] + 1, idx] = 1.
-        y[:lengths_y[idx], idx] = s_y
-        y_mask[:lengths_y[idx] + 1, idx] = 1.
+    x, x_mask = fill_padded(flat_x, starts_x, lengths_x, maxlen_x)
+    y, y_mask = fill_padded(flat_y, starts_y, lengths_y, maxlen_y)
 
     return x, x_mask, y, y_mask
 
 
 def prepare_data_x(seqs_x, maxlen=None, pad_eos=True, pad_sos=False, n_word=30000):
     # x: a list of sentences
-    lengths_x = [len(s) for s in seqs_x]
+    flat_x, starts_x, lengths_x = flatten_seqs(seqs_x)
 
     if maxlen is not None:
-        new_seqs_x = []
-        new_lengths_x = []
-        for l_x, s_x in zip(lengths_x, seqs_x):
-            if l_x < maxlen:
-                new_seqs_x.append(s_x)
-                new_lengths_x.append(l_x)
-
-        lengths_x = new_lengths_x
-        seqs_x = new_seqs_x
+        keep = lengths_x < maxlen
+        starts_x, lengths_x = starts_x[keep], lengths_x[keep]
 
         if len(lengths_x) < 1:
             return None, None,
 
-    n_samples = len(seqs_x)
+    n_samples = len(lengths_x)
     if pad_eos:
-        maxlen_x = np.max(lengths_x) + 1
+        maxlen_x = int(np.max(lengths_x)) + 1
     else:
-        maxlen_x = np.max(lengths_x)
-
-    x = np.zeros((maxlen_x, n_samples)).astype('int64')
-
-    x_mask = np.zeros((maxlen_x, n_samples)).astype('float32')
-
-    for idx, s_x in enumerate(seqs_x):
-        x[:lengths_x[idx], idx] = s_x
-        if pad_eos:
-            x_mask[:lengths_x[idx]+1, idx] = 1.
-        else:
-            x_mask[:lengths_x[idx], idx] = 1.
+        maxlen_x = int(np.max(lengths_x))
 
     if pad_sos:
-        x = np.concatenate((
-            np.full([1, n_samples], n_word - 1, dtype='int64'), x
-        ), axis=0)
-        x_mask = np.concatenate((
-            np.full([1, n_samples], 1., dtype='float32'), x_mask
-        ), axis=0)
+        # Fill below the sos row directly
+        x = np.empty((maxlen_x + 1, n_samples), dtype='int64')
+        x_mask = np.empty((maxlen_x + 1, n_samples), dtype='float32')
+        x[0] = n_word - 1
+        x_mask[0] = 1.
+        fill_padded(flat_x, starts_x, lengths_x, maxlen_x, x[1:], x_mask[1:], mask_len_offset=int(pad_eos))
+    else:
+        x, x_mask = fill_padded(flat_x, starts_x, lengths_x, maxlen_x, mask_len_offset=int(pad_eos))
 
     return x, x_mask
 
-def get_batch_place_holder(batch_size, maxlen):
+def get_batch_place_holder(batch_size, maxlen, max_tokens=-1):
+    if max_tokens > 0:
+        # The largest batch under the token budget at max length
+        batch_size = min(batch_size, max(1, max_tokens // (2 * (maxlen + 1))))
     x = np.zeros((maxlen + 1, batch_size)).astype('int64')
     y = np.zeros((maxlen + 1, batch_size)).astype('int64')
     x_mask = np.zeros((maxlen + 1, batch_size)).astype('float32')
@@ -592,9 +572,8 @@ def load_options_train(options, reload_=None, preload=None):
 
     if reload_ and os.path.exists(preload):
         print('Reloading model options')
-        with open('{}.pkl'.format(preload), 'rb') as f:
-            # FIXME: Update the option instead of replace it
-            options.update(pkl.load(f))
+        # FIXME: Update the option instead of replace it
+        options.update(load_model_options(preload))
 
         # Remain reload_, preload and dropout
         options['reload_'] = reload_
@@ -607,12 +586,16 @@ def load_options_train(options, reload_=None, preload=None):
         options['n_words_src'] = src_vocab_size
         options['n_words'] = tgt_vocab_size
 
-def save_options(options, iteration, saveto=None):
+def save_options(options, iteration, saveto=None, writer=None):
     saveto = options['saveto'] if saveto is None else saveto
 
     save_filename = '{}.iter{}.npz.pkl'.format(os.path.splitext(saveto)[0], iteration) \
         if iteration != -1 else '{}.pkl'.format(saveto)
 
+    if writer is not None:
+        writer.save_pickle(save_filename, dict(options))
+        return
+
     with open(save_filename, 'wb') as f:
         pkl.dump(options, f)
 
@@ -626,6 +609,9 @@ def check_options(options):
     if 'multi' in options['unit']:
         assert options['unit_size'] > 0 and options['cond_unit_size'] > 0, 'Unit size must > 0'
 
+    if options.get('sampled_softmax', 0) > 0:
+        assert options['trg_attention_layer_id'] is None, 'Sampled softmax does not support target attention'
+
     if options['reload_']:
         assert os.path.exists(options['preload']), 'preload file {} does not exist'.format(options['preload'])
 
@@ -634,7 +620,7 @@ def search_start_uidx(reload_, preload):
     if not reload_:
         return 0
 
-    m = re.search('.+iter(\d+?)\.npz', preload)
+    m = re.search('.+iter(\d+?)\.(?:npz|ckpt)', preload)
     if m:
         return int(m.group(1))
     else:
@@ -642,6 +628,7 @@ def search_start_uidx(reload_, preload):
 
 
 def make_f_train(f_grad_shared, f_update):
+    """Wrap the two calls of an update, same interface as the fused f_train of optimizers (without g2)."""
     def f_train(x, x_mask, y, y_mask, lr):
         cost = f_grad_shared(x, x_mask, y, y_mask)
 
@@ -652,8 +639,35 @@ def make_f_train(f_grad_shared, f_update):
     return f_train
 
 
+def _split_optimizer_imm_data(optimizer, data):
+    """Split the flat list of optimizer states into the immediate data of the optimizer."""
+    data_size = len(data)
+    if optimizer == 'adadelta':
+        return [
+            [data[i] for i in range(0, data_size // 2)],
+            [data[i] for i in range(data_size // 2, data_size)],
+        ]
+    elif optimizer == 'adam':
+        return [
+            data[0],
+            [data[i] for i in range(1, data_size // 2 + 1)],
+            [data[i] for i in range(data_size // 2 + 1, data_size)],
+        ]
+    else:
+        return None
+
+
 def get_optimizer_imm_data(optimizer, given_imm, preload, iteration=None):
     if given_imm:
+        if is_checkpoint_file(preload):
+            # Optimizer states are saved in the checkpoint container
+            data = Checkpoint(preload).optimizer_data()
+            if data is None:
+                message('No immediate data in checkpoint %s.' % preload)
+                return None
+            message('Loading adadelta immediate data')
+            return _split_optimizer_imm_data(optimizer, [np.array(value) for value in data])
+
         # [NOTE] preload filename format: filename.iter10000.npz
         _real_filename = os.path.splitext(os.path.splitext(preload)[0])[0]
         if iteration is None:
@@ -664,33 +678,34 @@ def get_optimizer_imm_data(optimizer, given_imm, preload, iteration=None):
         if os.path.exists(given_imm_filename):
             message('Loading adadelta immediate data')
             with np.load(given_imm_filename) as data:
-                data = data['arr_0']
-                data_size = len(data)
-                if optimizer == 'adadelta':
-                    return [
-                        [data[i] for i in range(0, data_size // 2)],
-                        [data[i] for i in range(data_size // 2, data_size)],
-                    ]
-                elif optimizer == 'adam':
-                    return [
-                        data[0],
-                        [data[i] for i in range(1, data_size // 2 + 1)],
-                        [data[i] for i in range(data_size // 2 + 1, data_size)],
-                    ]
-                else:
-                    pass
+                return _split_optimizer_imm_data(optimizer, data['arr_0'])
         else:
             message('Immediate data file %s not found.' % given_imm_filename)
     return None
 
 
-def dump_optimizer_imm_data(optimizer, imm_shared, dump_imm, saveto, iteration=None):
+def dump_optimizer_imm_data(optimizer, imm_shared, dump_imm, saveto, iteration=None, writer=None):
     if optimizer == 'sgd':
         return
 
     if imm_shared is None or dump_imm is None:
         return
 
+    if writer is not None:
+        # Snapshot now, write in background (atomically renamed by the writer)
+        if iteration is None:
+            imm_filename = BestImmediateFilename.format(os.path.splitext(saveto)[0])
+        else:
+            imm_filename = ImmediateFilename.format(os.path.splitext(saveto)[0], iteration)
+        if optimizer == 'adadelta':
+            writer.save_npz(imm_filename, lambda: np.array([g.get_value() for g in imm_shared[0]] +
+                                                           [g.get_value() for g in imm_shared[1]], dtype=object))
+        elif optimizer == 'adam':
+            writer.save_npz(imm_filename, lambda: np.array([imm_shared[0].get_value()] +
+                                                           [g.get_value() for g in imm_shared[1]] +
+                                                           [g.get_value() for g in imm_shared[2]], dtype=object))
+        return
+
     if iteration is None:
         tmp_filename = BestTempImmediateFilename.format(os.path.splitext(saveto)[0])
         imm_filename = BestImmediateFilename.format(os.path.splitext(saveto)[0])
@@ -726,6 +741,53 @@ def dump_optimizer_imm_data(optimizer, imm_shared, dump_imm, saveto, iteration=N
     message('Done')
 
 
+def save_iterator_state(saveto, iteration, worker_id, state, writer=None):
+    """Save the data iterator state of the checkpoint at `iteration` (each worker saves its own state).
+
+    If `iteration` is None, overwrite the latest state of the worker.
+    """
+    if iteration is None:
+        filename = LatestIteratorStateFilename.format(os.path.splitext(saveto)[0], worker_id)
+    else:
+        filename = IteratorStateFilename.format(os.path.splitext(saveto)[0], iteration, worker_id)
+    if writer is not None:
+        writer.save_pickle(filename, state)
+        return
+    tmp_filename = '{}.tmp{}'.format(filename, os.getpid())
+    with open(tmp_filename, 'wb') as f:
+        pkl.dump(state, f, protocol=pkl.HIGHEST_PROTOCOL)
+    os.rename(tmp_filename, filename)
+
+
+def load_iterator_state(preload, iteration, worker_id):
+    """Load the data iterator state of the checkpoint, None if not saved."""
+    if is_checkpoint_file(preload):
+        return Checkpoint(preload).iterator_state(worker_id)
+
+    # [NOTE] preload filename format: filename.iter10000.npz
+    _real_filename = os.path.splitext(os.path.splitext(preload)[0])[0]
+    filename = IteratorStateFilename.format(_real_filename, iteration, worker_id)
+    if not os.path.exists(filename):
+        return None
+
+    message('Loading data iterator state from {}'.format(filename))
+    with open(filename, 'rb') as f:
+        return pkl.load(f)
+
+
+def flatten_optimizer_imm_shared(imm_shared):
+    """Get the flat list of optimizer state shared variables, same order as the immediate file."""
+    if imm_shared is None:
+        return []
+    flat = []
+    for item in imm_shared:
+        if isinstance(item, (list, tuple)):
+            flat.extend(item)
+        else:
+            flat.append(item)
+    return flat
+
+
 def set_optimizer_imm_data(optimizer, given_imm_data, imm_shared):
     imm_model_start_idx = 0 if optimizer == 'adadelta' else 1
     for (imm_0, imm_1, imm0_given, imm1_given) in zip(imm_shared[imm_model_start_idx], imm_shared[imm_model_start_idx + 1], given_imm_data[imm_model_start_idx], given_imm_data[imm_model_start_idx + 1]):
@@ -758,8 +820,26 @@ def create_shuffle_data(datasets_orig, dataset_src, dataset_tgt):
 
 def load_shuffle_text_iterator(
         epoch, worker_id, text_iterator_list,
-        datasets, vocab_filenames, batch_size, maxlen, n_words_src, n_words,buffer_size
+        datasets, vocab_filenames, batch_size, maxlen, n_words_src, n_words,buffer_size, binary=False, max_tokens=-1,
+        n_shards=1,
 ):
+    if binary:
+        # Binary corpus: shuffle in place by a permutation of each epoch, no shuffled copies.
+        if text_iterator_list[0] is None:
+            message('Creating shuffled binary text iterator...', end='')
+            text_iterator_list[0] = BinaryTextIterator(
+                datasets[0], datasets[1],
+                vocab_filenames[0], vocab_filenames[1],
+                batch_size, n_words_src, n_words, maxlen, k=buffer_size, shuffle=True, max_tokens=max_tokens,
+                n_shards=n_shards, shard_id=worker_id % n_shards,
+            )
+            message('Done')
+        # Sharded workers read disjoint shards of the same permutation
+        permutation = epoch if n_shards > 1 else epoch + worker_id
+        message('Shuffle binary text iterator with permutation {}'.format(permutation))
+        text_iterator_list[0].reset(permutation)
+        return text_iterator_list[0]
+
     e = (epoch + worker_id) % ShuffleCycle
 
     if text_iterator_list[e] is None:
@@ -773,10 +853,10 @@ def load_shuffle_text_iterator(
             create_shuffle_data(datasets, dataset_src, dataset_tgt)
             message('Done')
 
-        text_iterator_list[e] = TextIterator(
+        text_iterator_list[e] = (BinaryTextIterator if binary else TextIterator)(
             dataset_src, dataset_tgt,
             vocab_filenames[0], vocab_filenames[1],
-            batch_size, n_words_src, n_words, maxlen, k = buffer_size,
+            batch_size, n_words_src, n_words, maxlen, k = buffer_size, max_tokens=max_tokens,
         )
         message('Done')
         return text_iterator_list[e]
@@ -786,17 +866,25 @@ def load_shuffle_text_iterator(
         text_iterator_list[e].reset()
         return text_iterator_list[e]
 
-def get_epoch_batch_cnt(dataset_src, dataset_tgt, vocab_filenames, batch_size, maxlen, n_words_src, n_words):
+def get_epoch_batch_cnt(dataset_src, dataset_tgt, vocab_filenames, batch_size, maxlen, n_words_src, n_words, binary=False,
+                        k=40, max_tokens=-1):
+    """Number of batches of an epoch, computed from sentence lengths without iterating the corpus.
+
+    Lengths come from the binary corpus offsets, or the length index of the text corpus (built once and cached).
+    """
+
+    if binary:
+        _, src_offsets = load_binary_corpus(dataset_src, n_words_src, vocab_filenames[0], mmap_mode='r')
+        _, tgt_offsets = load_binary_corpus(dataset_tgt, n_words, vocab_filenames[1], mmap_mode='r')
+        src_lengths, tgt_lengths = np.diff(src_offsets), np.diff(tgt_offsets)
+    else:
+        src_lengths, _ = load_length_index(dataset_src)
+        tgt_lengths, _ = load_length_index(dataset_tgt)
+    n_lines = min(len(src_lengths), len(tgt_lengths))
 
-    text_iterator = TextIterator(
-        dataset_src, dataset_tgt,
-        vocab_filenames[0], vocab_filenames[1],
-        batch_size, n_words_src, n_words,maxlen
-    )
-    n_batches = 0
-    for (x, y) in text_iterator:
-        n_batches += 1
-    return n_batches
+    _, n_batches = epoch_batch_plan(src_lengths[:n_lines], tgt_lengths[:n_lines], batch_size, maxlen, batch_size * k,
+                                    max_tokens=max_tokens)
+    return int(n_batches.sum())
 
 __all__ = [
     'set_logging_file',
@@ -830,6 +918,7 @@ __all__ = [
     'get_epoch_batch_cnt',
     'print_params',
     'load_options_train',
+    'load_model_options',
     'load_options_test',
     'save_options',
     'check_options',
@@ -837,6 +926,9 @@ __all__ = [
     'make_f_train',
     'get_optimizer_imm_data',
     'dump_optimizer_imm_data',
+    'flatten_optimizer_imm_shared',
+    'save_iterator_state',
+    'load_iterator_state',
     'load_shuffle_text_iterator',
     'make_grads_clip_func',
     'set_optimizer_imm_data',
@@ -0,0 +1,280 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Array-backed, memory-mapped vocabulary.
+
+A word -> id dict is compiled once into a single binary file:
+    header:         magic, version, n_words, id_size (max id + 1), table_size, blob_size
+    word_offsets:   int64[n_words + 1], word i of the sorted string table is blob[word_offsets[i]:word_offsets[i + 1]]
+    sorted_ids:     int32[n_words], id of word i of the sorted string table
+    id_to_sorted:   int32[id_size], index in the sorted string table of each id (-1 if the id is not used)
+    table:          int32[table_size], open addressing hash index (crc32, linear probing) into the sorted string table
+    blob:           utf-8 bytes of all words, in sorted order
+
+The file is memory-mapped read-only, so processes loading the same vocabulary share one page-cached copy,
+and loading takes no time regardless of the vocabulary size.
+"""
+
+from __future__ import print_function
+
+import os
+import zlib
+import cPickle as pkl
+
+import numpy as np
+
+from ..constants import VocabularyFilename
+
+__author__ = 'fyabc'
+
+_Magic = 'NMTVOCAB'
+_Version = 1
+_HeaderSize = 64
+_Empty = -1
+
+# Max number of memorized word lookups of a vocabulary (cleared when full).
+_MaxCacheSize = 1 << 20
+
+
+def _align(n, alignment=8):
+    return (n + alignment - 1) // alignment * alignment
+
+
+def _hash(word):
+    return zlib.crc32(word) & 0xffffffff
+
+
+def _to_bytes(word):
+    return word.encode('utf-8') if isinstance(word, unicode) else word
+
+
+def compile_vocabulary(dictionary, filename):
+    """Compile a word -> id dict into the vocabulary file.
+
+    :param dictionary: word dict (or the path of the pickled word dict).
+    :param filename: output filename.
+    """
+
+    if not isinstance(dictionary, dict):
+        with open(dictionary, 'rb') as f:
+            dictionary = pkl.load(f)
+
+    words = sorted((_to_bytes(w), i) for w, i in dictionary.iteritems())
+    n_words = len(words)
+    id_size = max(i for _, i in words) + 1 if words else 0
+
+    word_lengths = np.array([len(w) for w, _ in words], dtype='int64')
+    word_offsets = np.zeros(n_words + 1, dtype='int64')
+    np.cumsum(word_lengths, out=word_offsets[1:])
+    sorted_ids = np.array([i for _, i in words], dtype='int32')
+
+    id_to_sorted = np.full(id_size, _Empty, dtype='int32')
+    id_to_sorted[sorted_ids] = np.arange(n_words, dtype='int32')
+
+    table_size = 1
+    while table_size < 2 * n_words:
+        table_size *= 2
+    mask = table_size - 1
+    table = np.full(table_size, _Empty, dtype='int32')
+    for pos, (word, _) in enumerate(words):
+        slot = _hash(word) & mask
+        while table[slot] != _Empty:
+            slot = (slot + 1) & mask
+        table[slot] = pos
+
+    blob = ''.join(w for w, _ in words)
+
+    tmp_filename = '{}.tmp{}'.format(filename, os.getpid())
+    with open(tmp_filename, 'wb') as f:
+        header = np.array([_Version, n_words, id_size, table_size, len(blob)], dtype='int64')
+        f.write(_Magic)
+        f.write(header.tostring())
+        f.write('\0' * (_HeaderSize - len(_Magic) - header.nbytes))
+        for array in (word_offsets, sorted_ids, id_to_sorted, table):
+            f.write(array.tostring())
+            f.write('\0' * (_align(array.nbytes) - array.nbytes))
+        f.write(blob)
+    os.rename(tmp_filename, filename)
+
+    return filename
+
+
+class InverseVocabulary(object):
+    """Lazy id -> word view of a `Vocabulary`, entries can be overridden (e.g. `idict[0] = '<eos>'`)."""
+
+    def __init__(self, vocabulary):
+        self.vocabulary = vocabulary
+        self.overrides = {}
+
+    def __getitem__(self, id_):
+        if id_ in self.overrides:
+            return self.overrides[id_]
+        word = self.vocabulary.word(id_)
+        if word is None:
+            raise KeyError(id_)
+        return word
+
+    def __setitem__(self, id_, word):
+        self.overrides[id_] = word
+
+    def __contains__(self, id_):
+        return id_ in self.overrides or self.vocabulary.word(id_) is not None
+
+    def get(self, id_, default=None):
+        try:
+            return self[id_]
+        except KeyError:
+            return default
+
+    def __len__(self):
+        return len(self.vocabulary) + sum(1 for i in self.overrides if self.vocabulary.word(i) is None)
+
+
+class Vocabulary(object):
+    """Memory-mapped word -> id vocabulary, can be used as a read-only dict."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._data = np.memmap(filename, dtype='uint8', mode='r')
+
+        if self._data[:len(_Magic)].tostring() != _Magic:
+            raise ValueError('{} is not a vocabulary file'.format(filename))
+        version, self.n_words, self.id_size, table_size, blob_size = \
+            self._data[len(_Magic):len(_Magic) + 40].view('int64').tolist()
+        if version != _Version:
+            raise ValueError('Unsupported vocabulary version {} of {}'.format(version, filename))
+
+        start = _HeaderSize
+        sections = []
+        for dtype, size in (('int64', self.n_words + 1), ('int32', self.n_words),
+                            ('int32', self.id_size), ('int32', table_size)):
+            nbytes = np.dtype(dtype).itemsize * size
+            sections.append(self._data[start:start + nbytes].view(dtype))
+            start += _align(nbytes)
+        self._word_offsets, self._sorted_ids, self._id_to_sorted, self._table = sections
+        self._blob = self._data[start:start + blob_size]
+        self._mask = table_size - 1
+
+        # Memorized lookups (word -> id or None), frequent words are looked up only once
+        self._cache = {}
+
+    def __len__(self):
+        return self.n_words
+
+    def _word_at(self, pos):
+        return self._blob[self._word_offsets[pos]:self._word_offsets[pos + 1]].tostring()
+
+    def _lookup(self, word):
+        if self._mask < 0:
+            return None
+        slot = _hash(word) & self._mask
+        while True:
+            pos = self._table[slot]
+            if pos == _Empty:
+                return None
+            if self._word_at(pos) == word:
+                return int(self._sorted_ids[pos])
+            slot = (slot + 1) & self._mask
+
+    def get(self, word, default=None):
+        try:
+            id_ = self._cache[word]
+        except KeyError:
+            id_ = self._lookup(_to_bytes(word))
+            if len(self._cache) >= _MaxCacheSize:
+                self._cache.clear()
+            self._cache[word] = id_
+        return default if id_ is None else id_
+
+    def __getitem__(self, word):
+        id_ = self.get(word)
+        if id_ is None:
+            raise KeyError(word)
+        return id_
+
+    def __contains__(self, word):
+        return self.get(word) is not None
+
+    def word(self, id_):
+        """Get the word of the id, None if not exists."""
+        if not 0 <= id_ < self.id_size:
+            return None
+        pos = self._id_to_sorted[id_]
+        return None if pos == _Empty else self._word_at(pos)
+
+    def encode(self, tokens, unk_id=1, n_words=-1):
+        """Convert a list of tokens into a list of ids, unknown words and ids >= n_words (if > 0) are UNK."""
+        get = self.get
+        ids = [get(w, unk_id) for w in tokens]
+        if n_words > 0:
+            ids = [i if i < n_words else unk_id for i in ids]
+        return ids
+
+    def decode(self, ids, unk_word='UNK'):
+        """Convert a list of ids into a list of words, unknown ids are `unk_word`."""
+        word = self.word
+        return [word(int(i)) or unk_word for i in ids]
+
+    def inverse(self):
+        """Get a lazy id -> word view, instead of inverting the whole dict."""
+        return InverseVocabulary(self)
+
+    def iteritems(self):
+        """Iterate (word, id) pairs in the sorted order of words."""
+        for pos in xrange(self.n_words):
+            yield self._word_at(pos), int(self._sorted_ids[pos])
+
+    def iterkeys(self):
+        for word, _ in self.iteritems():
+            yield word
+
+    def itervalues(self):
+        return iter(self._sorted_ids.tolist())
+
+    __iter__ = iterkeys
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return self._sorted_ids.tolist()
+
+    def items(self):
+        return list(self.iteritems())
+
+    def to_dict(self):
+        return dict(self.iteritems())
+
+
+def load_dictionary(filename):
+    """Load a word dict.
+
+    If filename is a vocabulary file, or its compiled vocabulary file (see `VocabularyFilename`) exists and
+    is not older than it, return the memory-mapped `Vocabulary`, else unpickle the dict.
+    """
+
+    if filename.endswith(VocabularyFilename.format('')):
+        return Vocabulary(filename)
+
+    vocab_filename = VocabularyFilename.format(filename)
+    if os.path.exists(vocab_filename) and os.path.getmtime(vocab_filename) >= os.path.getmtime(filename):
+        return Vocabulary(vocab_filename)
+
+    with open(filename, 'rb') as f:
+        return pkl.load(f)
+
+
+def invert_dictionary(dictionary):
+    """Get the id -> word mapping of a word dict (lazy for `Vocabulary`)."""
+    if isinstance(dictionary, Vocabulary):
+        return dictionary.inverse()
+    return {v: k for k, v in dictionary.iteritems()}
+
+
+__all__ = [
+    'compile_vocabulary',
+    'InverseVocabulary',
+    'Vocabulary',
+    'load_dictionary',
+    'invert_dictionary',
+]
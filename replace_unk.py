@@ -11,23 +11,25 @@ from libs.constants import Datasets
 from libs.models import build_and_init_model
 from libs.utility.translate import get_bleu, de_bpe
 from libs.utility.utils import prepare_data
+from libs.utility.function_cache import FunctionCache, cached_functions
+from libs.utility.vocabulary import load_dictionary
 
 __author__ = 'fyabc'
 
 
+def _encode(word_dict, words, n_words):
+    if hasattr(word_dict, 'encode'):
+        return word_dict.encode(words, unk_id=1, n_words=n_words)
+    return [i if i < n_words else 1 for i in (word_dict.get(w, 1) for w in words)]
+
+
 def _load_data(args, dic1, dic2, test1):
     with open('{}.pkl'.format(args.model), 'rb') as f:
         options = pkl.load(f)
 
-    # load source dictionary
-    with open(dic1, 'rb') as f:
-        word_dict_raw = pkl.load(f)
-    word_dict = {k: v for k, v in word_dict_raw.iteritems() if v < options['n_words_src']}
-
-    # load target dictionary and invert
-    with open(dic2, 'rb') as f:
-        word_dict_tgt_raw = pkl.load(f)
-    word_dict_tgt = {k: v for k, v in word_dict_tgt_raw.iteritems() if v < options['n_words']}
+    # load source and target dictionary (words with id >= n_words are UNK)
+    word_dict = load_dictionary(dic1)
+    word_dict_tgt = load_dictionary(dic2)
 
     if args.nbest == 1:
         with open(args.translated_file, 'r') as f:
@@ -40,11 +42,11 @@ def _load_data(args, dic1, dic2, test1):
                 if idx % args.nbest == 0
             ]
 
-    trans_sents_num = [[word_dict_tgt.get(w, 1) for w in s] for s in trans_sents_str]
+    trans_sents_num = [_encode(word_dict_tgt, s, options['n_words']) for s in trans_sents_str]
 
     with open(test1, 'r') as f:
         src_sents_str = [s.strip().split() for s in f]
-    src_sents_num = [[word_dict.get(w, 1) for w in s] for s in src_sents_str]
+    src_sents_num = [_encode(word_dict, s, options['n_words_src']) for s in src_sents_str]
 
     with open(args.table, 'rb') as f:
         src_tgt_table = pkl.load(f)
@@ -54,9 +56,17 @@ def _load_data(args, dic1, dic2, test1):
 
 def replace_unk(args, seq_source, seq_trans, src_sents, trans_sents, src_tgt_table):
     print 'Load and build models...',
-    model, _, (trng, use_noise, x, x_mask, y, y_mask, opt_ret, cost, context_mean) = \
-        build_and_init_model(args.model, build=True)
-    f_get_attention = theano.function([x, x_mask, y, y_mask], opt_ret['dec_alphas'])
+    model, options = build_and_init_model(args.model, build=False)
+
+    def build_functions():
+        ret = model.build_model()
+        x, x_mask, y, y_mask = ret[2:6]
+        opt_ret = ret[6]
+        return {'functions': {'f_get_attention': theano.function([x, x_mask, y, y_mask], opt_ret['dec_alphas'])}}
+
+    function_cache = FunctionCache(args.function_cache, options) if args.function_cache else None
+    f_get_attention = cached_functions(function_cache, 'attention', model.P, build_functions)['functions'][
+        'f_get_attention']
     print 'Done'
 
     print 'Start to calculate the scores...'
@@ -112,6 +122,8 @@ def main():
                         help='Get BLEU, default is True, set to False')
     parser.add_argument('-d', '--dump', action='store_true', default=False, dest='dump',
                         help='Dump translated file without UNK, default is False, set to True')
+    parser.add_argument('--function_cache', action='store', default=None, dest='function_cache',
+                        help='Directory of compiled function cache, default is None (not cache)')
 
     args = parser.parse_args()
 
@@ -0,0 +1,126 @@
+#! /usr/bin/python
+# -*- encoding: utf-8 -*-
+
+"""Micro-benchmark of train batch assembly: per-sentence loop vs vectorized `prepare_data` vs `BatchAssembler`."""
+
+from __future__ import print_function
+
+import os
+import sys
+import argparse
+import timeit
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from libs.utility.utils import prepare_data
+from libs.utility.batch_assembler import BatchAssembler
+
+__author__ = 'fyabc'
+
+
+def prepare_data_loop(seqs_x, seqs_y, maxlen=None):
+    """The old per-sentence implementation of `prepare_data`, as the baseline."""
+
+    lengths_x = [len(s) for s in seqs_x]
+    lengths_y = [len(s) for s in seqs_y]
+
+    if maxlen is not None:
+        new_seqs_x = []
+        new_seqs_y = []
+        new_lengths_x = []
+        new_lengths_y = []
+        for l_x, s_x, l_y, s_y in zip(lengths_x, seqs_x, lengths_y, seqs_y):
+            if l_x < maxlen and l_y < maxlen:
+                new_seqs_x.append(s_x)
+                new_lengths_x.append(l_x)
+                new_seqs_y.append(s_y)
+                new_lengths_y.append(l_y)
+        lengths_x = new_lengths_x
+        seqs_x = new_seqs_x
+        lengths_y = new_lengths_y
+        seqs_y = new_seqs_y
+
+        if len(lengths_x) < 1 or len(lengths_y) < 1:
+            return None, None, None, None
+
+    n_samples = len(seqs_x)
+    maxlen_x = np.max(lengths_x) + 1
+    maxlen_y = np.max(lengths_y) + 1
+
+    x = np.zeros((maxlen_x, n_samples)).astype('int64')
+    y = np.zeros((maxlen_y, n_samples)).astype('int64')
+    x_mask = np.zeros((maxlen_x, n_samples)).astype('float32')
+    y_mask = np.zeros((maxlen_y, n_samples)).astype('float32')
+    for idx, [s_x, s_y] in enumerate(zip(seqs_x, seqs_y)):
+        x[:lengths_x[idx], idx] = s_x
+        x_mask[:lengths_x[idx] + 1, idx] = 1.
+        y[:lengths_y[idx], idx] = s_y
+        y_mask[:lengths_y[idx] + 1, idx] = 1.
+
+    return x, x_mask, y, y_mask
+
+
+def random_corpus(n_lines, maxlen, n_words, rng):
+    """Random binary corpus (flat ids and offsets)."""
+    lengths = rng.randint(1, maxlen + 10, size=n_lines)
+    offsets = np.zeros(n_lines + 1, dtype='int64')
+    np.cumsum(lengths, out=offsets[1:])
+    return rng.randint(2, n_words, size=offsets[-1]).astype('uint16'), offsets
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark per-batch assembly time.')
+    parser.add_argument('--bs', action='store', default=128, type=int, dest='batch_size',
+                        help='Batch size, default is %(default)s')
+    parser.add_argument('--maxlen', action='store', default=80, type=int, dest='maxlen',
+                        help='Max sentence length, default is %(default)s')
+    parser.add_argument('--n_batches', action='store', default=200, type=int, dest='n_batches',
+                        help='Number of different batches, default is %(default)s')
+    parser.add_argument('--repeat', action='store', default=5, type=int, dest='repeat',
+                        help='Number of repeats (the best is reported), default is %(default)s')
+
+    args = parser.parse_args(args)
+
+    rng = np.random.RandomState(1234)
+    n_lines = args.batch_size * args.n_batches
+    source_ids, source_offsets = random_corpus(n_lines, args.maxlen, 30000, rng)
+    target_ids, target_offsets = random_corpus(n_lines, args.maxlen, 30000, rng)
+
+    batch_indices = np.split(rng.permutation(n_lines), args.n_batches)
+    batches = [
+        ([source_ids[source_offsets[i]:source_offsets[i + 1]].tolist() for i in indices],
+         [target_ids[target_offsets[i]:target_offsets[i + 1]].tolist() for i in indices])
+        for indices in batch_indices
+    ]
+
+    assembler = BatchAssembler(args.batch_size, args.maxlen)
+
+    # Check the results first
+    for (seqs_x, seqs_y), indices in zip(batches, batch_indices):
+        expected = prepare_data_loop(seqs_x, seqs_y, maxlen=args.maxlen)
+        for results in (prepare_data(seqs_x, seqs_y, maxlen=args.maxlen), assembler(seqs_x, seqs_y),
+                        assembler.assemble_indices(source_ids, source_offsets, target_ids, target_offsets, indices)):
+            assert all(np.array_equal(e, r) for e, r in zip(expected, results)), 'Results mismatch'
+
+    candidates = [
+        ('loop prepare_data', lambda: [prepare_data_loop(x, y, maxlen=args.maxlen) for x, y in batches]),
+        ('vectorized prepare_data', lambda: [prepare_data(x, y, maxlen=args.maxlen) for x, y in batches]),
+        ('BatchAssembler (lists)', lambda: [assembler(x, y) for x, y in batches]),
+        ('BatchAssembler (binary)', lambda: [
+            assembler.assemble_indices(source_ids, source_offsets, target_ids, target_offsets, indices)
+            for indices in batch_indices]),
+    ]
+
+    print('Batch size {}, maxlen {}, {} batches'.format(args.batch_size, args.maxlen, args.n_batches))
+    baseline = None
+    for name, fn in candidates:
+        per_batch = min(timeit.repeat(fn, number=1, repeat=args.repeat)) / args.n_batches
+        if baseline is None:
+            baseline = per_batch
+        print('{:<26}{:>10.1f} us/batch{:>8.2f}x'.format(name, per_batch * 1e6, baseline / per_batch))
+
+
+if __name__ == '__main__':
+    main()
@@ -12,43 +12,137 @@ except:
 
 import sys
 import os
-import fileinput
+import time
+from multiprocessing import Pool
 
-from collections import OrderedDict
+from collections import OrderedDict, Counter
 import argparse
 
 __author__ = 'fyabc'
 
+# Bytes read at once when counting a chunk.
+_ReadSize = 1 << 24
+
+
+def split_chunks(filename, n_chunks):
+    """Split a file into at most `n_chunks` byte ranges, the boundaries are at line starts.
+
+    :return: list of (filename, start, end)
+    """
+
+    size = os.path.getsize(filename)
+    boundaries = [0]
+    with open(filename, 'rb') as f:
+        for i in xrange(1, n_chunks):
+            f.seek(max(size * i // n_chunks, boundaries[-1]))
+            if f.tell() > 0:
+                # Move to the start of the next line
+                f.seek(f.tell() - 1)
+                f.readline()
+            boundaries.append(min(f.tell(), size))
+    boundaries.append(size)
+
+    return [(filename, start, end) for start, end in zip(boundaries[:-1], boundaries[1:]) if end > start]
+
+
+def count_chunk(chunk):
+    """Count words of the lines in a byte range."""
+
+    filename, start, end = chunk
+    counter = Counter()
+
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        remaining = end - start
+        rest = ''
+        while remaining > 0:
+            data = f.read(min(_ReadSize, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            lines = (rest + data).split('\n')
+            rest = lines.pop()
+            for line in lines:
+                counter.update(line.strip().split(' '))
+        if rest:
+            counter.update(rest.strip().split(' '))
+
+    return counter
+
+
+def count_words(filenames, workers=1, chunks_per_worker=4):
+    word_freqs = Counter()
+
+    if workers <= 1:
+        for filename in filenames:
+            print('Processing', filename)
+            word_freqs.update(count_chunk((filename, 0, os.path.getsize(filename))))
+        return word_freqs
+
+    chunks = []
+    for filename in filenames:
+        print('Processing', filename)
+        chunks.extend(split_chunks(filename, workers * chunks_per_worker))
+
+    pool = Pool(workers)
+    try:
+        for i, counter in enumerate(pool.imap_unordered(count_chunk, chunks)):
+            word_freqs.update(counter)
+            print('Counted {}/{} chunks'.format(i + 1, len(chunks)), end='\r')
+            sys.stdout.flush()
+        print()
+    finally:
+        pool.close()
+        pool.join()
+
+    return word_freqs
+
+
+def select_words(word_freqs, max_words=-1, min_freq=1):
+    """Select the most frequent words (with freq >= min_freq), sorted by frequency desc then word.
+
+    Only the selected words are sorted: they are picked by a partial selection (argpartition).
+    Ties at the size limit are broken by word, so the result does not depend on the counting order.
+    """
+
+    words = list(word_freqs.iterkeys())
+    freqs = numpy.fromiter(word_freqs.itervalues(), dtype='int64', count=len(words))
+
+    if min_freq > 1:
+        keep = numpy.flatnonzero(freqs >= min_freq)
+        words = [words[i] for i in keep]
+        freqs = freqs[keep]
+
+    if 0 <= max_words < len(words):
+        if max_words == 0:
+            return []
+        threshold = freqs[numpy.argpartition(-freqs, max_words - 1)[max_words - 1]]
+        selected = numpy.flatnonzero(freqs > threshold).tolist()
+        ties = sorted(words[i] for i in numpy.flatnonzero(freqs == threshold))
+        sorted_words = sorted((words[i] for i in selected), key=lambda w: (-word_freqs[w], w))
+        return sorted_words + ties[:max_words - len(selected)]
+
+    return [words[i] for i in sorted(xrange(len(words)), key=lambda i: (-freqs[i], words[i]))]
+
 
 def real_main(args):
     if args.output is None:
         args.output = '{}.pkl'.format(args.input[0])
 
     tgt_filename = os.path.join('data', 'dic', args.output)
+    freq_filename = '{}.freq.txt'.format(tgt_filename) if args.freq_output is None else args.freq_output
+
+    start_time = time.time()
+    word_freqs = count_words([os.path.join('data', 'train', filename) for filename in args.input], args.workers)
+    print('Counted {} words, {} tokens in {:.3f}s'.format(
+        len(word_freqs), sum(word_freqs.itervalues()), time.time() - start_time))
 
-    word_freqs = OrderedDict()
     worddict = OrderedDict()
     worddict['eos'] = 0
     worddict['UNK'] = 1
 
-    for filename in args.input:
-        src_filename = os.path.join('data', 'train', filename)
-
-        print('Processing', src_filename)
-
-        with open(src_filename, 'r') as f:
-            for line in f:
-                words_in = line.strip().split(' ')
-                for w in words_in:
-                    if w not in word_freqs:
-                        word_freqs[w] = 0
-                    word_freqs[w] += 1
-
-    words = list(word_freqs.keys())
-    freqs = list(word_freqs.values())
-
-    sorted_idx = numpy.argsort(freqs)
-    sorted_words = [words[ii] for ii in sorted_idx[::-1]]
+    # max_size includes eos and UNK, same as n_words of training
+    sorted_words = select_words(word_freqs, args.max_size - 2 if args.max_size > 0 else -1, args.min_freq)
 
     for ii, ww in enumerate(sorted_words):
         worddict[ww] = ii + 2
@@ -58,6 +152,20 @@ def real_main(args):
 
         pkl.dump(worddict, f)
 
+    with open(freq_filename, 'w') as f:
+        print('Dump frequencies to', freq_filename)
+
+        for ww in sorted_words:
+            print(ww, word_freqs[ww], sep='\t', file=f)
+
+    if args.vocab:
+        sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        from libs.constants import VocabularyFilename
+        from libs.utility.vocabulary import compile_vocabulary
+
+        print('Compile vocabulary to', VocabularyFilename.format(tgt_filename))
+        compile_vocabulary(worddict, VocabularyFilename.format(tgt_filename))
+
 
 def main(args=None):
     parser = argparse.ArgumentParser(description='Build dictionary file.')
@@ -66,6 +174,18 @@ def main(args=None):
                         help='input filenames')
     parser.add_argument('-o', '--output', action='store', dest='output', default=None,
                         help='dict output file, default is first input filename + ".pkl"')
+    parser.add_argument('-j', '--workers', action='store', dest='workers', type=int, default=1,
+                        help='number of counting processes, input files are split into byte-range chunks, '
+                             'default is %(default)s')
+    parser.add_argument('--max-size', action='store', dest='max_size', type=int, default=-1,
+                        help='max dict size (including eos and UNK), default is %(default)s (unlimited)')
+    parser.add_argument('--min-freq', action='store', dest='min_freq', type=int, default=1,
+                        help='min word frequency, default is %(default)s')
+    parser.add_argument('--freq-output', action='store', dest='freq_output', default=None,
+                        help='frequency list output file ("word<TAB>freq" per line, in id order), '
+                             'default is dict output file + ".freq.txt"')
+    parser.add_argument('--vocab', action='store_true', dest='vocab', default=False,
+                        help='also compile the memory-mapped vocabulary file, default is False, set to True')
 
     args = parser.parse_args(args)
 
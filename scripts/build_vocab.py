@@ -0,0 +1,38 @@
+#! /usr/bin/python
+# -*- encoding: utf-8 -*-
+
+"""Compile pickled word dicts into memory-mapped vocabulary files.
+
+The vocabulary file is written beside the pickled dict (see `libs.constants.VocabularyFilename`),
+then it is used automatically instead of unpickling the dict.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import argparse
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from libs.constants import VocabularyFilename
+from libs.utility.vocabulary import compile_vocabulary, Vocabulary
+
+__author__ = 'fyabc'
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Compile pickled word dicts into memory-mapped vocabulary files.')
+    parser.add_argument('dictionaries', nargs='+', help='The pickled dict filenames')
+
+    args = parser.parse_args(args)
+
+    for dictionary in args.dictionaries:
+        print('Compiling {}...'.format(dictionary), end='')
+        sys.stdout.flush()
+        filename = compile_vocabulary(dictionary, VocabularyFilename.format(dictionary))
+        print('Done, {} words written into {}'.format(len(Vocabulary(filename)), filename))
+
+
+if __name__ == '__main__':
+    main()
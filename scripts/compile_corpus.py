@@ -0,0 +1,36 @@
+#! /usr/bin/python
+# -*- encoding: utf-8 -*-
+
+"""Compile text corpus into binary pre-indexed corpus, used by `train_nmt.py --binary_data`."""
+
+from __future__ import print_function
+
+import os
+import sys
+import argparse
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from libs.utility.corpus import compile_corpus
+
+__author__ = 'fyabc'
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Compile text corpus into binary pre-indexed corpus.')
+    parser.add_argument('input', help='The text corpus filename')
+    parser.add_argument('dictionary', help='The pickled dict filename')
+    parser.add_argument('-n', '--n_words', action='store', dest='n_words', type=int, default=30000,
+                        help='Vocabulary size (must be same as training), default is %(default)s')
+
+    args = parser.parse_args(args)
+
+    print('Compiling {}...'.format(args.input), end='')
+    sys.stdout.flush()
+    ids_filename, offsets_filename = compile_corpus(args.input, args.dictionary, args.n_words)
+    print('Done')
+    print('Output: {}, {}'.format(ids_filename, offsets_filename))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+#! /usr/bin/python
+# -*- encoding: utf-8 -*-
+
+"""Convert checkpoints of separated files (model, options, immediate and iterator state files)
+into unified checkpoint containers."""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from libs.utility.checkpoint import convert_to_checkpoint, Checkpoint
+
+__author__ = 'fyabc'
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Convert model files into unified checkpoint containers.')
+    parser.add_argument('models', nargs='+',
+                        help='Model filenames, e.g. "model/en-de/model.iter10000.npz"')
+    parser.add_argument('-o', '--output', action='store', dest='output', default=None,
+                        help='Output filename (only for one model), default is the model filename with ".ckpt"')
+    parser.add_argument('--no_optimizer', action='store_false', dest='optimizer', default=True,
+                        help='Do not include optimizer states (e.g. for inference only), default is False')
+    parser.add_argument('--no_iterator', action='store_false', dest='iterator', default=True,
+                        help='Do not include data iterator states, default is False')
+
+    args = parser.parse_args(args)
+    assert args.output is None or len(args.models) == 1, '--output can only be used with one model'
+
+    for model in args.models:
+        start_time = time.time()
+        output = convert_to_checkpoint(model, args.output, optimizer=args.optimizer, iterator=args.iterator)
+
+        checkpoint = Checkpoint(output)
+        print('{} -> {} ({} entries, {:.1f} MB) in {:.3f} s'.format(
+            model, output, len(checkpoint.entries), os.path.getsize(output) / 1048576.0, time.time() - start_time))
+
+
+if __name__ == '__main__':
+    main()
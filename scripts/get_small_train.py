@@ -1,47 +1,126 @@
 #! /usr/bin/python
 # -*- encoding: utf-8 -*-
 
+"""Sample small parallel subsets (e.g. small train set, dev-like subsets) from a parallel corpus.
+
+Both sides are read in lockstep in a single pass, only the sampled lines are kept in memory
+(reservoir sampling, Algorithm L), so the corpus is never loaded as a whole.
+Several sample sizes are drawn independently in the same pass.
+"""
+
 from __future__ import print_function
 
-import sys
 import os
+import math
 import random
+import argparse
+from itertools import izip_longest
 
 __author__ = 'fyabc'
 
 
-def main():
-    input_filename1 = sys.argv[1]
-    input_filename2 = sys.argv[2]
+class Reservoir(object):
+    """Uniform sample of `size` items from a stream (Algorithm L, skips between replacements are drawn directly)."""
 
-    if len(sys.argv) >= 4:
-        small_size = int(sys.argv[3])
-    else:
-        small_size = 10000
+    def __init__(self, size, rng):
+        self.size = size
+        self.rng = rng
+        self.items = []
+        # Index of the next item to be added or replaced, items between are skipped
+        self.next_index = 0 if size > 0 else float('inf')
+        self._w = 1.
+
+    def _random(self):
+        # random() may return 0.0, which has no log
+        return self.rng.random() or 1e-300
+
+    def _skip(self):
+        self._w *= math.exp(math.log(self._random()) / self.size)
+        self.next_index += 1 + int(math.floor(math.log(self._random()) / math.log(1. - self._w)))
+
+    def add(self, index, item):
+        if index < self.size:
+            self.items.append((index, item))
+            self.next_index = index + 1
+            if self.next_index == self.size:
+                self.next_index -= 1
+                self._skip()
+        elif index == self.next_index:
+            self.items[self.rng.randrange(self.size)] = (index, item)
+            self._skip()
+
+    def sorted_items(self):
+        """Sampled items in stream order."""
+        return [item for _, item in sorted(self.items)]
+
+
+def sample_parallel(input_filename1, input_filename2, sizes, seed=None):
+    """Sample line pairs of the parallel corpus.
 
-    with open(input_filename1, 'r') as f_in:
-        lines = list(f_in)
+    :return: list of sampled (line1, line2) lists for each size, in corpus order
+    """
 
-        selected_indices = random.sample(range(len(lines)), small_size)
+    rng = random.Random(seed)
+    reservoirs = [Reservoir(size, random.Random(rng.random())) for size in sizes]
+    next_index = min(r.next_index for r in reservoirs) if reservoirs else -1
 
-        head, tail = os.path.split(input_filename1)
-        output_filename1 = '{}{}small_{}'.format(head, '/' if head else '', tail)
-        with open(output_filename1, 'w') as f_out:
-            for index in selected_indices:
-                print(lines[index], end='', file=f_out)
+    n_lines = 0
+    with open(input_filename1, 'r') as f_in1, open(input_filename2, 'r') as f_in2:
+        for index, pair in enumerate(izip_longest(f_in1, f_in2)):
+            if index >= next_index:
+                if pair[0] is None or pair[1] is None:
+                    raise ValueError('{} and {} have different number of lines'.format(
+                        input_filename1, input_filename2))
+                for reservoir in reservoirs:
+                    reservoir.add(index, pair)
+                next_index = min(r.next_index for r in reservoirs)
+            elif pair[0] is None or pair[1] is None:
+                raise ValueError('{} and {} have different number of lines'.format(input_filename1, input_filename2))
+            n_lines = index + 1
+
+    for size in sizes:
+        if size > n_lines:
+            print('Warning: sample size {} is larger than the corpus size {}'.format(size, n_lines))
+
+    return [reservoir.sorted_items() for reservoir in reservoirs]
+
+
+def output_filename(input_filename, prefix):
+    head, tail = os.path.split(input_filename)
+    return '{}{}{}_{}'.format(head, '/' if head else '', prefix, tail)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Sample small subsets of a parallel corpus in one pass.')
+    parser.add_argument('input1', help='The source corpus filename')
+    parser.add_argument('input2', help='The target corpus filename')
+    parser.add_argument('sizes', nargs='*', type=int, default=[10000],
+                        help='Sample sizes, default is 10000')
+    parser.add_argument('--seed', action='store', dest='seed', type=int, default=None,
+                        help='Random seed, default is None (not fixed)')
+    parser.add_argument('--prefixes', action='store', dest='prefixes', default=None,
+                        help='Comma-separated output filename prefixes of each size, default is "small" '
+                             'for one size, "small<size>" for several sizes')
+
+    args = parser.parse_args(args)
+
+    if args.prefixes is None:
+        prefixes = ['small'] if len(args.sizes) == 1 else ['small{}'.format(size) for size in args.sizes]
+    else:
+        prefixes = args.prefixes.split(',')
+        assert len(prefixes) == len(args.sizes), 'Number of prefixes must be same as number of sizes'
 
-        print('Extract {} -> {}'.format(input_filename1, output_filename1))
+    samples = sample_parallel(args.input1, args.input2, args.sizes, args.seed)
 
-    with open(input_filename2, 'r') as f_in:
-        lines = list(f_in)
+    for prefix, sample in zip(prefixes, samples):
+        for side, input_filename in enumerate((args.input1, args.input2)):
+            filename = output_filename(input_filename, prefix)
+            with open(filename, 'w') as f_out:
+                for pair in sample:
+                    print(pair[side], end='', file=f_out)
 
-        head, tail = os.path.split(input_filename2)
-        output_filename2 = '{}{}small_{}'.format(head, '/' if head else '', tail)
-        with open(output_filename2, 'w') as f_out:
-            for index in selected_indices:
-                print(lines[index], end='', file=f_out)
+            print('Extract {} lines {} -> {}'.format(len(sample), input_filename, filename))
 
-        print('Extract {} -> {}'.format(input_filename2, output_filename2))
 
 if __name__ == '__main__':
     main()
@@ -2,9 +2,14 @@
 # -*- coding: utf-8 -*-
 #used to map new dataset vocab id to old dataset vocab id
 
+import os
 import sys
 import cPickle as pkl
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from libs.utility.vocabulary import load_dictionary
+
 def main():
 
     new_src_dic_file = sys.argv[1]
@@ -15,11 +20,11 @@ def main():
     new_to_old_src_map = {}
     new_to_old_tgt_map = {}
 
-    o_src_dic = pkl.load(open(old_src_dic_file, 'rb'))
-    o_tgt_dic = pkl.load(open(old_tgt_dic_file, 'rb'))
+    o_src_dic = load_dictionary(old_src_dic_file)
+    o_tgt_dic = load_dictionary(old_tgt_dic_file)
 
-    new_src_dic = pkl.load(open(new_src_dic_file, 'rb'))
-    new_tgt_dic = pkl.load(open(new_tgt_dic_file, 'rb'))
+    new_src_dic = load_dictionary(new_src_dic_file)
+    new_tgt_dic = load_dictionary(new_tgt_dic_file)
 
     for (word, id) in new_src_dic.iteritems():
         if word in o_src_dic:
@@ -38,4 +43,4 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -35,6 +35,9 @@ def main():
                         help='Dim of word embedding, default is %(default)s')
     parser.add_argument('--maxlen', action='store', default=80, type=int, dest='maxlen',
                         help='Max sentence length, default is %(default)s')
+    parser.add_argument('--max_tokens', action='store', default=-1, type=int, dest='max_tokens',
+                        help='Token budget (source + target tokens including padding) of a train batch, '
+                             '--bs is still the max sentences of a batch, default is %(default)s (fixed batch size)')
     parser.add_argument('-S', action='store_false', default=True, dest='shuffle',
                         help='Shuffle data per epoch, default is True, set to False')
     parser.add_argument('--train1', action='store', metavar='filename', dest='train1', type=str,
@@ -153,6 +156,69 @@ def main():
                         help='The buffer size in data reader, default to 40')
     parser.add_argument('--start_epoch', action='store', default=00, type=int, dest='start_epoch',
                         help='The starting epoch, default to 0')
+    parser.add_argument('--binary_data', action="store_true", default=False, dest='binary_data',
+                        help='Read train data from binary pre-indexed corpus (compiled at the first time), '
+                             'with -S unset it is shuffled in place per epoch without shuffled copies, '
+                             'default to False, set to True')
+    parser.add_argument('--prefetch', action='store', default=0, type=int, dest='prefetch_depth',
+                        help='Number of batches prepared ahead in background, default to 0 (not prefetch)')
+    parser.add_argument('--prefetch_workers', action='store', default=1, type=int, dest='prefetch_workers',
+                        help='Number of background batch preparation threads, default to 1')
+    parser.add_argument('--buckets', action='store', default=None, type=str, dest='buckets',
+                        help='Comma-separated length bucket bounds (e.g. "10,20,30,40,50,60,80"), batch the whole '
+                             'binary corpus by (source, target) length buckets and pad to bucket bounds, '
+                             'default to None (not bucketing)')
+    parser.add_argument('--resident_ctx', action='store_true', default=False, dest='resident_ctx',
+                        help='Keep the encoder context on device in dev translation beam search, '
+                             'default to False, set to True')
+    parser.add_argument('--function_cache', action='store', default=None, type=str, dest='function_cache',
+                        help='Directory of compiled function cache, load compiled functions from it if cached, '
+                             'else compile and save them, default to None (not cache)')
+    parser.add_argument('--warm_cache', action='store_true', default=False, dest='warm_cache',
+                        help='Compile functions into --function_cache and exit, default to False, set to True')
+
+    parser.add_argument('--shard_data', action='store_true', default=False, dest='shard_data',
+                        help='In distributed training, each worker reads a disjoint shard of the binary corpus '
+                             '(needs --binary_data or --buckets), default to False, set to True')
+    parser.add_argument('--accum_steps', action='store', default=1, type=int, dest='accum_steps',
+                        help='Accumulate gradients of N batches into one update (and one allreduce in mpi_reduce), '
+                             'default to 1')
+    parser.add_argument('--async_save', action='store_true', default=False, dest='async_save',
+                        help='Write checkpoints in a background thread, default to False, set to True')
+    parser.add_argument('--snapshot_freq', action='store', default=0, type=int, dest='snapshot_freq',
+                        help='Keep in-memory parameter snapshots every N updates to recover from NaN without '
+                             'saved models, default to 0 (not keep)')
+    parser.add_argument('--snapshot_size', action='store', default=3, type=int, dest='snapshot_size',
+                        help='Number of in-memory snapshots, default to 3')
+    parser.add_argument('--snapshot_fp16', action='store_true', default=False, dest='snapshot_fp16',
+                        help='Store parameters of in-memory snapshots in float16 (optimizer states keep their dtype), '
+                             'default to False, set to True')
+    parser.add_argument('--snapshot_max_mb', action='store', default=-1, type=int, dest='snapshot_max_mb',
+                        help='Max total size of in-memory snapshots in MB, default to -1 (unlimited)')
+    parser.add_argument('--metrics', action='store', default=None, type=str, dest='metrics_file',
+                        help='Append per-phase timing and throughput metrics as JSON lines to '
+                             '"<METRICS>.worker<id>.jsonl" every dispFreq updates, default to None (not emit)')
+    parser.add_argument('--metrics_window', action='store', default=100, type=int, dest='metrics_window',
+                        help='Number of recent updates of the rolling metrics statistics, default to 100')
+    parser.add_argument('--profile', action='store', default=0, type=int, dest='profile_steps',
+                        help='Profile N updates with Theano op-level profiling, report the time by model component '
+                             '(encoder/decoder layer, attention, softmax, optimizer). Profiled copies of the train '
+                             'functions are compiled at start and called in these updates only, default to 0 (off)')
+    parser.add_argument('--profile_start', action='store', default=10, type=int, dest='profile_start',
+                        help='Start profiling after N updates (skip warm-up), default to 10')
+    parser.add_argument('--profile_memory', action='store_true', default=False, dest='profile_memory',
+                        help='Also report the output memory of ops in the profiled updates (slower, uses the Python '
+                             'VM), default to False, set to True')
+    parser.add_argument('--fused_step', action='store_true', default=False, dest='fused_step',
+                        help='Compute gradients, clip and update in one function call without gradient buffers '
+                             '(single node only), default to False, set to True')
+    parser.add_argument('--fused_silent', action='store_true', default=False, dest='fused_silent',
+                        help='With --fused_step, only fetch cost and G2 every dispFreq updates to avoid a device sync '
+                             'per update (NaN is only detected at these updates), default to False, set to True')
+    parser.add_argument('--sampled_softmax', action='store', default=0, type=int, dest='sampled_softmax',
+                        help='Train with a sampled softmax over the target words of each batch and N words sampled '
+                             'uniformly from the target vocabulary (validation and decoding use the full softmax), '
+                             'default to 0 (full softmax)')
 
     args = parser.parse_args()
     print args
@@ -161,8 +227,16 @@ def main():
         args.residual_enc = None
     if args.residual_dec == 'None':
         args.residual_dec = None
+    if args.buckets is not None:
+        args.buckets = [int(b) for b in args.buckets.split(',')]
+    assert not args.warm_cache or args.function_cache, '--warm_cache needs --function_cache'
+    assert not args.shard_data or args.binary_data or args.buckets, '--shard_data needs --binary_data or --buckets'
+    assert args.accum_steps >= 1, '--accum_steps must be positive'
     if args.dist_type != 'mv' and args.dist_type != 'mpi_reduce':
         args.dist_type = None
+    assert not args.fused_step or (args.dist_type is None and args.accum_steps == 1), \
+        '--fused_step needs single node training without --accum_steps'
+    assert not args.fused_silent or args.fused_step, '--fused_silent needs --fused_step'
 
     # FIXME: Auto mode
     if args.auto:
@@ -298,6 +372,29 @@ def main():
         start_from_histo_data =  args.start_from_histo_data,
         fine_tune_type= args.finetune_type,
         zhen = zhen,
+        binary_data=args.binary_data,
+        prefetch_depth=args.prefetch_depth,
+        prefetch_workers=args.prefetch_workers,
+        max_tokens=args.max_tokens,
+        bucket_bounds=args.buckets,
+        resident_ctx=args.resident_ctx,
+        function_cache=args.function_cache,
+        warm_cache=args.warm_cache,
+        shard_data=args.shard_data,
+        accum_steps=args.accum_steps,
+        async_save=args.async_save,
+        snapshot_freq=args.snapshot_freq,
+        snapshot_size=args.snapshot_size,
+        snapshot_fp16=args.snapshot_fp16,
+        snapshot_max_mb=args.snapshot_max_mb,
+        metrics_file=args.metrics_file,
+        metrics_window=args.metrics_window,
+        profile_start=args.profile_start,
+        profile_steps=args.profile_steps,
+        profile_memory=args.profile_memory,
+        fused_step=args.fused_step,
+        fused_silent=args.fused_silent,
+        sampled_softmax=args.sampled_softmax,
     )
 
 
@@ -0,0 +1,237 @@
+#! /usr/bin/python
+# -*- encoding: utf-8 -*-
+
+"""Long-running translation service with dynamic request batching.
+
+The model is loaded and the sampler is built once. Protocols:
+    HTTP (default):
+        POST /translate   {"text": "a sentence"} or {"texts": ["sentence 1", ...]}
+                          -> {"translation": ...} or {"translations": [...]}
+        GET  /stats       -> latency percentiles and throughput
+    stdin/stdout (--stdin):
+        One request per line, a plain sentence or {"id": ..., "text": ...},
+        one JSON result per line in the same order: {"id": ..., "translation": ..., "latency": ...}
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import sys
+import threading
+import time
+from collections import OrderedDict
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from Queue import Queue
+
+import numpy as np
+import theano
+
+from libs.models import build_and_init_model
+from libs.utility.utils import load_options_test
+from libs.utility.translate import load_translate_data, translate_block, seqs2words, de_bpe
+from libs.utility.serving import DynamicBatcher
+from libs.utility.function_cache import FunctionCache, cached_functions
+
+__author__ = 'fyabc'
+
+
+def build_translate_fn(args):
+    """Load the model once, return the batch translate function."""
+
+    options = load_options_test(args.model)
+
+    from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
+    trng = RandomStreams(1234)
+    use_noise = theano.shared(np.float32(0.))
+
+    model_type = 'TrgAttnNMTModel' if args.trg_attention else 'NMTModel'
+    model, _ = build_and_init_model(args.model, options=options, build=False, model_type=model_type)
+
+    def build_functions():
+        f_init, f_next = model.build_sampler(trng=trng, use_noise=use_noise, batch_mode=True,
+                                             dropout=options['use_dropout'], resident_ctx=args.resident_ctx)
+        return {'functions': OrderedDict([('f_init', f_init), ('f_next', f_next[0]), ('f_att_projected', f_next[1])])}
+
+    function_cache = None
+    if args.function_cache:
+        function_cache = FunctionCache(args.function_cache, options, extra=(model_type, False, args.resident_ctx))
+    functions = cached_functions(function_cache, 'sampler', model.P, build_functions)['functions']
+    f_init, f_next = functions['f_init'], [functions['f_next'], functions.get('f_att_projected')]
+
+    word_dict, _, word_idict_trg = load_translate_data(
+        args.dictionary_source, args.dictionary_target, None, load_input=False, echo=True)
+    n_words_src = options['n_words_src']
+
+    def translate_fn(sentences):
+        seqs = []
+        for sentence in sentences:
+            seq = [word_dict.get(w, 1) for w in sentence.strip().split()]
+            seqs.append([w if w < n_words_src else 1 for w in seq])
+
+        trans, _, _, _ = translate_block(seqs, model, f_init, f_next, trng, args.k, alpha=args.alpha)
+        trans = seqs2words(trans, word_idict_trg)
+        if args.de_bpe:
+            trans = [de_bpe(t) for t in trans]
+        return trans
+
+    return translate_fn
+
+
+def serve_stdin(batcher, output):
+    """Read requests from stdin, write results to output in input order."""
+
+    pending = Queue()
+
+    def write_results():
+        while True:
+            item = pending.get()
+            if item is None:
+                break
+            request_id, request = item
+            try:
+                result = {'id': request_id, 'translation': request.wait()}
+            except Exception as e:
+                result = {'id': request_id, 'error': str(e)}
+            result['latency'] = request.latency
+            print(json.dumps(result), file=output)
+            output.flush()
+
+    writer = threading.Thread(target=write_results, name='ResultWriter')
+    writer.start()
+
+    for line_id, line in enumerate(iter(sys.stdin.readline, '')):
+        line = line.strip()
+        request_id, text = line_id, line
+        if line.startswith('{'):
+            obj = json.loads(line)
+            request_id, text = obj.get('id', line_id), obj['text']
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        pending.put((request_id, batcher.submit(text)))
+
+    pending.put(None)
+    writer.join()
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_handler(batcher):
+    class TranslateHandler(BaseHTTPRequestHandler):
+        def _reply(self, code, obj):
+            body = json.dumps(obj)
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self._reply(200, batcher.stats.summary())
+            else:
+                self._reply(404, {'error': 'Unknown path {}'.format(self.path)})
+
+        def do_POST(self):
+            if self.path != '/translate':
+                self._reply(404, {'error': 'Unknown path {}'.format(self.path)})
+                return
+
+            try:
+                obj = json.loads(self.rfile.read(int(self.headers.getheader('Content-Length', 0))))
+                single = 'text' in obj
+                texts = [obj['text']] if single else obj['texts']
+                texts = [t.encode('utf-8') if isinstance(t, unicode) else t for t in texts]
+            except (ValueError, KeyError, TypeError) as e:
+                self._reply(400, {'error': 'Bad request: {}'.format(e)})
+                return
+
+            # Submit all sentences first, so they can be batched together
+            requests = [batcher.submit(text) for text in texts]
+            try:
+                translations = [request.wait() for request in requests]
+            except Exception as e:
+                self._reply(500, {'error': str(e)})
+                return
+
+            if single:
+                self._reply(200, {'translation': translations[0]})
+            else:
+                self._reply(200, {'translations': translations})
+
+        def log_message(self, format, *args):
+            pass
+
+    return TranslateHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Translation server with dynamic request batching')
+    parser.add_argument('-k', type=int, default=4,
+                        help='Beam size, default to 4')
+    parser.add_argument('-alpha', type=float, default=1.,
+                        help='The length penalty alpha, default to 1.0')
+    parser.add_argument('-b', type=int, default=32, dest='max_batch_size',
+                        help='Max number of sentences in a batch, default to 32')
+    parser.add_argument('--max_latency', type=float, default=0.05, dest='max_latency',
+                        help='Max seconds a request waits for a batch to be filled, default to 0.05')
+    parser.add_argument('--stdin', action='store_true', default=False, dest='stdin',
+                        help='Serve JSON lines on stdin/stdout instead of HTTP, default to False, set to True')
+    parser.add_argument('--host', type=str, default='127.0.0.1', dest='host',
+                        help='HTTP host, default to 127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080, dest='port',
+                        help='HTTP port, default to 8080')
+    parser.add_argument('--stats_interval', type=float, default=60., dest='stats_interval',
+                        help='Print latency and throughput stats to stderr every N seconds, default to 60, '
+                             '0 means not print')
+    parser.add_argument('--trg_att', action='store_true', dest='trg_attention', default=False,
+                        help='Use target attention, default is False, set to True')
+    parser.add_argument('--resident_ctx', action='store_true', dest='resident_ctx', default=False,
+                        help='Keep the encoder context on device in beam search, default is False, set to True')
+    parser.add_argument('--function_cache', action='store', dest='function_cache', default=None,
+                        help='Directory of compiled function cache (shared with translate_single.py), '
+                             'default is None (not cache)')
+    parser.add_argument('--de_bpe', action='store_true', dest='de_bpe', default=False,
+                        help='Remove BPE separators of translations, default is False, set to True')
+
+    parser.add_argument('model', type=str, help='The model path')
+    parser.add_argument('dictionary_source', type=str, help='The source dict path')
+    parser.add_argument('dictionary_target', type=str, help='The target dict path')
+    args = parser.parse_args()
+
+    # Keep stdout clean for results, model loading messages go to stderr
+    output = sys.stdout
+    if args.stdin:
+        sys.stdout = sys.stderr
+
+    batcher = DynamicBatcher(build_translate_fn(args), args.max_batch_size, args.max_latency)
+
+    if args.stats_interval > 0:
+        def print_stats():
+            while True:
+                time.sleep(args.stats_interval)
+                print(batcher.stats.summary_str(), file=sys.stderr)
+
+        stats_thread = threading.Thread(target=print_stats, name='StatsPrinter')
+        stats_thread.daemon = True
+        stats_thread.start()
+
+    try:
+        if args.stdin:
+            serve_stdin(batcher, output)
+        else:
+            server = _ThreadingHTTPServer((args.host, args.port), make_handler(batcher))
+            print('Serving on http://{}:{}'.format(args.host, args.port), file=sys.stderr)
+            server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(batcher.stats.summary_str(), file=sys.stderr)
+        batcher.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,7 @@
 
 import argparse
 import cPickle as pkl
+from collections import OrderedDict
 from pprint import pprint
 
 import numpy as np
@@ -11,7 +12,9 @@ import theano
 from libs.constants import Datasets
 from libs.models import build_and_init_model
 from libs.utility.utils import load_options_test
+from libs.utility.function_cache import FunctionCache, cached_functions
 from libs.utility.translate import translate_whole, chosen_by_len_alpha, get_bleu, seqs2words, de_tc, de_bpe
+from libs.utility.profiling import ProfileWindow
 
 def main(model, dictionary, dictionary_target, source_file, saveto, k=5,alpha = 0,
          normalize=False, chr_level=False, batch_size=1, zhen = False, src_trg_table_path = None, search_all_alphas = False, ref_file = None, dump_all = False, args = None):
@@ -36,10 +39,31 @@ def main(model, dictionary, dictionary_target, source_file, saveto, k=5,alpha =
 
     model, _ = build_and_init_model(model, options=options, build=False, model_type=model_type)
 
-    f_init, f_next = model.build_sampler(trng=trng, use_noise = use_noise, batch_mode = batch_mode, dropout=options['use_dropout'], need_srcattn = zhen)
+    def build_functions():
+        f_init, f_next = model.build_sampler(trng=trng, use_noise = use_noise, batch_mode = batch_mode, dropout=options['use_dropout'], need_srcattn = zhen,
+                                             resident_ctx=args.resident_ctx)
+        return {'functions': OrderedDict([('f_init', f_init), ('f_next', f_next[0]), ('f_att_projected', f_next[1])])}
+
+    function_cache = None
+    if args.function_cache:
+        function_cache = FunctionCache(args.function_cache, options, extra=(model_type, zhen, args.resident_ctx))
+    functions = cached_functions(function_cache, 'sampler', model.P, build_functions, warm=args.warm_cache)['functions']
+    f_init, f_next = functions['f_init'], [functions['f_next'], functions.get('f_att_projected')]
+    if args.warm_cache:
+        return
+
+    profile_window = None
+    if args.profile > 0:
+        # Profile decode steps [profile_start, profile_start + profile), f_next is called once per step
+        profile_window = ProfileWindow(OrderedDict([('f_next', (f_next[0], None))]),
+                                       start=args.profile_start, n_steps=args.profile, name='Decode profile',
+                                       memory=args.profile_memory)
+        f_next = [profile_window.wrap(profile_window.function('f_next')), f_next[1]]
 
     trans, all_cand_ids, all_cand_trans, all_scores, word_idic_tgt = translate_whole(model, f_init, f_next, trng, dictionary, dictionary_target, source_file, k, normalize, alpha= alpha,
                                 src_trg_table = src_trg_table, zhen = zhen, n_words_src = options['n_words_src'], echo = True, batch_size = batch_size)
+    if profile_window is not None:
+        profile_window.report()
 
     if search_all_alphas:
         all_alpha_values = 0.1 * np.array(xrange(11))
@@ -87,6 +111,21 @@ if __name__ == "__main__":
                         help='Testing all length penalty alpha values, default to False, set to True')
     parser.add_argument('--trg_att', action='store_true', dest='trg_attention', default=False,
                         help='Use target attention, default is False, set to True')
+    parser.add_argument('--resident_ctx', action='store_true', dest='resident_ctx', default=False,
+                        help='Keep the encoder context on device in beam search, feed sentence indices of hypotheses '
+                             'instead of repeated context to f_next, default is False, set to True')
+    parser.add_argument('--function_cache', action='store', dest='function_cache', default=None,
+                        help='Directory of compiled function cache, default is None (not cache)')
+    parser.add_argument('--warm_cache', action='store_true', dest='warm_cache', default=False,
+                        help='Compile the sampler into --function_cache and exit, default is False, set to True')
+    parser.add_argument('--profile', action='store', dest='profile', type=int, default=0,
+                        help='Profile N decode steps with Theano op-level profiling (a profiled copy of f_next is '
+                             'called in these steps only), report the time by model component, default is 0 (off)')
+    parser.add_argument('--profile_start', action='store', dest='profile_start', type=int, default=10,
+                        help='Start profiling after N decode steps, default is 10')
+    parser.add_argument('--profile_memory', action='store_true', dest='profile_memory', default=False,
+                        help='Also report the output memory of ops in the profiled steps (slower), '
+                             'default is False, set to True')
     parser.add_argument('--ref_file', action='store', metavar='filename', dest='ref_file', type= str, help = 'The test ref file', default = None)
 
     parser.add_argument('model', type=str, help='The model path')
@@ -98,6 +137,7 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     assert not args.all_alphas or args.ref_file
+    assert not args.warm_cache or args.function_cache
 
     main(args.model, args.dictionary_source, args.dictionary_target, args.source,
          args.saveto, k=args.k, alpha= args.alpha,normalize=args.n,